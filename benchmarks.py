@@ -0,0 +1,393 @@
+#! /usr/bin/env python3
+
+from collections.abc import Callable
+from functools import wraps
+import os
+import random
+import string
+from time import perf_counter, sleep
+
+
+benchmarks: list = []
+
+
+def benchmark(func: Callable) -> Callable:
+    """
+    Registers a benchmark to be run by this script, under a header naming it
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        print('=' * 70)
+        print(func.__name__)
+        return func(*args, **kwargs)
+
+    benchmarks.append(wrapper)
+    return wrapper
+
+
+def timed(func: Callable, *args, **kwargs) -> float:
+    """
+    Returns the wall-clock time in seconds taken by a single call
+    """
+    start = perf_counter()
+    func(*args, **kwargs)
+    return perf_counter() - start
+
+
+def report(label: str, count: int, seconds: float, unit: str) -> None:
+    print('%-40s %12.1f %s/s' % (label, count / seconds, unit))
+
+
+def asciistr(i: int):
+    return ''.join([random.choice(string.ascii_lowercase) for _ in range(i)])
+
+
+
+@benchmark
+def keccak_hash_many(count: int = 20000, size: int = 128):
+    import keccak
+
+    messages = [bytes(asciistr(size), 'utf8') for _ in range(count)]
+
+    def loop():
+        return [keccak.Keccak256(m).digest() for m in messages]
+
+    report('Keccak256() loop', count, timed(loop), 'msgs')
+    for workers in (1, 2, 4, 8):
+        report('hash_many(workers=%d)' % workers, count,
+               timed(keccak.hash_many, messages, keccak.Keccak256, workers), 'msgs')
+
+
+
+@benchmark
+def feistel_modes(size: int = 1 << 22):
+    from feistel import FeistelCipher
+
+    data = bytes(size)
+    for name in ('ECB', 'CBC', 'PCBC', 'CFB', 'OFB'):
+        cipher = FeistelCipher(mode=getattr(FeistelCipher, 'MODE_' + name))
+        report('encrypt_bytes(MODE_%s)' % name, size >> 20, timed(cipher.encrypt_bytes, data), 'MB')
+    for workers in (1, 2, 4, 8):
+        cipher = FeistelCipher(mode=FeistelCipher.MODE_CTR, workers=workers)
+        report('encrypt_bytes(MODE_CTR, workers=%d)' % workers, size >> 20,
+               timed(cipher.encrypt_bytes, data), 'MB')
+
+
+
+@benchmark
+def ntru_multiply(count: int = 200):
+    import ntruencrypt
+
+    cLib = ntruencrypt.NTRUPolynomial.cLib
+    for name in ('NTRUEncrypt80', 'NTRUEncrypt128', 'NTRUEncrypt192', 'NTRUEncrypt256'):
+        cipher = getattr(ntruencrypt, name)()
+        N = cipher.params['N']
+        sparse = cipher._NTRUCipher__random_poly(cipher.params)
+        dense = ntruencrypt.NTRUPolynomial(random.randrange(cipher.params['q']) for _ in range(N))
+        out = ntruencrypt.NTRUPolynomial.zeros(N)
+
+        def loop(mul, p, q):
+            for _ in range(count):
+                mul(p, q, out)
+
+        print(name)
+        report('  schoolbook_mul', count, timed(loop, cLib.schoolbook_mul, sparse, dense), 'muls')
+        report('  sparse_mul', count, timed(loop, cLib.sparse_mul, sparse, dense), 'muls')
+        report('  karatsuba_mul', count, timed(loop, cLib.karatsuba_mul, sparse, dense), 'muls')
+        report('  v_mul (sparse x dense)', count, timed(loop, cLib.v_mul, sparse, dense), 'muls')
+        report('  v_mul (dense x dense)', count, timed(loop, cLib.v_mul, dense, dense), 'muls')
+
+
+
+@benchmark
+def ntru_blocks(count: int = 500):
+    import ntruencrypt
+
+    Polynomial = ntruencrypt.NTRUPolynomial
+    for name in ('NTRUEncrypt80', 'NTRUEncrypt128', 'NTRUEncrypt192', 'NTRUEncrypt256'):
+        cipher = getattr(ntruencrypt, name)()
+        N, d, p, q = (cipher.params[k] for k in ('N', 'd', 'p', 'q'))
+        h, context = cipher.key['pub'], cipher.context
+        m, out = Polynomial(random.randrange(p) for _ in range(N)), Polynomial.zeros(N)
+
+        def chained():
+            for _ in range(count):
+                r = cipher.cLib.sample_ternary(d, d - 1, os.urandom(32), Polynomial.zeros(N))
+                (r * h + m.centerlift(p)) % q
+
+        def fused():
+            for _ in range(count):
+                cipher.cLib.encrypt_block(context, m, os.urandom(32), out)
+
+        print(name)
+        report('  operator chain', count, timed(chained), 'blocks')
+        report('  encrypt_block', count, timed(fused), 'blocks')
+
+
+
+@benchmark
+def ntru_sample(count: int = 5000):
+    import ntruencrypt
+
+    cLib, Polynomial = ntruencrypt.NTRUPolynomial.cLib, ntruencrypt.NTRUPolynomial
+    for name in ('NTRUEncrypt80', 'NTRUEncrypt256'):
+        N, d = (getattr(ntruencrypt, name).params[k] for k in ('N', 'd'))
+        polys = [Polynomial.zeros(N) for _ in range(count)]
+
+        def mersenne():
+            for poly in polys:
+                positions = random.sample(range(N), 2 * d - 1)
+                poly[:] = Polynomial.zeros(N)
+                for i in positions[:d]:
+                    poly[i] = 1
+                for i in positions[d:]:
+                    poly[i] = -1
+
+        def loop():
+            for poly in polys:
+                cLib.sample_ternary(d, d - 1, os.urandom(cLib.SEED_BYTES), poly)
+
+        print(name)
+        report('  random.sample loop', count, timed(mersenne), 'polys')
+        report('  sample_ternary loop', count, timed(loop), 'polys')
+        report('  sample_many', count, timed(cLib.sample_many, d, d - 1, os.urandom(cLib.SEED_BYTES), polys), 'polys')
+
+
+
+@benchmark
+def ntru_encode(size: int = 1 << 16):
+    import ntruencrypt
+
+    data = bytes(random.getrandbits(8) for _ in range(size))
+    cipher = ntruencrypt.NTRUEncrypt256()
+    p, q, N = cipher.params['p'], cipher.params['q'], cipher.params['N']
+    blocks = ntruencrypt.bytes2base(data, p, N)
+    report('bytes2base(base=%d)' % p, size >> 10, timed(ntruencrypt.bytes2base, data, p, N), 'KB')
+    report('base2bytes(base=%d)' % p, size >> 10, timed(ntruencrypt.base2bytes, blocks, p), 'KB')
+    report('encrypt (%d KB)' % (size >> 10), size >> 10, timed(cipher.encrypt, str(data, 'latin1')), 'KB')
+
+
+
+@benchmark
+def ntru_keygen(count: int = 50):
+    import ntruencrypt
+
+    for name in ('NTRUEncrypt80', 'NTRUEncrypt128', 'NTRUEncrypt192', 'NTRUEncrypt256'):
+        preset = getattr(ntruencrypt, name)
+
+        def loop():
+            for _ in range(count):
+                preset()
+
+        report('%s()' % name, count, timed(loop), 'keys')
+        with ntruencrypt.NTRUKeyPool(preset, size=count, workers=2) as pool:
+            while len(pool) < count:
+                sleep(0.01)
+            report('%s() from NTRUKeyPool' % name, count, timed(loop), 'keys')
+
+
+
+@benchmark
+def ntru_encrypt_many(count: int = 500, size: int = 256):
+    import ntruencrypt
+
+    messages = [asciistr(size) for _ in range(count)]
+    for name in ('NTRUEncrypt80', 'NTRUEncrypt256'):
+        cipher = getattr(ntruencrypt, name)()
+        blocks = count * len(ntruencrypt.bytes2base(bytes(messages[0], 'utf8'), cipher.params['p'],
+                                                    cipher.params['N']))
+
+        def loop():
+            return [cipher.encrypt(m) for m in messages]
+
+        print(name)
+        report('  encrypt() loop', blocks, timed(loop), 'blocks')
+        for workers in (1, 2, 4, 8):
+            report('  encrypt_many(workers=%d)' % workers, blocks,
+                   timed(cipher.encrypt_many, messages, workers), 'blocks')
+
+
+
+@benchmark
+def ntru_keystore(count: int = 5000):
+    import tempfile
+    import ntruencrypt
+
+    cipher = ntruencrypt.NTRUEncrypt256()
+    with tempfile.TemporaryDirectory() as tmp:
+        with ntruencrypt.NTRUKeyStore(tmp + '/keys') as store:
+            for i in range(count):
+                store.add('node%d' % i, cipher)
+
+        def lookups():
+            with ntruencrypt.NTRUKeyStore(tmp + '/keys') as store:
+                for i in range(count):
+                    store['node%d' % i]
+
+        report('NTRUKeyStore open', count, timed(ntruencrypt.NTRUKeyStore, tmp + '/keys'), 'keys')
+        report('NTRUKeyStore lookup', count, timed(lookups), 'keys')
+
+
+
+@benchmark
+def ntru_backends(count: int = 100, batch: int = 2000):
+    import c_ntruencrypt.polynomial as native
+    import ntruencrypt
+    try:
+        import np_ntruencrypt.polynomial as vectorised
+    except ImportError:
+        print('NumPy is not installed')
+        return
+
+    for name in ('NTRUEncrypt80', 'NTRUEncrypt256'):
+        cipher = getattr(ntruencrypt, name)()
+        N, d, p, q = (cipher.params[k] for k in ('N', 'd', 'p', 'q'))
+        f, h = cipher.key['priv'], cipher.key['pub']
+        dense = ntruencrypt.NTRUPolynomial(random.randrange(q) for _ in range(N))
+        blocks = [ntruencrypt.NTRUPolynomial(random.randrange(p) for _ in range(N)) for _ in range(batch)]
+        out = ntruencrypt.NTRUPolynomial.zeros(N)
+
+        def loop(func, *args):
+            for _ in range(count):
+                func(*args)
+
+        print(name)
+        for label, cLib in (('native', native), ('numpy', vectorised)):
+            context = cLib.new_context(h, f, d, p, q)
+            report('  %s v_mul (sparse x dense)' % label, count, timed(loop, cLib.v_mul, f, dense, out), 'muls')
+            report('  %s v_mul (dense x dense)' % label, count, timed(loop, cLib.v_mul, dense, dense, out), 'muls')
+            report('  %s inverse_modpn' % label, count, timed(loop, cLib.inverse_modpn, f, q, out), 'keys')
+            report('  %s encrypt_many' % label, batch,
+                   timed(cLib.encrypt_many, context, blocks, os.urandom(32), 1), 'blocks')
+        m = vectorised.np.stack([vectorised.view(block) for block in blocks])
+        context = vectorised.new_context(h, f, d, p, q)
+        report('  numpy encrypt_block (2-D batch)', batch,
+               timed(vectorised.encrypt_block, context, m, os.urandom(32), m), 'blocks')
+
+
+
+@benchmark
+def blockchain_mine(difficulty: int = 5, count: int = 1 << 16):
+    import blockchain
+
+    chain = blockchain.Blockchain()
+    last_block = chain.last_block
+    last_hash = chain.hash(last_block)
+
+    def loop():
+        for proof in range(count):
+            chain.valid_proof(last_block.proof, proof, last_hash, difficulty)
+
+    report('valid_proof loop', count, timed(loop), 'hashes')
+    for workers in (1, 2, 4, 8):
+        miner = blockchain.ProofOfWork(workers)
+        miner.search(last_block.proof, last_hash, difficulty)
+        report('ProofOfWork(workers=%d)' % workers, miner.hashes, miner.seconds, 'hashes')
+
+
+
+@benchmark
+def blockchain_consensus(length: int = 10000, extra: int = 100):
+    import tempfile
+    from threading import Thread
+    from werkzeug.serving import make_server
+    import blockchain
+
+    def grow(chain, count):
+        for _ in range(count):
+            last_block, proof = chain.last_block, 0
+            while not chain.valid_proof(last_block.proof, proof, last_block.hash, chain.difficulty):
+                proof += 1
+            chain.new_transaction('0', asciistr(8), 1)
+            chain.new_block(proof, last_block.hash)
+
+    node = blockchain.BlockchainNode(__name__)
+    peer = node.blockchain
+    peer.difficulty = 1
+    grow(peer, length)
+    local = blockchain.Blockchain(difficulty=1)
+    report('valid_chain (no common prefix)', len(peer.chain), timed(local.valid_chain, peer.chain), 'blocks')
+    server = make_server('127.0.0.1', 0, node, threaded=True)
+    Thread(target=server.serve_forever, daemon=True).start()
+    with tempfile.TemporaryDirectory() as tmp:
+        chains = {'list': blockchain.Blockchain(difficulty=1),
+                  'store': blockchain.Blockchain(difficulty=1, path=tmp + '/chain')}
+        for local in chains.values():
+            del local.chain[:]
+            local.chain.extend(peer.chain)
+            local.register_node('127.0.0.1:%d' % server.server_port)
+        grow(peer, extra)
+        try:
+            for label, local in chains.items():
+                report('valid_chain (%s, %d new blocks)' % (label, extra), len(peer.chain),
+                       timed(local.valid_chain, peer.chain), 'blocks')
+                report('resolve_conflicts (%s, %d new blocks)' % (label, extra), len(peer.chain),
+                       timed(local.resolve_conflicts), 'blocks')
+                assert len(local.chain) == len(peer.chain)
+        finally:
+            server.shutdown()
+            chains['store'].chain.close()
+
+
+
+@benchmark
+def blockchain_encoding(count: int = 2000, transactions: int = 10):
+    import hashlib
+    import json
+    import blockchain
+
+    chain = blockchain.Blockchain(difficulty=1)
+    for _ in range(count):
+        for _ in range(transactions):
+            chain.new_transaction(asciistr(32), asciistr(32), random.randint(1, 100))
+        chain.new_block(0, None)
+    blocks = chain.chain
+
+    def json_hashes():
+        for block in blocks:
+            hashlib.sha256(json.dumps(block._replace(hash=None), sort_keys=True).encode()).hexdigest()
+
+    def binary_hashes():
+        for block in blocks:
+            chain.hash(block)
+
+    report('json.dumps hash', count, timed(json_hashes), 'blocks')
+    report('encode_block hash', count, timed(binary_hashes), 'blocks')
+    ndjson = sum(len(json.dumps(block._asdict())) + 1 for block in blocks)
+    packed = sum(len(record) for record in blockchain.pack_blocks(blocks))
+    print('%-40s %12d bytes/block' % ('NDJSON wire size', ndjson // count))
+    print('%-40s %12d bytes/block' % ('packed wire size', packed // count))
+
+
+
+@benchmark
+def blockchain_store(length: int = 10000):
+    import tempfile
+    import blockchain
+
+    with tempfile.TemporaryDirectory() as tmp:
+        chain = blockchain.Blockchain(difficulty=1, path=tmp + '/chain')
+        for _ in range(length):
+            chain.new_transaction('0', asciistr(8), 1)
+            chain.new_block(0, None)
+        hashes = [block.hash for block in chain.chain]
+        chain.chain.close()
+
+        def lookups(store):
+            for i in range(length):
+                store[i]
+
+        def hash_lookups(store):
+            for h in hashes:
+                store.get(h)
+
+        report('BlockStore open', length, timed(blockchain.BlockStore, tmp + '/chain'), 'blocks')
+        with blockchain.BlockStore(tmp + '/chain') as store:
+            report('BlockStore lookup by height', length, timed(lookups, store), 'blocks')
+            report('BlockStore lookup by hash', length, timed(hash_lookups, store), 'blocks')
+
+
+
+if __name__ == '__main__':
+    for bench in benchmarks:
+        bench()
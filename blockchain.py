@@ -2,30 +2,505 @@
 
 from __future__ import annotations
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import hashlib
 import json
-from time import time
-from typing import List, Set
+import logging
+from mmap import mmap, ACCESS_READ
+from multiprocessing import Event, Process, Value
+import os
+from os import cpu_count
+from struct import Struct, error as StructError
+from threading import Lock, RLock
+from time import perf_counter, time
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
 from urllib.parse import urlparse
 from uuid import uuid4
 
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 import requests
+from requests.adapters import HTTPAdapter
 
 
-Block = namedtuple('Block', ['message', 'index', 'timestamp', 'transactions', 'proof', 'previous_hash'])
+Block = namedtuple('Block', ['message', 'index', 'timestamp', 'transactions', 'proof', 'previous_hash', 'hash'])
 Block.__new__.__defaults__ = (None,) * len(Block._fields)
 Transaction = namedtuple('Transaction', ['sender', 'recipient', 'amount'])
 
+# Leading zero hex digits a proof's hash must have, of the 64 in a SHA-256 digest
+DIFFICULTY = 6
+MAX_DIFFICULTY = 2 * hashlib.sha256().digest_size
+
+# Chain validation logs each block it checks at DEBUG level, so is silent unless enabled
+logger = logging.getLogger(__name__)
+
+# Neighbours are queried concurrently by up to this many threads, over as many kept-alive connections
+FETCH_WORKERS = 16
+
+# Block ranges are streamed as newline-delimited JSON, or packed as binary blocks, when the client accepts it
+NDJSON = 'application/x-ndjson'
+BLOCKS = 'application/octet-stream'
+
+# Index, timestamp, proof and raw previous hash, then the number of transactions that follow
+BLOCK_HEADER = Struct('<Qdq32sI')
+# Amount, then the lengths of the sender and recipient that follow
+TRANSACTION_HEADER = Struct('<qHH')
+# The longest sender or recipient, in UTF-8 bytes, and the range of amounts a transaction header holds
+MAX_PARTY_BYTES = 0xFFFF
+MIN_AMOUNT, MAX_AMOUNT = -1 << 63, (1 << 63) - 1
+# Length of the encoded block that follows
+BLOCK_RECORD = Struct('<I')
+HASH_BYTES = hashlib.sha256().digest_size
+
+# The genesis block has no previous block, so links to an all-zero hash
+GENESIS_HASH = '00' * HASH_BYTES
+
+
+def hash_digest(hash: str) -> bytes:
+    """
+    Returns the raw digest of a hash, which must be written exactly as sha256's hexdigest writes it
+    """
+    if not isinstance(hash, str) or len(hash) != 2 * HASH_BYTES or not set(hash) <= set('0123456789abcdef'):
+        raise ValueError('Error: hash is not %d lowercase hex digits' % (2 * HASH_BYTES))
+    return bytes.fromhex(hash)
+
+
+def encode_block(block: Block) -> bytes:
+    """
+    Encodes a block's contents canonically, as a fixed-width header followed by its transactions,
+    each a fixed-width header followed by its UTF-8 sender and recipient.
+    The block's own hash is left out, as the encoding is what the hash is taken over.
+    """
+    parts = [BLOCK_HEADER.pack(block.index, block.timestamp, block.proof, hash_digest(block.previous_hash),
+                               len(block.transactions))]
+    for transaction in block.transactions:
+        sender, recipient = transaction['sender'].encode(), transaction['recipient'].encode()
+        parts.append(TRANSACTION_HEADER.pack(transaction['amount'], len(sender), len(recipient)))
+        parts.append(sender + recipient)
+    return b''.join(parts)
+
+
+def decode_block(data: bytes, hash: str = None) -> Block:
+    """
+    Decodes a block's contents, attaching the given hash to it
+    """
+    index, timestamp, proof, previous_hash, count = BLOCK_HEADER.unpack_from(data)
+    offset, transactions = BLOCK_HEADER.size, []
+    for _ in range(count):
+        amount, sender_len, recipient_len = TRANSACTION_HEADER.unpack_from(data, offset)
+        offset += TRANSACTION_HEADER.size
+        sender = str(data[offset:offset + sender_len], 'utf8')
+        recipient = str(data[offset + sender_len:offset + sender_len + recipient_len], 'utf8')
+        offset += sender_len + recipient_len
+        transactions.append(Transaction(sender, recipient, amount)._asdict())
+    if offset != len(data):
+        raise ValueError('Error: block encoding has %d trailing bytes' % (len(data) - offset))
+    return Block(index=index, timestamp=timestamp, transactions=transactions, proof=proof,
+                 previous_hash=previous_hash.hex(), hash=hash)
+
+
+def pack_blocks(blocks: Iterable[Block]) -> Iterator[bytes]:
+    """
+    Encodes blocks for the wire, each as its length, its encoding and its raw hash
+    """
+    for block in blocks:
+        encoded = encode_block(block)
+        yield BLOCK_RECORD.pack(len(encoded)) + encoded + hash_digest(block.hash)
+
+
+def unpack_blocks(data: bytes) -> List[Block]:
+    """
+    Decodes blocks packed for the wire. Their hashes are taken as given, to be checked when the chain is validated.
+    """
+    offset, blocks = 0, []
+    while offset < len(data):
+        length, = BLOCK_RECORD.unpack_from(data, offset)
+        start = offset + BLOCK_RECORD.size
+        end = start + length
+        if end + HASH_BYTES > len(data):
+            raise ValueError('Error: block record is truncated')
+        blocks.append(decode_block(data[start:end], data[end:end + HASH_BYTES].hex()))
+        offset = end + HASH_BYTES
+    return blocks
+
+
+def meets_difficulty(digest: bytes, difficulty: int) -> bool:
+    """
+    Checks a raw digest for the given number of leading zero hex digits, without formatting it
+    """
+    zeros = difficulty // 2
+    return digest[:zeros] == bytes(zeros) and (difficulty % 2 == 0 or digest[zeros] < 0x10)
+
+
+def search_share(last_proof: int, last_hash: str, difficulty: int, start: int, step: int, chunk: int,
+                 stop: Event, found: Value, hashes: Value) -> None:
+    """
+    Tries every step'th proof from start, a chunk at a time, until one is found or the search is stopped.
+    The hash state over the fixed last_proof prefix is built once and copied for each guess.
+    """
+    prefix, suffix = hashlib.sha256(b'%d' % last_proof), last_hash.encode()
+    proof = start
+    while not stop.is_set():
+        first, tried = proof, chunk
+        for proof in range(first, first + chunk * step, step):
+            guess = prefix.copy()
+            guess.update(b'%d%s' % (proof, suffix))
+            if meets_difficulty(guess.digest(), difficulty):
+                with found.get_lock():
+                    if found.value < 0:
+                        found.value = proof
+                stop.set()
+                # Count only the proofs actually tried in this chunk
+                tried = (proof - first) // step + 1
+                break
+        proof += step
+        with hashes.get_lock():
+            hashes.value += tried
+
+
+class ProofOfWork:
+    """
+    A proof-of-work search split across worker processes, each taking every workers'th proof.
+    A search stops as soon as any worker finds a proof, or when it is cancelled from another thread,
+    and records how many hashes it tried and how long it took.
+    """
+
+    def __init__(self, workers: int = None, chunk: int = 1 << 12) -> None:
+        self.workers = workers or cpu_count() or 1
+        self.chunk = chunk
+        self.hashes, self.seconds = 0, 0.
+        self.__lock = Lock()
+        self.__stop: Optional[Event] = None
+
+    @property
+    def hashrate(self) -> float:
+        """
+        Hashes per second over the last search
+        """
+        return self.hashes / self.seconds if self.seconds else 0.
+
+    def search(self, last_proof: int, last_hash: str, difficulty: int = DIFFICULTY) -> Optional[int]:
+        """
+        Returns a proof for the given last proof and hash, or None if the search was cancelled.
+        Raises ValueError for a difficulty no digest can meet, and RuntimeError if every worker dies.
+        """
+        if not 0 <= difficulty <= MAX_DIFFICULTY:
+            raise ValueError('Error: difficulty must be from 0 to %d' % MAX_DIFFICULTY)
+        stop, found, hashes = Event(), Value('q', -1), Value('Q', 0)
+        with self.__lock:
+            self.__stop = stop
+        workers = [Process(target=search_share, daemon=True,
+                           args=(last_proof, last_hash, difficulty, w, self.workers, self.chunk, stop, found, hashes))
+                   for w in range(self.workers)]
+        start = perf_counter()
+        for worker in workers:
+            worker.start()
+        while not stop.wait(0.1) and any(worker.is_alive() for worker in workers):
+            pass
+        for worker in workers:
+            worker.join()
+        self.hashes, self.seconds = hashes.value, perf_counter() - start
+        with self.__lock:
+            self.__stop = None
+        # Workers only stop early when one finds a proof or the search is cancelled, both of which set stop
+        if not stop.is_set():
+            raise RuntimeError('Error: every proof-of-work worker exited without a proof')
+        return found.value if found.value >= 0 else None
+
+    def cancel(self) -> None:
+        """
+        Stops any search in progress, which then returns None
+        """
+        with self.__lock:
+            if self.__stop is not None:
+                self.__stop.set()
+
+
+class BlockStore:
+    """
+    An append-only segment file of encoded blocks, with an index file of fixed-size entries
+    giving each block's offset, length and hash, both memory-mapped for reads,
+    and a hash table file mapping each block's hash to its height.
+    Opening the store reads neither the chain nor the index, so the block at any height or with any hash
+    is found in constant time without replaying the chain, and a block is only decoded when it is looked up.
+    The store can stand in for a list of blocks:
+    it supports len, indexing, slicing and iteration, appending, and deleting a suffix.
+    Every read, append and truncation holds the store's lock, so it may be shared between threads:
+    a mapping is only closed while the lock is held, and readers copy out of it before releasing the lock.
+    """
+    MAGIC = b'BLOCKS02'
+    INDEX_MAGIC = b'BLKIDX02'
+    RECORD = BLOCK_RECORD
+    # Offset and length of an encoded block in the segment file, then its raw hash
+    ENTRY = Struct('<QI32s')
+    HASH_MAGIC = b'BLKHSH01'
+    # Slots, slots used and blocks added so far, then an open-addressed table of slots keyed by hash,
+    # each holding a block's height plus one, or 0 if empty. Slots left by truncated blocks are skipped
+    # on lookup, as their height is past the end of the chain or holds a block with another hash.
+    HASH_HEADER = Struct('<QQQ')
+    SLOT = Struct('<Q')
+    MIN_SLOTS = 1 << 10
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.__data = self.__open(path, self.MAGIC)
+        try:
+            self.__index = self.__open(path + '.idx', self.INDEX_MAGIC)
+        except ValueError:
+            self.__data.close()
+            raise
+        # Read-only mappings of each file, remapped as the file grows
+        self.__maps: dict = {}
+        self.__lock = RLock()
+        self.__hash_file = self.__hashes = None
+        self.__recover()
+        self.__open_hashes()
+
+    def __enter__(self) -> BlockStore:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return self.__count
+
+    def __getitem__(self, key: int | slice) -> Block | List[Block]:
+        with self.__lock:
+            if isinstance(key, slice):
+                return [self[i] for i in range(*key.indices(self.__count))]
+            height = key + self.__count if key < 0 else key
+            if not 0 <= height < self.__count:
+                raise IndexError('block index out of range')
+            offset, length, digest = self.__entry(height)
+            encoded = self.__view(self.__data)[offset:offset + length]
+        return decode_block(encoded, digest.hex())
+
+    def __delitem__(self, key: slice) -> None:
+        """
+        Removes the blocks from key.start onwards, which is the only removal an append-only store allows
+        """
+        with self.__lock:
+            if not isinstance(key, slice) or key.step is not None or key.indices(self.__count)[1] != self.__count:
+                raise TypeError('only a suffix of the chain can be deleted')
+            self.__truncate(key.indices(self.__count)[0])
+
+    def __iter__(self) -> Iterator[Block]:
+        for height in range(self.__count):
+            yield self[height]
+
+    @staticmethod
+    def __open(path: str, magic: bytes):
+        file = open(path, 'a+b')
+        if file.tell() == 0:
+            file.write(magic)
+            file.flush()
+        file.seek(0)
+        if file.read(len(magic)) != magic:
+            file.close()
+            raise ValueError("Error: %s is not a block store" % path)
+        file.seek(0, 2)
+        return file
+
+    def __view(self, file) -> mmap:
+        """
+        Returns a mapping of the whole file, remapping it if it has grown since it was last mapped
+        """
+        view = self.__maps.get(file)
+        if view is None or len(view) < file.tell():
+            if view is not None:
+                view.close()
+            view = self.__maps[file] = mmap(file.fileno(), 0, access=ACCESS_READ)
+        return view
+
+    def __unmap(self) -> None:
+        for view in self.__maps.values():
+            view.close()
+        self.__maps.clear()
+
+    def __entry(self, height: int) -> tuple:
+        index = self.__view(self.__index)
+        return self.ENTRY.unpack_from(index, len(self.INDEX_MAGIC) + height * self.ENTRY.size)
+
+    def __recover(self) -> None:
+        """
+        Reconciles the index with the segment file after an interrupted append:
+        entries for blocks that were never fully written are dropped,
+        and whole blocks written after the last indexed one are indexed
+        """
+        self.__count = (self.__index.tell() - len(self.INDEX_MAGIC)) // self.ENTRY.size
+        end = len(self.MAGIC)
+        while self.__count:
+            offset, length, _ = self.__entry(self.__count - 1)
+            if offset + length <= self.__data.tell():
+                end = offset + length
+                break
+            self.__count -= 1
+        self.__unmap()
+        self.__index.truncate(len(self.INDEX_MAGIC) + self.__count * self.ENTRY.size)
+        data = self.__view(self.__data)
+        while end + self.RECORD.size <= len(data):
+            length, = self.RECORD.unpack_from(data, end)
+            start = end + self.RECORD.size
+            if start + length > len(data):
+                break
+            digest = hashlib.sha256(data[start:start + length]).digest()
+            self.__index.write(self.ENTRY.pack(start, length, digest))
+            self.__count += 1
+            end = start + length
+        self.__index.flush()
+        self.__unmap()
+        self.__data.truncate(end)
+        self.__data.seek(0, 2)
+        self.__index.seek(0, 2)
+
+    def __truncate(self, height: int) -> None:
+        if height >= self.__count:
+            return
+        offset, _, _ = self.__entry(height)
+        self.__unmap()
+        self.__data.truncate(offset - self.RECORD.size)
+        self.__index.truncate(len(self.INDEX_MAGIC) + height * self.ENTRY.size)
+        self.__data.seek(0, 2)
+        self.__index.seek(0, 2)
+        self.__count = height
+
+    def __open_hashes(self) -> None:
+        """
+        Maps the hash table, adding any blocks appended since it was last updated,
+        or rebuilds it if it is missing or damaged
+        """
+        path, header = self.path + '.hash', len(self.HASH_MAGIC) + self.HASH_HEADER.size
+        if os.path.exists(path):
+            self.__hash_file = open(path, 'r+b')
+            size = self.__hash_file.seek(0, 2)
+            if size > header:
+                self.__hashes = mmap(self.__hash_file.fileno(), 0)
+                slots, _, added = self.HASH_HEADER.unpack_from(self.__hashes, len(self.HASH_MAGIC))
+                if self.__hashes[:len(self.HASH_MAGIC)] == self.HASH_MAGIC and size == header + slots * self.SLOT.size:
+                    for height in range(min(added, self.__count), self.__count):
+                        self.__add_hash(height)
+                    return
+        self.__rebuild_hashes()
+
+    def __close_hashes(self) -> None:
+        if self.__hashes is not None:
+            self.__hashes.close()
+        if self.__hash_file is not None:
+            self.__hash_file.close()
+        self.__hash_file = self.__hashes = None
+
+    def __rebuild_hashes(self) -> None:
+        """
+        Writes a fresh hash table of every block, with room for the chain to double, and maps it in its place
+        """
+        self.__close_hashes()
+        path, slots = self.path + '.hash', max(self.MIN_SLOTS, 4 * self.__count)
+        with open(path + '.tmp', 'wb') as file:
+            file.write(self.HASH_MAGIC + self.HASH_HEADER.pack(slots, 0, 0))
+            file.truncate(len(self.HASH_MAGIC) + self.HASH_HEADER.size + slots * self.SLOT.size)
+        os.replace(path + '.tmp', path)
+        self.__hash_file = open(path, 'r+b')
+        self.__hashes = mmap(self.__hash_file.fileno(), 0)
+        for height in range(self.__count):
+            self.__add_hash(height)
+
+    def __slots(self, digest: bytes) -> Iterator[int]:
+        """
+        Yields the offsets of the slots to probe for a hash, from the one it hashes to onwards
+        """
+        slots, _, _ = self.HASH_HEADER.unpack_from(self.__hashes, len(self.HASH_MAGIC))
+        slot = int.from_bytes(digest[:8], 'little') % slots
+        while True:
+            yield len(self.HASH_MAGIC) + self.HASH_HEADER.size + slot * self.SLOT.size
+            slot = (slot + 1) % slots
+
+    def __add_hash(self, height: int) -> None:
+        slots, used, _ = self.HASH_HEADER.unpack_from(self.__hashes, len(self.HASH_MAGIC))
+        # Keep the table at most half full, so probes stay short
+        if 2 * (used + 1) > slots:
+            self.__rebuild_hashes()
+            return
+        for offset in self.__slots(self.__entry(height)[2]):
+            if not self.SLOT.unpack_from(self.__hashes, offset)[0]:
+                self.SLOT.pack_into(self.__hashes, offset, height + 1)
+                break
+        self.HASH_HEADER.pack_into(self.__hashes, len(self.HASH_MAGIC), slots, used + 1, height + 1)
+
+    def append(self, block: Block) -> None:
+        encoded, digest = encode_block(block), hash_digest(block.hash)
+        with self.__lock:
+            offset = self.__data.tell() + self.RECORD.size
+            # The block goes to disk before its index entry, so an interrupted append can always be recovered
+            self.__data.write(self.RECORD.pack(len(encoded)) + encoded)
+            self.__data.flush()
+            self.__index.write(self.ENTRY.pack(offset, len(encoded), digest))
+            self.__index.flush()
+            self.__count += 1
+            self.__add_hash(self.__count - 1)
+
+    def extend(self, blocks: Iterable[Block]) -> None:
+        with self.__lock:
+            for block in blocks:
+                self.append(block)
+
+    def hash_at(self, height: int) -> str:
+        """
+        Returns the hash of the block at the given height from the index, without decoding the block
+        """
+        with self.__lock:
+            if not 0 <= height < self.__count:
+                raise IndexError('block index out of range')
+            return self.__entry(height)[2].hex()
+
+    def height(self, hash: str) -> Optional[int]:
+        """
+        Returns the height of the block with the given hash, or None if it is not stored
+        """
+        try:
+            digest = bytes.fromhex(hash)
+        except ValueError:
+            return None
+        with self.__lock:
+            for offset in self.__slots(digest):
+                value, = self.SLOT.unpack_from(self.__hashes, offset)
+                if not value:
+                    return None
+                if value - 1 < self.__count and self.__entry(value - 1)[2] == digest:
+                    return value - 1
+
+    def get(self, hash: str) -> Optional[Block]:
+        """
+        Returns the block with the given hash, or None if it is not stored
+        """
+        height = self.height(hash)
+        return None if height is None else self[height]
+
+    def close(self) -> None:
+        with self.__lock:
+            self.__unmap()
+            self.__close_hashes()
+            self.__data.close()
+            self.__index.close()
+
 
 class Blockchain:
 
-    def __init__(self):
+    def __init__(self, workers: int = None, difficulty: int = DIFFICULTY, timeout: float = 5., path: str = None):
         self.current_transactions: List[Transaction] = []
-        self.chain: List[Block] = []
+        # Kept in a block store if given a path, else in memory
+        self.chain: List[Block] | BlockStore = BlockStore(path) if path else []
+        # Held while the chain or pending transactions change, and by readers that need one whole chain
+        self.lock = RLock()
         self.nodes: Set[str] = set()
-        # Create the genesis block
-        self.new_block(100, '1')
+        self.miner = ProofOfWork(workers)
+        self.difficulty = difficulty
+        # Seconds to wait on any one neighbour, and a connection pool shared by every request to them
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=FETCH_WORKERS, pool_maxsize=FETCH_WORKERS))
+        # Create the genesis block, unless the chain was reopened from its store
+        if not self.chain:
+            self.new_block(100, GENESIS_HASH)
 
 
     def register_node(self, address: str) -> None:
@@ -39,63 +514,185 @@ class Blockchain:
             raise ValueError('Invalid URL')
 
 
+    def common_prefix(self, blocks: List[Block], start: int = 0) -> int:
+        """
+        Returns the height at which the given blocks, the first of which is at height start, fork from ours.
+        Blocks are matched by their stored hashes, from the end of the shorter chain backwards,
+        so when one chain extends the other this takes a single comparison.
+        """
+        for height in range(min(len(self.chain), start + len(blocks)), start, -1):
+            if blocks[height - 1 - start].hash == self.hash_at(height - 1):
+                return height
+        return start
+
+
+    def hash_at(self, height: int) -> str:
+        """
+        Returns the hash of our block at the given height, which a block store reads without decoding the block
+        """
+        if isinstance(self.chain, BlockStore):
+            return self.chain.hash_at(height)
+        return self.chain[height].hash
+
+
     def valid_chain(self, chain: List[Block]) -> bool:
-        for last_block, block in zip(chain[:-1], chain[1:]):
-            print(f'{last_block}')
-            print(f'{block}')
-            print("\n-----------\n")
-            # Check that the hash of the block is correct
-            if block.previous_hash != self.hash(last_block):
+        """
+        Validates the chain we would adopt from the given one: our own blocks up to the fork, then theirs.
+        Our blocks have already been validated, so only the blocks after the fork are checked.
+        """
+        start = self.common_prefix(chain)
+        return self.valid_blocks(start, chain[start:])
+
+
+    def valid_blocks(self, start: int, blocks: List[Block]) -> bool:
+        """
+        Validates blocks that would replace ours from height start onwards, the first linking to our block before it.
+        Each block's stored hash is recomputed once, then links and proofs use the stored hashes.
+        """
+        logger.debug('Validating blocks %d to %d', start, start + len(blocks) - 1)
+        last_block = self.chain[start - 1] if start else None
+        for i, block in enumerate(blocks, start):
+            logger.debug('%s', block)
+            # Check that the block's stored hash is correct, and that it can be encoded at all
+            try:
+                digest = self.hash(block)
+            except (ValueError, TypeError, KeyError, AttributeError, StructError):
+                logger.debug('Block %d is malformed', i)
+                return False
+            if block.hash != digest:
+                logger.debug('Block %d has a bad hash', i)
+                return False
+            if last_block is None:
+                last_block = block
+                continue
+            # Check that the block links to the previous one
+            if block.previous_hash != last_block.hash:
+                logger.debug('Block %d does not link to block %d', i, i - 1)
                 return False
             # Check that the Proof of Work is correct
-            if not self.valid_proof(last_block.proof, block.proof, last_block.previous_hash):
+            if not self.valid_proof(last_block.proof, block.proof, last_block.hash, self.difficulty):
+                logger.debug('Block %d has a bad proof', i)
                 return False
+            last_block = block
         return True
 
 
-    def resolve_conflicts(self) -> bool:
-        neighbours = self.nodes
-        new_chain = None
-        # We're only looking for chains longer than ours
-        max_length = len(self.chain)
-        # Grab and verify the chains from all the nodes in our network
-        for node in neighbours:
-            response = requests.get(f'http://{node}/chain')
+    def fetch(self, node: str, path: str) -> Optional[dict]:
+        """
+        Gets a JSON document from a neighbour, or None if it fails or does not answer in time
+        """
+        try:
+            response = self.session.get(f'http://{node}{path}', timeout=self.timeout)
+            if response.status_code == 200:
+                return response.json()
+        except (requests.RequestException, ValueError) as e:
+            logger.debug('Fetching %s from %s failed: %s', path, node, e)
+        return None
+
+
+    @staticmethod
+    def tip_length(tip: Optional[dict]) -> int:
+        """
+        Returns the chain length a neighbour's tip claims, or 0 if the tip is missing or malformed
+        """
+        length = tip.get('length') if isinstance(tip, dict) else None
+        return length if isinstance(length, int) and not isinstance(length, bool) else 0
+
+
+    def fetch_blocks(self, node: str, start: int) -> Optional[List[Block]]:
+        """
+        Gets a neighbour's blocks from the given index onwards as packed binary blocks, or returns None if it fails
+        """
+        try:
+            response = self.session.get(f'http://{node}/chain', params={'from': start}, headers={'Accept': BLOCKS},
+                                        timeout=self.timeout)
             if response.status_code == 200:
-                length = response.json()['length']
-                chain = response.json()['chain']
-                # Check if the length is longer and the chain is valid
-                if length > max_length and self.valid_chain(chain):
-                    max_length = length
-                    new_chain = chain
-        # Replace our chain if we discovered a new, valid chain longer than ours
-        if new_chain:
-            self.chain = new_chain
-            return True
+                return unpack_blocks(response.content)
+        except (requests.RequestException, ValueError, StructError) as e:
+            logger.debug('Fetching blocks from %s failed: %s', node, e)
+        return None
+
+
+    def sync(self, node: str) -> Optional[Tuple[int, List[Block]]]:
+        """
+        Returns the height at which a neighbour's chain forks from ours, and its blocks from there on.
+        Asks for the blocks after our last, reaching twice as far back each time they do not join our chain,
+        then drops any fetched blocks whose hashes match ours
+        """
+        reach = 0
+        while True:
+            start = max(1, len(self.chain) + 1 - reach)
+            blocks = self.fetch_blocks(node, start)
+            if not blocks:
+                return None
+            if start == 1 or blocks[0].previous_hash == self.hash_at(start - 2):
+                fork = self.common_prefix(blocks, start - 1)
+                return fork, blocks[fork - start + 1:]
+            reach = max(1, 2 * reach)
+
+
+    def resolve_conflicts(self) -> bool:
+        """
+        Adopts the longest valid chain among our neighbours, if it is longer than ours.
+        Every neighbour is asked for its tip at once, and only those claiming a longer chain
+        are asked for the blocks we are missing, so a slow or dead neighbour costs at most one timeout.
+        """
+        neighbours = list(self.nodes)
+        if not neighbours:
+            return False
+        with ThreadPoolExecutor(max_workers=min(len(neighbours), FETCH_WORKERS)) as pool:
+            tips = pool.map(lambda node: self.fetch(node, '/chain/tip'), neighbours)
+            # We're only looking for chains longer than ours
+            longer = [node for node, tip in zip(neighbours, tips) if self.tip_length(tip) > len(self.chain)]
+            forks = [fork for fork in pool.map(self.sync, longer) if fork]
+        # Replace our chain with the longest valid chain we discovered.
+        # Only the blocks after the fork are checked and replaced, so a stored chain keeps the rest on disk
+        with self.lock:
+            for start, blocks in sorted(forks, key=lambda fork: fork[0] + len(fork[1]), reverse=True):
+                if start + len(blocks) > len(self.chain) and self.valid_blocks(start, blocks):
+                    del self.chain[start:]
+                    self.chain.extend(blocks)
+                    # Any proof being mined is for a block that is no longer last
+                    self.miner.cancel()
+                    return True
         return False
 
 
     def new_block(self, proof: int, previous_hash: str) -> Block:
-        block = Block(**{
-            'index': len(self.chain) + 1,
-            'timestamp': time(),
-            'transactions': [transaction._asdict() for transaction in self.current_transactions],
-            'proof': proof,
-            'previous_hash': previous_hash or self.hash(self.chain[-1]),
-        })
-        # Reset the current list of transactions
-        self.current_transactions = []
-        self.chain.append(block)
-        return block
+        with self.lock:
+            block = Block(**{
+                'index': len(self.chain) + 1,
+                'timestamp': time(),
+                'transactions': [transaction._asdict() for transaction in self.current_transactions],
+                'proof': proof,
+                'previous_hash': previous_hash or self.chain[-1].hash,
+            })
+            # Hash the block once, and keep it with the block
+            block = block._replace(hash=self.hash(block))
+            # Reset the current list of transactions
+            self.current_transactions = []
+            self.chain.append(block)
+            return block
 
 
     def new_transaction(self, sender: str, recipient: str, amount: int) -> int:
-        self.current_transactions.append(Transaction(**{
-            'sender': sender,
-            'recipient': recipient,
-            'amount': amount,
-        }))
-        return self.last_block.index + 1
+        """
+        Queues a transaction for the next block, raising ValueError if it could not be encoded in one:
+        the sender and recipient must be strings of at most MAX_PARTY_BYTES in UTF-8, and the amount a 64-bit integer
+        """
+        for party in (sender, recipient):
+            if not isinstance(party, str) or len(party.encode()) > MAX_PARTY_BYTES:
+                raise ValueError('Error: sender and recipient must be strings of at most %d UTF-8 bytes'
+                                 % MAX_PARTY_BYTES)
+        if isinstance(amount, bool) or not isinstance(amount, int) or not MIN_AMOUNT <= amount <= MAX_AMOUNT:
+            raise ValueError('Error: amount must be an integer from %d to %d' % (MIN_AMOUNT, MAX_AMOUNT))
+        with self.lock:
+            self.current_transactions.append(Transaction(**{
+                'sender': sender,
+                'recipient': recipient,
+                'amount': amount,
+            }))
+            return self.last_block.index + 1
 
 
     @property
@@ -105,34 +702,33 @@ class Blockchain:
 
     @staticmethod
     def hash(block: Block) -> str:
-        block_string = json.dumps(block, sort_keys=True).encode()
-        return hashlib.sha256(block_string).hexdigest()
+        """
+        Computes a block's hash from its canonical encoding, ignoring any hash already stored on it
+        """
+        return hashlib.sha256(encode_block(block)).hexdigest()
 
 
-    def proof_of_work(self, last_block: Block) -> int:
-        last_proof = last_block.proof
-        last_hash = self.hash(last_block)
-        proof = 0
-        while self.valid_proof(last_proof, proof, last_hash) is False:
-            proof += 1
-        return proof
+    def proof_of_work(self, last_block: Block, difficulty: int = None) -> Optional[int]:
+        """
+        Mines a proof for the block after last_block on every core, or returns None if cancelled
+        """
+        return self.miner.search(last_block.proof, last_block.hash, difficulty or self.difficulty)
 
 
     @staticmethod
     def valid_proof(last_proof: int, proof: int, last_hash: str,
-                    difficulty: int = 6) -> bool:
-        guess = f'{last_proof}{proof}{last_hash}'.encode()
-        guess_hash = hashlib.sha256(guess).hexdigest()
-        return guess_hash[:difficulty] == "0" * difficulty
+                    difficulty: int = DIFFICULTY) -> bool:
+        guess = b'%d%d%s' % (last_proof, proof, last_hash.encode())
+        return meets_difficulty(hashlib.sha256(guess).digest(), difficulty)
 
 
 
 class BlockchainNode(Flask):
 
-    def __init__(self, *args, **kwargs) -> None:
+    def __init__(self, *args, path: str = None, **kwargs) -> None:
         super().__init__(*args, **kwargs)
         self.node_id = str(uuid4()).replace('-', '')
-        self.blockchain = Blockchain()
+        self.blockchain = Blockchain(path=path)
         for rule, func, methods in self.routes:
             self.add_url_rule(rule, view_func=getattr(self, func), methods=methods)
 
@@ -140,46 +736,88 @@ class BlockchainNode(Flask):
     def mine(self):
         last_block = self.blockchain.last_block
         proof = self.blockchain.proof_of_work(last_block)
-        # We must receive a reward for finding the proof.
-        # The sender is "0" to signify that this node has mined a new coin.
-        self.blockchain.new_transaction('0', self.node_id, 1)
-        # Forge the new Block by adding it to the chain
-        previous_hash = self.blockchain.hash(last_block)
-        block = self.blockchain.new_block(proof, previous_hash)
+        # Check the chain has not changed and forge on it in one step, so no other block can come between
+        with self.blockchain.lock:
+            # Compare by hash, as a block store decodes a new block on every lookup
+            if proof is None or last_block.hash != self.blockchain.last_block.hash:
+                return jsonify({'message': "Mining cancelled, the chain has changed"}), 409
+            # We must receive a reward for finding the proof.
+            # The sender is "0" to signify that this node has mined a new coin.
+            self.blockchain.new_transaction('0', self.node_id, 1)
+            # Forge the new Block by adding it to the chain, taking the reward back if it cannot be
+            try:
+                block = self.blockchain.new_block(proof, last_block.hash)
+            except Exception:
+                self.blockchain.current_transactions.pop()
+                raise
         response = Block(**{
             'message': "New Block Forged",
             'index': block.index,
             'transactions': block.transactions,
             'proof': block.proof,
             'previous_hash': block.previous_hash,
+            'hash': block.hash,
         })
-        return jsonify(response._asdict()), 200
+        return jsonify(dict(response._asdict(), hashrate=self.blockchain.miner.hashrate)), 200
 
 
     def new_transaction(self):
         values = request.get_json()
         # Check that the required fields are in the POST'ed data
         required = ['sender', 'recipient', 'amount']
-        if not all(k in values for k in required):
+        if not isinstance(values, dict) or not all(k in values for k in required):
             return 'Missing values', 400
         # Create a new Transaction
-        index = self.blockchain.new_transaction(
-            values['sender'],
-            values['recipient'],
-            values['amount'],
-        )
+        try:
+            index = self.blockchain.new_transaction(
+                values['sender'],
+                values['recipient'],
+                values['amount'],
+            )
+        except ValueError as e:
+            return str(e), 400
         response = {'message': f'Transaction will be added to Block {index}'}
         return jsonify(response), 201
 
 
     def full_chain(self):
+        """
+        Returns the blocks with indices from ?from= (default 1) onwards, at most ?limit= of them,
+        streamed as one JSON block per line if the client accepts NDJSON, or as packed binary blocks
+        """
+        start = request.args.get('from', 1, type=int)
+        limit = request.args.get('limit', None, type=int)
+        if start < 1 or (limit is not None and limit < 0):
+            return "Error: Please supply a valid block range", 400
+        # Take the range from one whole chain, as it may be replaced while the response is streamed
+        with self.blockchain.lock:
+            chain = self.blockchain.chain
+            length = len(chain)
+            blocks = chain[start - 1:length if limit is None else min(length, start - 1 + limit)]
+
+        headers = {'X-Chain-Length': str(length)}
+        mimetype = request.accept_mimetypes.best_match(['application/json', NDJSON, BLOCKS])
+        if mimetype == NDJSON:
+            lines = (json.dumps(block._asdict()) + '\n' for block in blocks)
+            return Response(lines, mimetype=NDJSON, headers=headers)
+        if mimetype == BLOCKS:
+            return Response(pack_blocks(blocks), mimetype=BLOCKS, headers=headers)
         response = {
-            'chain': [block._asdict() for block in self.blockchain.chain],
-            'length': len(self.blockchain.chain),
+            'chain': [block._asdict() for block in blocks],
+            'length': length,
         }
         return jsonify(response), 200
 
 
+    def chain_tip(self):
+        with self.blockchain.lock:
+            response = {
+                'length': len(self.blockchain.chain),
+                'hash': self.blockchain.last_block.hash,
+            }
+        return jsonify(response), 200
+
+
     def register_nodes(self):
         values = request.get_json()
         nodes = values.get('nodes')
@@ -196,22 +834,18 @@ class BlockchainNode(Flask):
 
     def consensus(self):
         replaced = self.blockchain.resolve_conflicts()
-        if replaced:
-            response = {
-                'message': 'Our chain was replaced',
-                'new_chain': [block._asdict() for block in self.blockchain.chain],
-            }
-        else:
-            response = {
-                'message': 'Our chain is authoritative',
-                'chain': [block._asdict() for block in self.blockchain.chain],
-            }
+        response = {
+            'message': 'Our chain was replaced' if replaced else 'Our chain is authoritative',
+            'length': len(self.blockchain.chain),
+            'hash': self.blockchain.last_block.hash,
+        }
         return jsonify(response), 200
 
 
     routes = [('/mine', 'mine', ['GET']),
               ('/transactions/new', 'new_transaction', ['POST']),
               ('/chain', 'full_chain', ['GET']),
+              ('/chain/tip', 'chain_tip', ['GET']),
               ('/nodes/register', 'register_nodes', ['POST']),
               ('/nodes/resolve', 'consensus', ['GET'])]
 
@@ -220,10 +854,11 @@ class BlockchainNode(Flask):
 if __name__ == '__main__':
     from argparse import ArgumentParser
 
-    app = BlockchainNode(__name__)
     parser = ArgumentParser()
     parser.add_argument('-p', '--port', default=5000, type=int, help='port to listen on')
+    parser.add_argument('-d', '--data', default=None, help='file to keep the chain in, rather than in memory')
     args = parser.parse_args()
+    app = BlockchainNode(__name__, path=args.data)
     port = args.port
 
     app.run(host='0.0.0.0', port=port)
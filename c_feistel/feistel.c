@@ -1,187 +1,544 @@
 #include "feistel.h"
 
-#define HASH_BLOCKSIZE 1024
-#define FEISTEL_ROUNDS 4
-#define strlen(x) strlen((char *) x)
+/* SHAKE256, as used for both the round function and IV expansion */
+#define SPONGE_RATE 1088
+#define SPONGE_CAPACITY 512
 
-typedef string (*hash_func)(string in, int out_bytes);
+#define MIN(a, b) ((a) < (b) ? (a) : (b))
+#define MAX(a, b) ((a) > (b) ? (a) : (b))
 
 
-void xor (string a, string b, string o) {
-    for (unsigned int i = 0; i < o.len; i++)
-        o.str[i] = a.str[i] ^ b.str[i];
+void xor (const UINT8 *a, const UINT8 *b, UINT8 *o, unsigned int len) {
+    for (unsigned int i = 0; i < len; i++)
+        o[i] = a[i] ^ b[i];
 }
 
 
-string new_string(int len) {
-    string s;
-    s = (string) {
-        .len = (unsigned long long) len,
-        .str = calloc(sizeof(s.str), len)
-    };
-    return s;
+void c_init_context(FeistelContext *context, string key, string iv, enum cipher_mode mode, int workers) {
+    /* Absorb the key once; every round then clones this keyed sponge */
+    context->keyed = c_new_xof(SPONGE_RATE, SPONGE_CAPACITY);
+    c_absorb(&context->keyed, key);
+    context->mode = mode;
+    context->workers = MAX(1, workers);
+    context->counter = 0;
+    memset(context->nonce, 0, NONCE_LEN);
+
+    /* Stretch the IV to a whole block for the chaining modes */
+    KeccakHash iv_hash = c_new_xof(SPONGE_RATE, SPONGE_CAPACITY);
+    c_absorb(&iv_hash, iv);
+    c_read_bytes(&iv_hash, context->iv, HASH_BLOCKSIZE);
+}
+FeistelContext *new_context(PyObject *keyObj, PyObject *ivObj, int mode, int workers) {
+    Py_buffer key, iv;
+    if (mode < ECB || mode > CTR) {
+        PyErr_Format(PyExc_ValueError, "mode %d not found", mode);
+        return NULL;
+    }
+    if (PyObject_GetBuffer(keyObj, &key, PyBUF_SIMPLE) == -1)
+        return NULL;
+    if (PyObject_GetBuffer(ivObj, &iv, PyBUF_SIMPLE) == -1) {
+        PyBuffer_Release(&key);
+        return NULL;
+    }
+    FeistelContext *context = malloc(sizeof(FeistelContext));
+    c_init_context(context,
+                   (string) { .str = key.buf, .len = key.len },
+                   (string) { .str = iv.buf, .len = iv.len },
+                   mode, workers);
+    PyBuffer_Release(&key);
+    PyBuffer_Release(&iv);
+    return context;
 }
 
 
-void free_string(string s) {
-    free(s.str);
+void free_context(FeistelContext *context) {
+    free(context);
 }
 
 
-string hash_feistel_block(string input, string key, string output, hash_func hash, bool forward) {
-    assert(input.len == HASH_BLOCKSIZE);
-    string buffer = new_string(2 * input.len);
-    string left, right, *in, *out, hashed;
-    memcpy(output.str, input.str, input.len);
+void c_feistel_block(const FeistelContext *context, UINT8 *block, bool forward) {
+    /* Transform a single block in place, without touching the heap or modifying the context */
+    UINT8 *left = block, *right = block + HALF_BLOCKSIZE, *in, *out, round_out[HALF_BLOCKSIZE];
+    KeccakHash round_hash;
     for (int round_nmbr = forward? 0:FEISTEL_ROUNDS-1;
          forward? round_nmbr<FEISTEL_ROUNDS:round_nmbr>=0;
          forward? round_nmbr++:round_nmbr--) {
-        left = (string) {
-            .str = output.str,
-            .len = output.len / 2
-        };
-        right = (string) {
-            .str = output.str + left.len,
-            .len = left.len
-        };
-        in = round_nmbr % 2 ? &left : &right; out = round_nmbr % 2 ? &right : &left;
-        
-        memcpy(buffer.str, key.str, key.len);
-        memcpy(buffer.str + key.len, in->str, in->len);
-        buffer.len = key.len + in->len;
-        hashed = hash(buffer, HASH_BLOCKSIZE);
-        xor(hashed, *out, *out);
-        free(hashed.str);
-    }
-    return output;
-}
-
-
-string c_encrypt(string plaintext, string key, string iv, enum cipher_mode mode) {
-    assert(plaintext.len % HASH_BLOCKSIZE == 0);
-    string ciphertext = new_string(plaintext.len), temp = new_string(HASH_BLOCKSIZE);
-    string sub_text;
-    for (unsigned int i = 0; i < plaintext.len / HASH_BLOCKSIZE; i++) {
-        sub_text = (string) {
-            .str = plaintext.str + i * plaintext.len / HASH_BLOCKSIZE,
-            .len = HASH_BLOCKSIZE
+        in = round_nmbr % 2 ? left : right; out = round_nmbr % 2 ? right : left;
+
+        round_hash = context->keyed;
+        c_absorb(&round_hash, (string) {
+            .str = (char *) in,
+            .len = HALF_BLOCKSIZE
+        });
+        c_read_bytes(&round_hash, round_out, HALF_BLOCKSIZE);
+        xor(round_out, out, out, HALF_BLOCKSIZE);
+    }
+}
+
+
+void c_ctr_blocks(const FeistelContext *context, const UINT8 *nonce, const UINT8 *in, UINT8 *out,
+                  unsigned long long int blocks, unsigned long long int counter) {
+    /* XOR blocks with the keystream from the given counter onwards;
+       each depends only on the IV, the message's nonce and its counter */
+    UINT8 base[HASH_BLOCKSIZE], keystream[HASH_BLOCKSIZE];
+    memcpy(base, context->iv, HASH_BLOCKSIZE);
+    xor(base + HASH_BLOCKSIZE - 8 - NONCE_LEN, nonce, base + HASH_BLOCKSIZE - 8 - NONCE_LEN, NONCE_LEN);
+    for (unsigned long long int i = 0; i < blocks; i++, counter++) {
+        memcpy(keystream, base, HASH_BLOCKSIZE);
+        store64(keystream + HASH_BLOCKSIZE - 8, load64(keystream + HASH_BLOCKSIZE - 8) ^ counter);
+        c_feistel_block(context, keystream, true);
+        xor(keystream, in + i * HASH_BLOCKSIZE, out + i * HASH_BLOCKSIZE, HASH_BLOCKSIZE);
+    }
+}
+
+
+typedef struct {
+    const FeistelContext *context;
+    const UINT8 *nonce, *in;
+    UINT8 *out;
+    unsigned long long int blocks, counter;
+} CTRJob;
+
+void *c_ctr_worker(void *arg) {
+    CTRJob *job = (CTRJob *) arg;
+    c_ctr_blocks(job->context, job->nonce, job->in, job->out, job->blocks, job->counter);
+    return NULL;
+}
+
+void c_ctr(const FeistelContext *context, const UINT8 *nonce, string input, string output, unsigned long long int counter) {
+    /* Split whole blocks into contiguous runs, one per worker thread */
+    assert(input.len % HASH_BLOCKSIZE == 0 && output.len >= input.len);
+    unsigned long long int blocks = input.len / HASH_BLOCKSIZE, share, start = 0;
+    int workers = (int) MAX(1, MIN((unsigned long long int) context->workers, blocks));
+    pthread_t *threads = malloc(sizeof(pthread_t) * workers);
+    CTRJob *jobs = malloc(sizeof(CTRJob) * workers);
+    bool *started = calloc(workers, sizeof(bool));
+    for (int w = 0; w < workers; w++) {
+        share = blocks / workers + ((unsigned long long int) w < blocks % workers);
+        jobs[w] = (CTRJob) {
+            .context = context,
+            .nonce = nonce,
+            .in = (UINT8 *) input.str + start * HASH_BLOCKSIZE,
+            .out = (UINT8 *) output.str + start * HASH_BLOCKSIZE,
+            .blocks = share,
+            .counter = counter + start
         };
-        
-        switch (mode) {
-            case ECB:
-                hash_feistel_block(sub_text, key, temp, c_hash, true);
-                memcpy(ciphertext.str + i * HASH_BLOCKSIZE, temp.str, HASH_BLOCKSIZE);
-                break;
-                
-            case CBC:
-                xor(iv, sub_text, iv);
-                hash_feistel_block(iv, key, temp, c_hash, true);
-                memcpy(ciphertext.str + i * HASH_BLOCKSIZE, temp.str, HASH_BLOCKSIZE);
-                break;
-                
-            case PCBC:
-                xor(iv, sub_text, iv);
-                hash_feistel_block(iv, key, temp, c_hash, true);
-                memcpy(ciphertext.str + i * HASH_BLOCKSIZE, temp.str, HASH_BLOCKSIZE);
-                xor(temp, sub_text, iv);
-                break;
-                
-            case CFB:
-                hash_feistel_block(iv, key, temp, c_hash, true);
-                xor(sub_text, temp, iv);
-                memcpy(ciphertext.str + i * HASH_BLOCKSIZE, iv.str, HASH_BLOCKSIZE);
-                break;
-            
-            case OFB:
-                hash_feistel_block(iv, key, temp, c_hash, true);
-                memcpy(iv.str, temp.str, HASH_BLOCKSIZE);
-                xor(sub_text, temp, temp);
-                memcpy(ciphertext.str + i * HASH_BLOCKSIZE, temp.str, HASH_BLOCKSIZE);
-                break;
+        start += share;
+    }
+    /* The calling thread takes the first run, and any run whose thread failed to start */
+    for (int w = 1; w < workers; w++)
+        started[w] = pthread_create(&threads[w], NULL, c_ctr_worker, &jobs[w]) == 0;
+    c_ctr_worker(&jobs[0]);
+    for (int w = 1; w < workers; w++) {
+        if (started[w])
+            pthread_join(threads[w], NULL);
+        else
+            c_ctr_worker(&jobs[w]);
+    }
+    free(threads); free(jobs); free(started);
+}
+
+
+void c_reset(FeistelContext *context) {
+    memcpy(context->chain, context->iv, HASH_BLOCKSIZE);
+    context->counter = 0;
+}
+
+
+void c_encrypt_block(FeistelContext *context, const UINT8 *in, UINT8 *out) {
+    /* Encrypt one block, advancing the chaining value; in and out may alias */
+    UINT8 *chain = context->chain, *work = context->work;
+    switch (context->mode) {
+        case ECB:
+            memmove(out, in, HASH_BLOCKSIZE);
+            c_feistel_block(context, out, true);
+            break;
+
+        case CBC:
+            xor(chain, in, out, HASH_BLOCKSIZE);
+            c_feistel_block(context, out, true);
+            memcpy(chain, out, HASH_BLOCKSIZE);
+            break;
+
+        case PCBC:
+            memcpy(work, in, HASH_BLOCKSIZE);
+            xor(chain, work, out, HASH_BLOCKSIZE);
+            c_feistel_block(context, out, true);
+            xor(work, out, chain, HASH_BLOCKSIZE);
+            break;
+
+        case CFB:
+            c_feistel_block(context, chain, true);
+            xor(chain, in, out, HASH_BLOCKSIZE);
+            memcpy(chain, out, HASH_BLOCKSIZE);
+            break;
+
+        case OFB:
+            c_feistel_block(context, chain, true);
+            xor(chain, in, out, HASH_BLOCKSIZE);
+            break;
+
+        case CTR:
+            c_ctr_blocks(context, context->nonce, in, out, 1, context->counter++);
+            break;
+    }
+}
+
+
+void c_decrypt_block(FeistelContext *context, const UINT8 *in, UINT8 *out) {
+    /* Decrypt one block, advancing the chaining value; in and out may alias */
+    UINT8 *chain = context->chain, *work = context->work;
+    switch (context->mode) {
+        case ECB:
+            memmove(out, in, HASH_BLOCKSIZE);
+            c_feistel_block(context, out, false);
+            break;
+
+        case CBC:
+            memcpy(work, in, HASH_BLOCKSIZE);
+            memcpy(out, work, HASH_BLOCKSIZE);
+            c_feistel_block(context, out, false);
+            xor(chain, out, out, HASH_BLOCKSIZE);
+            memcpy(chain, work, HASH_BLOCKSIZE);
+            break;
+
+        case PCBC:
+            memcpy(work, in, HASH_BLOCKSIZE);
+            memcpy(out, work, HASH_BLOCKSIZE);
+            c_feistel_block(context, out, false);
+            xor(chain, out, out, HASH_BLOCKSIZE);
+            xor(work, out, chain, HASH_BLOCKSIZE);
+            break;
+
+        case CFB:
+            memcpy(work, in, HASH_BLOCKSIZE);
+            c_feistel_block(context, chain, true);
+            xor(chain, work, out, HASH_BLOCKSIZE);
+            memcpy(chain, work, HASH_BLOCKSIZE);
+            break;
+
+        case OFB:
+            c_feistel_block(context, chain, true);
+            xor(chain, in, out, HASH_BLOCKSIZE);
+            break;
+
+        case CTR:
+            c_ctr_blocks(context, context->nonce, in, out, 1, context->counter++);
+            break;
+    }
+}
+
+
+void c_encrypt(FeistelContext *context, string plaintext, string ciphertext) {
+    /* Encrypt whole blocks, continuing from the current chaining value */
+    assert(plaintext.len % HASH_BLOCKSIZE == 0 && ciphertext.len >= plaintext.len);
+    if (context->mode == CTR) {
+        c_ctr(context, context->nonce, plaintext, ciphertext, context->counter);
+        context->counter += plaintext.len / HASH_BLOCKSIZE;
+        return;
+    }
+    for (unsigned long long int i = 0; i < plaintext.len; i += HASH_BLOCKSIZE)
+        c_encrypt_block(context, (UINT8 *) plaintext.str + i, (UINT8 *) ciphertext.str + i);
+}
+
+
+void c_decrypt(FeistelContext *context, string ciphertext, string plaintext) {
+    /* Decrypt whole blocks, continuing from the current chaining value */
+    assert(ciphertext.len % HASH_BLOCKSIZE == 0 && plaintext.len >= ciphertext.len);
+    if (context->mode == CTR) {
+        c_ctr(context, context->nonce, ciphertext, plaintext, context->counter);
+        context->counter += ciphertext.len / HASH_BLOCKSIZE;
+        return;
+    }
+    for (unsigned long long int i = 0; i < ciphertext.len; i += HASH_BLOCKSIZE)
+        c_decrypt_block(context, (UINT8 *) ciphertext.str + i, (UINT8 *) plaintext.str + i);
+}
+
+
+void c_pad(const UINT8 *tail, unsigned int len, UINT8 *block) {
+    /* Terminate a partial block with the delimiter, then fill it with padding; tail and block may alias */
+    memmove(block, tail, len);
+    block[len] = PAD_DELIMITER;
+    memset(block + len + 1, PAD_BYTE, HASH_BLOCKSIZE - len - 1);
+}
+
+
+int c_unpad(const UINT8 *block) {
+    /* Return the length of the message in a final block, or -1 if its padding is invalid */
+    int len = HASH_BLOCKSIZE;
+    while (len > 0 && block[len - 1] == PAD_BYTE)
+        len--;
+    if (len == 0 || block[len - 1] != PAD_DELIMITER)
+        return -1;
+    return len - 1;
+}
+
+
+unsigned long long int c_encrypt_padded(FeistelContext *context, const UINT8 *nonce,
+                                        string plaintext, string ciphertext) {
+    /* Encrypt a whole message from the IV, padding the final block with a delimiter and then zeros.
+       In CTR mode the message's nonce is written first, and the blocks follow it. */
+    unsigned long long int whole = plaintext.len - plaintext.len % HASH_BLOCKSIZE,
+                           tail = plaintext.len - whole,
+                           lead = nonce_length(context);
+    UINT8 *final = (UINT8 *) ciphertext.str + lead + whole;
+    assert(ciphertext.len >= padded_length(plaintext.len) + lead);
+    /* CTR mode runs straight from the counter, without touching the context */
+    if (context->mode == CTR) {
+        memcpy(ciphertext.str, nonce, NONCE_LEN);
+        c_ctr(context, nonce, (string) { .str = plaintext.str, .len = whole },
+              (string) { .str = ciphertext.str + NONCE_LEN, .len = ciphertext.len - NONCE_LEN }, 0);
+        c_pad((UINT8 *) plaintext.str + whole, tail, final);
+        c_ctr_blocks(context, nonce, final, final, 1, whole / HASH_BLOCKSIZE);
+    } else {
+        c_reset(context);
+        c_encrypt(context, (string) { .str = plaintext.str, .len = whole }, ciphertext);
+        c_pad((UINT8 *) plaintext.str + whole, tail, final);
+        c_encrypt_block(context, final, final);
+    }
+    return lead + whole + HASH_BLOCKSIZE;
+}
+
+
+long long int c_decrypt_padded(FeistelContext *context, string ciphertext, string plaintext) {
+    /* Decrypt a whole message from the IV, returning its unpadded length, or -1 if the padding is invalid.
+       In CTR mode the message is led by its nonce. */
+    const UINT8 *nonce = (UINT8 *) ciphertext.str;
+    if (ciphertext.len < (unsigned long long int) nonce_length(context))
+        return -1;
+    ciphertext.str += nonce_length(context);
+    ciphertext.len -= nonce_length(context);
+    assert(ciphertext.len % HASH_BLOCKSIZE == 0 && plaintext.len >= ciphertext.len);
+    if (ciphertext.len == 0)
+        return -1;
+    /* CTR mode runs straight from the counter, without touching the context */
+    if (context->mode == CTR)
+        c_ctr(context, nonce, ciphertext, plaintext, 0);
+    else {
+        c_reset(context);
+        c_decrypt(context, ciphertext, plaintext);
+    }
+
+    unsigned long long int final = ciphertext.len - HASH_BLOCKSIZE;
+    int len = c_unpad((UINT8 *) plaintext.str + final);
+    return len < 0 ? -1 : (long long int) (final + len);
+}
+
+
+unsigned long long int encrypt_padded(FeistelContext *context, const UINT8 *nonce,
+                                      string plaintext, string ciphertext) {
+    /* CTR mode never writes to the context, so is run without the GIL */
+    PyThreadState *state = context->mode == CTR ? PyEval_SaveThread() : NULL;
+    unsigned long long int len = c_encrypt_padded(context, nonce, plaintext, ciphertext);
+    if (state != NULL)
+        PyEval_RestoreThread(state);
+    return len;
+}
+long long int decrypt_padded(FeistelContext *context, string ciphertext, string plaintext) {
+    /* CTR mode never writes to the context, so is run without the GIL */
+    PyThreadState *state = context->mode == CTR ? PyEval_SaveThread() : NULL;
+    long long int len = c_decrypt_padded(context, ciphertext, plaintext);
+    if (state != NULL)
+        PyEval_RestoreThread(state);
+    return len;
+}
+
+
+bool get_nonce(const FeistelContext *context, PyObject *nonceObj, Py_buffer *nonce) {
+    /* Get a message's nonce, which must be NONCE_LEN bytes in CTR mode and is ignored by the other modes */
+    if (PyObject_GetBuffer(nonceObj, nonce, PyBUF_SIMPLE) == -1)
+        return false;
+    if (context->mode == CTR && nonce->len != NONCE_LEN) {
+        PyErr_Format(PyExc_ValueError, "nonce must be %d bytes", NONCE_LEN);
+        PyBuffer_Release(nonce);
+        return false;
+    }
+    return true;
+}
+
+
+PyObject *encrypt_bytes(FeistelContext *context, PyObject *textObj, PyObject *nonceObj) {
+    Py_buffer text, nonce;
+    if (!get_nonce(context, nonceObj, &nonce))
+        return NULL;
+    if (PyObject_GetBuffer(textObj, &text, PyBUF_SIMPLE) == -1) {
+        PyBuffer_Release(&nonce);
+        return NULL;
+    }
+    unsigned long long int len = padded_length(text.len) + nonce_length(context);
+    PyObject *ret = PyBytes_FromStringAndSize(NULL, len);
+    if (ret != NULL)
+        encrypt_padded(context, nonce.buf,
+                       (string) { .str = text.buf, .len = text.len },
+                       (string) { .str = PyBytes_AS_STRING(ret), .len = len });
+    PyBuffer_Release(&text);
+    PyBuffer_Release(&nonce);
+    return ret;
+}
+PyObject *encrypt_into(FeistelContext *context, PyObject *textObj, PyObject *outObj, PyObject *nonceObj) {
+    Py_buffer text, out, nonce;
+    if (!get_nonce(context, nonceObj, &nonce))
+        return NULL;
+    if (PyObject_GetBuffer(textObj, &text, PyBUF_SIMPLE) == -1) {
+        PyBuffer_Release(&nonce);
+        return NULL;
+    }
+    if (PyObject_GetBuffer(outObj, &out, PyBUF_WRITABLE) == -1) {
+        PyBuffer_Release(&text);
+        PyBuffer_Release(&nonce);
+        return NULL;
+    }
+    PyObject *ret = NULL;
+    unsigned long long int len = padded_length(text.len) + nonce_length(context);
+    if ((unsigned long long int) out.len < len)
+        PyErr_Format(PyExc_ValueError, "output buffer must hold at least %llu bytes", len);
+    else
+        ret = PyLong_FromUnsignedLongLong(encrypt_padded(context, nonce.buf,
+                                                         (string) { .str = text.buf, .len = text.len },
+                                                         (string) { .str = out.buf, .len = out.len }));
+    PyBuffer_Release(&text);
+    PyBuffer_Release(&out);
+    PyBuffer_Release(&nonce);
+    return ret;
+}
+
+
+PyObject *decrypt_bytes(FeistelContext *context, PyObject *textObj) {
+    Py_buffer text;
+    if (PyObject_GetBuffer(textObj, &text, PyBUF_SIMPLE) == -1)
+        return NULL;
+    PyObject *ret = NULL;
+    long long int len;
+    Py_ssize_t blocks_len = text.len - nonce_length(context);
+    if (blocks_len <= 0 || blocks_len % HASH_BLOCKSIZE != 0)
+        PyErr_Format(PyExc_ValueError, "input length must be a positive multiple of %d%s", HASH_BLOCKSIZE,
+                     nonce_length(context) ? ", after the nonce" : "");
+    else if ((ret = PyBytes_FromStringAndSize(NULL, text.len)) != NULL) {
+        len = decrypt_padded(context,
+                             (string) { .str = text.buf, .len = text.len },
+                             (string) { .str = PyBytes_AS_STRING(ret), .len = text.len });
+        if (len < 0) {
+            PyErr_SetString(PyExc_ValueError, "invalid padding");
+            Py_CLEAR(ret);
+        } else {
+            _PyBytes_Resize(&ret, len);
         }
     }
-    free_string(temp);
-    return ciphertext;
-}
-char *encrypt_(char *input_ptr, char *key_ptr, char *iv_ptr, int mode) {
-    assert(0 <= mode && mode <= 4);
-    string input = (string) {
-        .len = strlen(input_ptr),
-        .str = input_ptr
-    };
-    string key = (string) {
-        .len = strlen(key_ptr),
-        .str = key_ptr
-    };
-    string iv = (string) {
-        .len = strlen(iv_ptr),
-        .str = iv_ptr
-    };
-    return c_encrypt(input, key, iv, mode).str;
-}
-
-
-string c_decrypt(string ciphertext, string key, string iv, enum cipher_mode mode) {
-    assert(ciphertext.len % HASH_BLOCKSIZE == 0);
-    string plaintext = new_string(ciphertext.len), temp = new_string(HASH_BLOCKSIZE);
-    string sub_text;
-    for (unsigned int i = 0; i < ciphertext.len / HASH_BLOCKSIZE; i++) {
-        sub_text = (string) {
-            .str = ciphertext.str + i * ciphertext.len / HASH_BLOCKSIZE,
-            .len = HASH_BLOCKSIZE
-        };
-        
-        switch (mode) {
-            case ECB:
-                hash_feistel_block(sub_text, key, temp, c_hash, false);
-                memcpy(plaintext.str + i * HASH_BLOCKSIZE, temp.str, HASH_BLOCKSIZE);
-                break;
-                
-            case CBC:
-                hash_feistel_block(sub_text, key, temp, c_hash, false);
-                xor(iv, temp, temp);
-                memcpy(iv.str, sub_text.str, HASH_BLOCKSIZE);
-                memcpy(plaintext.str + i * HASH_BLOCKSIZE, temp.str, HASH_BLOCKSIZE);
-                break;
-                
-            case PCBC:
-                hash_feistel_block(sub_text, key, temp, c_hash, false);
-                xor(iv, temp, temp);
-                xor(sub_text, temp, iv);
-                memcpy(plaintext.str + i * HASH_BLOCKSIZE, temp.str, HASH_BLOCKSIZE);
-                break;
-                
-            case CFB:
-                hash_feistel_block(iv, key, temp, c_hash, true);
-                xor(sub_text, temp, iv);
-                memcpy(plaintext.str + i * HASH_BLOCKSIZE, iv.str, HASH_BLOCKSIZE);
-                memcpy(iv.str, sub_text.str, HASH_BLOCKSIZE);
-                break;
-            
-            case OFB:
-                hash_feistel_block(iv, key, temp, c_hash, true);
-                memcpy(iv.str, temp.str, HASH_BLOCKSIZE);
-                xor(sub_text, temp, temp);
-                memcpy(plaintext.str + i * HASH_BLOCKSIZE, temp.str, HASH_BLOCKSIZE);
-                break;
+    PyBuffer_Release(&text);
+    return ret;
+}
+PyObject *decrypt_into(FeistelContext *context, PyObject *textObj, PyObject *outObj) {
+    Py_buffer text, out;
+    if (PyObject_GetBuffer(textObj, &text, PyBUF_SIMPLE) == -1)
+        return NULL;
+    if (PyObject_GetBuffer(outObj, &out, PyBUF_WRITABLE) == -1) {
+        PyBuffer_Release(&text);
+        return NULL;
+    }
+    PyObject *ret = NULL;
+    long long int len;
+    Py_ssize_t blocks_len = text.len - nonce_length(context);
+    if (blocks_len <= 0 || blocks_len % HASH_BLOCKSIZE != 0)
+        PyErr_Format(PyExc_ValueError, "input length must be a positive multiple of %d%s", HASH_BLOCKSIZE,
+                     nonce_length(context) ? ", after the nonce" : "");
+    else if (out.len < blocks_len)
+        PyErr_Format(PyExc_ValueError, "output buffer must hold at least %zd bytes", blocks_len);
+    else if ((len = decrypt_padded(context,
+                                   (string) { .str = text.buf, .len = text.len },
+                                   (string) { .str = out.buf, .len = out.len })) < 0)
+        PyErr_SetString(PyExc_ValueError, "invalid padding");
+    else
+        ret = PyLong_FromLongLong(len);
+    PyBuffer_Release(&text);
+    PyBuffer_Release(&out);
+    return ret;
+}
+
+
+FeistelContext *copy_context(FeistelContext *context) {
+    /* Copy a context for a stream of its own, rewound to the IV */
+    FeistelContext *copy = malloc(sizeof(FeistelContext));
+    memcpy(copy, context, sizeof(FeistelContext));
+    c_reset(copy);
+    return copy;
+}
+
+
+PyObject *set_nonce(FeistelContext *context, PyObject *nonceObj) {
+    /* Set the nonce of the message a stream is processing */
+    Py_buffer nonce;
+    if (!get_nonce(context, nonceObj, &nonce))
+        return NULL;
+    memcpy(context->nonce, nonce.buf, MIN((Py_ssize_t) NONCE_LEN, nonce.len));
+    PyBuffer_Release(&nonce);
+    Py_RETURN_NONE;
+}
+
+
+PyObject *stream_blocks(FeistelContext *context, PyObject *textObj, bool encrypt) {
+    /* Process whole blocks, continuing from the stream's chaining value.
+       A stream's context is private to it, so the GIL is released in every mode. */
+    Py_buffer text;
+    if (PyObject_GetBuffer(textObj, &text, PyBUF_SIMPLE) == -1)
+        return NULL;
+    PyObject *ret = NULL;
+    if (text.len % HASH_BLOCKSIZE != 0)
+        PyErr_Format(PyExc_ValueError, "input length must be a multiple of %d", HASH_BLOCKSIZE);
+    else if ((ret = PyBytes_FromStringAndSize(NULL, text.len)) != NULL) {
+        string in = (string) { .str = text.buf, .len = text.len },
+               out = (string) { .str = PyBytes_AS_STRING(ret), .len = text.len };
+        Py_BEGIN_ALLOW_THREADS
+        if (encrypt)
+            c_encrypt(context, in, out);
+        else
+            c_decrypt(context, in, out);
+        Py_END_ALLOW_THREADS
+    }
+    PyBuffer_Release(&text);
+    return ret;
+}
+PyObject *encrypt_blocks(FeistelContext *context, PyObject *textObj) {
+    return stream_blocks(context, textObj, true);
+}
+PyObject *decrypt_blocks(FeistelContext *context, PyObject *textObj) {
+    return stream_blocks(context, textObj, false);
+}
+
+
+PyObject *encrypt_final(FeistelContext *context, PyObject *textObj) {
+    /* Pad and encrypt the partial block that ends a stream */
+    Py_buffer text;
+    if (PyObject_GetBuffer(textObj, &text, PyBUF_SIMPLE) == -1)
+        return NULL;
+    PyObject *ret = NULL;
+    if (text.len >= HASH_BLOCKSIZE)
+        PyErr_Format(PyExc_ValueError, "input length must be less than %d", HASH_BLOCKSIZE);
+    else if ((ret = PyBytes_FromStringAndSize(NULL, HASH_BLOCKSIZE)) != NULL) {
+        UINT8 *final = (UINT8 *) PyBytes_AS_STRING(ret);
+        c_pad(text.buf, text.len, final);
+        c_encrypt_block(context, final, final);
+    }
+    PyBuffer_Release(&text);
+    return ret;
+}
+PyObject *decrypt_final(FeistelContext *context, PyObject *textObj) {
+    /* Decrypt and unpad the block that ends a stream */
+    Py_buffer text;
+    if (PyObject_GetBuffer(textObj, &text, PyBUF_SIMPLE) == -1)
+        return NULL;
+    PyObject *ret = NULL;
+    int len;
+    if (text.len != HASH_BLOCKSIZE)
+        PyErr_Format(PyExc_ValueError, "a stream must end with a whole block of %d bytes", HASH_BLOCKSIZE);
+    else if ((ret = PyBytes_FromStringAndSize(NULL, HASH_BLOCKSIZE)) != NULL) {
+        c_decrypt_block(context, text.buf, (UINT8 *) PyBytes_AS_STRING(ret));
+        if ((len = c_unpad((UINT8 *) PyBytes_AS_STRING(ret))) < 0) {
+            PyErr_SetString(PyExc_ValueError, "invalid padding");
+            Py_CLEAR(ret);
+        } else {
+            _PyBytes_Resize(&ret, len);
         }
     }
-    free_string(temp);
-    return plaintext;
-}
-char *decrypt_(char *input_ptr, char *key_ptr, char *iv_ptr, int mode) {
-    assert(0 <= mode && mode <= 4);
-    string input = (string) {
-        .len = strlen(input_ptr),
-        .str = input_ptr
-    };
-    string key = (string) {
-        .len = strlen(key_ptr),
-        .str = key_ptr
-    };
-    string iv = (string) {
-        .len = strlen(iv_ptr),
-        .str = iv_ptr
-    };
-    return c_decrypt(input, key, iv, mode).str;
+    PyBuffer_Release(&text);
+    return ret;
 }
@@ -9,6 +9,19 @@
 #ifndef FEISTEL_H
     #define FEISTEL_H
 
+    #define HASH_BLOCKSIZE 1024
+    #define HALF_BLOCKSIZE (HASH_BLOCKSIZE / 2)
+    #define FEISTEL_ROUNDS 4
+
+    /* Messages are terminated by a delimiter byte, then zero-padded to a whole block */
+    #define PAD_DELIMITER 0xFF
+    #define PAD_BYTE 0x00
+    #define padded_length(len) (((len) / HASH_BLOCKSIZE + 1) * HASH_BLOCKSIZE)
+
+    /* CTR mode messages are led by a random nonce of their own, mixed into every keystream block */
+    #define NONCE_LEN 16
+    #define nonce_length(context) ((context)->mode == CTR ? NONCE_LEN : 0)
+
     #ifndef STRUCT_STRING
         #define STRUCT_STRING
 
@@ -20,15 +33,58 @@
     #endif
 
     enum cipher_mode {
-        ECB = 0, CBC = 1, PCBC = 2, CFB = 3, OFB = 4
-    } cipher_mode;
+        ECB = 0, CBC = 1, PCBC = 2, CFB = 3, OFB = 4, CTR = 5
+    };
+
+    typedef struct {
+        /* Round function sponge, with the key already absorbed */
+        KeccakHash keyed;
+        enum cipher_mode mode;
+        /* Threads to spread CTR mode blocks over */
+        int workers;
+        /* Initial and running chaining values, and a work area for a single block */
+        UINT8 iv[HASH_BLOCKSIZE], chain[HASH_BLOCKSIZE], work[HASH_BLOCKSIZE];
+        /* Nonce of the message a stream is processing, and its running block counter, for CTR mode */
+        UINT8 nonce[NONCE_LEN];
+        unsigned long long int counter;
+    } FeistelContext;
+
+    void c_init_context(FeistelContext *, string, string, enum cipher_mode, int);
+    FeistelContext *new_context(PyObject *, PyObject *, int, int);
+    void free_context(FeistelContext *);
+
+    void c_feistel_block(const FeistelContext *, UINT8 *, bool);
+
+    void c_ctr_blocks(const FeistelContext *, const UINT8 *, const UINT8 *, UINT8 *,
+                      unsigned long long int, unsigned long long int);
+    void c_ctr(const FeistelContext *, const UINT8 *, string, string, unsigned long long int);
+
+    void c_reset(FeistelContext *);
+    void c_encrypt_block(FeistelContext *, const UINT8 *, UINT8 *);
+    void c_decrypt_block(FeistelContext *, const UINT8 *, UINT8 *);
+
+    void c_encrypt(FeistelContext *, string, string);
+    void c_decrypt(FeistelContext *, string, string);
+
+    void c_pad(const UINT8 *, unsigned int, UINT8 *);
+    int c_unpad(const UINT8 *);
 
-    typedef void (*round_func)(string sub_key, string in, string out);
+    unsigned long long int c_encrypt_padded(FeistelContext *, const UINT8 *, string, string);
+    unsigned long long int encrypt_padded(FeistelContext *, const UINT8 *, string, string);
+    bool get_nonce(const FeistelContext *, PyObject *, Py_buffer *);
+    PyObject *encrypt_bytes(FeistelContext *, PyObject *, PyObject *);
+    PyObject *encrypt_into(FeistelContext *, PyObject *, PyObject *, PyObject *);
+    long long int c_decrypt_padded(FeistelContext *, string, string);
+    long long int decrypt_padded(FeistelContext *, string, string);
+    PyObject *decrypt_bytes(FeistelContext *, PyObject *);
+    PyObject *decrypt_into(FeistelContext *, PyObject *, PyObject *);
 
-    string new_string(int len);
-    void free_string(string s);
+    FeistelContext *copy_context(FeistelContext *);
+    PyObject *set_nonce(FeistelContext *, PyObject *);
+    PyObject *stream_blocks(FeistelContext *, PyObject *, bool);
+    PyObject *encrypt_blocks(FeistelContext *, PyObject *);
+    PyObject *decrypt_blocks(FeistelContext *, PyObject *);
+    PyObject *encrypt_final(FeistelContext *, PyObject *);
+    PyObject *decrypt_final(FeistelContext *, PyObject *);
 
-    char *encrypt_(char *text, char *key, char *iv, int mode);
-    char *decrypt_(char *text, char *key, char *iv, int mode);
-    
 #endif /* end of include guard: FEISTEL_H */
@@ -5,5 +5,33 @@
     #include "../c_keccak/keccak.h"
 %}
 
-extern char *encrypt_(char *, char *, char *, int);
-extern char *decrypt_(char *, char *, char *, int);
+/* Opaque cipher context, owned by the Python proxy and freed on collection */
+%nodefaultctor FeistelContext;
+typedef struct {} FeistelContext;
+%extend FeistelContext {
+    ~FeistelContext() {
+        free_context($self);
+    }
+}
+
+%exception new_context {
+    $action
+    if (PyErr_Occurred()) SWIG_fail;
+}
+%newobject new_context;
+extern FeistelContext *new_context(PyObject *, PyObject *, int, int);
+
+%constant int NONCE_LEN = NONCE_LEN;
+
+extern PyObject *encrypt_bytes(FeistelContext *, PyObject *, PyObject *);
+extern PyObject *encrypt_into(FeistelContext *, PyObject *, PyObject *, PyObject *);
+extern PyObject *decrypt_bytes(FeistelContext *, PyObject *);
+extern PyObject *decrypt_into(FeistelContext *, PyObject *, PyObject *);
+
+%newobject copy_context;
+extern FeistelContext *copy_context(FeistelContext *);
+extern PyObject *set_nonce(FeistelContext *, PyObject *);
+extern PyObject *encrypt_blocks(FeistelContext *, PyObject *);
+extern PyObject *decrypt_blocks(FeistelContext *, PyObject *);
+extern PyObject *encrypt_final(FeistelContext *, PyObject *);
+extern PyObject *decrypt_final(FeistelContext *, PyObject *);
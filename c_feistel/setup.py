@@ -3,7 +3,9 @@
 from distutils.core import setup, Extension
 
 feistel_module = Extension('_feistel',
-                           sources=['feistel_wrap.c', 'feistel.c', '../c_keccak/keccak.c'])
+                           sources=['feistel_wrap.c', 'feistel.c', '../c_keccak/keccak.c'],
+                           extra_compile_args=['-pthread'],
+                           extra_link_args=['-pthread'])
 
 setup(name='feistel',
       version='0.1',
@@ -1,109 +1,94 @@
 #include "keccak.h"
 
 #define MIN(a, b) ((a) < (b) ? (a) : (b))
+#define MAX(a, b) ((a) > (b) ? (a) : (b))
+/* Inputs shorter than this are absorbed without dropping the GIL */
+#define GIL_MINSIZE 2048
 
 
-KeccakHash from_PyObject(PyObject *pyObject) {
-    unsigned int rate = PyLong_AsUnsignedLong(PyObject_GetAttrString(pyObject, "rate")),
-                 block_size = PyLong_AsUnsignedLong(PyObject_GetAttrString(pyObject, "block_size")),
-                 capacity = PyLong_AsUnsignedLong(PyObject_GetAttrString(pyObject, "capacity"));
-    KeccakHash ret = c_new_hash(rate, capacity);
-    ret.block_size = block_size;
-    PyObject *state = PyObject_GetAttrString(pyObject, "state"), *stateItem;
-    int stateSize = PyTuple_Size(state);
-    if (stateSize != sizeof(ret.state)) {
-        printf("Error: sequence is of invalid size (%d)\n", stateSize);
-        exit(1);
-    }
-    for (int i = 0; i < stateSize; i++) {
-        stateItem = PyTuple_GetItem(state, i);
-        if (PyLong_Check(stateItem))
-            ret.state[i] = PyLong_AsUnsignedLong(stateItem);
-        else {
-            printf("Error: sequence contains a non-int value");
-            exit(1);
-        }
-    }
-    return ret;
-}
-
-void to_PyObject(PyObject *pyObject, KeccakHash hash) {
-    PyObject_SetAttrString(pyObject, "rate", PyLong_FromUnsignedLong(hash.rate));
-    PyObject_SetAttrString(pyObject, "block_size", PyLong_FromUnsignedLong(hash.block_size));
-    PyObject_SetAttrString(pyObject, "capacity", PyLong_FromUnsignedLong(hash.capacity));
-    PyObject *stateObj = PyTuple_New(sizeof(hash.state));
-    for (unsigned int i = 0; i < sizeof(hash.state); i++) {
-        PyTuple_SetItem(stateObj, i, PyLong_FromUnsignedLong(hash.state[i]));
-    }
-    PyObject_SetAttrString(pyObject, "state", stateObj);
-}
-
-
-int LFSR86540(UINT8 *LFSR) {
-    int result = ((*LFSR) & 0x01) != 0;
-    if (((*LFSR) & 0x80) != 0)
-        /* Primitive polynomial over GF(2): x^8+x^6+x^5+x^4+1 */
-        (*LFSR) = ((*LFSR) << 1) ^ 0x71;
-    else
-        (*LFSR) <<= 1;
-    return result;
-}
+static const tKeccakLane KeccakRoundConstants[24] = {
+    0x0000000000000001ULL, 0x0000000000008082ULL, 0x800000000000808AULL,
+    0x8000000080008000ULL, 0x000000000000808BULL, 0x0000000080000001ULL,
+    0x8000000080008081ULL, 0x8000000000008009ULL, 0x000000000000008AULL,
+    0x0000000000000088ULL, 0x0000000080008009ULL, 0x000000008000000AULL,
+    0x000000008000808BULL, 0x800000000000008BULL, 0x8000000000008089ULL,
+    0x8000000000008003ULL, 0x8000000000008002ULL, 0x8000000000000080ULL,
+    0x000000000000800AULL, 0x800000008000000AULL, 0x8000000080008081ULL,
+    0x8000000000008080ULL, 0x0000000080000001ULL, 0x8000000080008008ULL
+};
 
 void permute(KeccakHash *hash) {
-    UINT8 LFSRstate = 0x01;
+    tKeccakLane *A = hash->state, B[25], C[5], D[5];
 
     for (unsigned int round = 0; round < 24; round++) {
-        {   /* theta-step */
-            tKeccakLane C[5], D;
-            /* Compute the parity of the columns */
-            for (unsigned int x = 0; x < 5; x++)
-                C[x] = readLane(hash, x, 0) ^ readLane(hash, x, 1) ^ readLane(hash, x, 2) ^ readLane(hash, x, 3) ^ readLane(hash, x, 4);
-            for (unsigned int x = 0; x < 5; x++) {
-                /* Compute the θ effect for a given column */
-                D = C[(x+4)%5] ^ ROL64(C[(x+1)%5], 1);
-                /* Add the θ effect to the whole column */
-                for (unsigned int y = 0; y < 5; y++)
-                    XORLane(hash, x, y, D);
-            }
-        }
+        /* theta-step: compute the parity of the columns, and the θ effect of each */
+        C[0] = A[0] ^ A[5] ^ A[10] ^ A[15] ^ A[20];
+        C[1] = A[1] ^ A[6] ^ A[11] ^ A[16] ^ A[21];
+        C[2] = A[2] ^ A[7] ^ A[12] ^ A[17] ^ A[22];
+        C[3] = A[3] ^ A[8] ^ A[13] ^ A[18] ^ A[23];
+        C[4] = A[4] ^ A[9] ^ A[14] ^ A[19] ^ A[24];
+        D[0] = C[4] ^ ROL64(C[1], 1);
+        D[1] = C[0] ^ ROL64(C[2], 1);
+        D[2] = C[1] ^ ROL64(C[3], 1);
+        D[3] = C[2] ^ ROL64(C[4], 1);
+        D[4] = C[3] ^ ROL64(C[0], 1);
 
-        {   /* rho-step and pi-step */
-            tKeccakLane current, temp;
-            /* Start at coordinates (1 0) */
-            unsigned int x = 1, y = 0;
-            current = readLane(hash, x, y);
-            /* Iterate over ((0 1)(2 3))^t * (1 0) for 0 ≤ t ≤ 23 */
-            for (unsigned int t = 0; t < 24; t++) {
-                /* Compute the rotation constant r = (t+1)(t+2)/2 */
-                unsigned int r = ((t + 1) * (t + 2) / 2) % 64;
-                /* Compute ((0 1)(2 3)) * (x y) */
-                unsigned int Y = (2 * x + 3 * y) % 5; x = y; y = Y;
-                /* Swap current and state(x,y), and rotate */
-                temp = readLane(hash, x, y);
-                writeLane(hash, x, y, ROL64(current, r));
-                current = temp;
-            }
-        }
+        /* rho-step and pi-step, with the θ effect added to each lane on the way through */
+        B[0] = A[0] ^ D[0];
+        B[10] = ROL64(A[1] ^ D[1], 1);
+        B[20] = ROL64(A[2] ^ D[2], 62);
+        B[5] = ROL64(A[3] ^ D[3], 28);
+        B[15] = ROL64(A[4] ^ D[4], 27);
+        B[16] = ROL64(A[5] ^ D[0], 36);
+        B[1] = ROL64(A[6] ^ D[1], 44);
+        B[11] = ROL64(A[7] ^ D[2], 6);
+        B[21] = ROL64(A[8] ^ D[3], 55);
+        B[6] = ROL64(A[9] ^ D[4], 20);
+        B[7] = ROL64(A[10] ^ D[0], 3);
+        B[17] = ROL64(A[11] ^ D[1], 10);
+        B[2] = ROL64(A[12] ^ D[2], 43);
+        B[12] = ROL64(A[13] ^ D[3], 25);
+        B[22] = ROL64(A[14] ^ D[4], 39);
+        B[23] = ROL64(A[15] ^ D[0], 41);
+        B[8] = ROL64(A[16] ^ D[1], 45);
+        B[18] = ROL64(A[17] ^ D[2], 15);
+        B[3] = ROL64(A[18] ^ D[3], 21);
+        B[13] = ROL64(A[19] ^ D[4], 8);
+        B[14] = ROL64(A[20] ^ D[0], 18);
+        B[24] = ROL64(A[21] ^ D[1], 2);
+        B[9] = ROL64(A[22] ^ D[2], 61);
+        B[19] = ROL64(A[23] ^ D[3], 56);
+        B[4] = ROL64(A[24] ^ D[4], 14);
 
-        {   /* chi-step */
-            tKeccakLane temp[5];
-            for (unsigned int y = 0; y < 5; y++) {
-                /* Take a copy of the plane */
-                for (unsigned int x = 0; x < 5; x++)
-                    temp[x] = readLane(hash, x, y);
-                /* Compute χ on the plane */
-                for (unsigned int x = 0; x < 5; x++)
-                    writeLane(hash, x, y, temp[x] ^((~temp[(x+1)%5]) & temp[(x+2)%5]));
-            }
-        }
+        /* chi-step */
+        A[0] = B[0] ^ (~B[1] & B[2]);
+        A[1] = B[1] ^ (~B[2] & B[3]);
+        A[2] = B[2] ^ (~B[3] & B[4]);
+        A[3] = B[3] ^ (~B[4] & B[0]);
+        A[4] = B[4] ^ (~B[0] & B[1]);
+        A[5] = B[5] ^ (~B[6] & B[7]);
+        A[6] = B[6] ^ (~B[7] & B[8]);
+        A[7] = B[7] ^ (~B[8] & B[9]);
+        A[8] = B[8] ^ (~B[9] & B[5]);
+        A[9] = B[9] ^ (~B[5] & B[6]);
+        A[10] = B[10] ^ (~B[11] & B[12]);
+        A[11] = B[11] ^ (~B[12] & B[13]);
+        A[12] = B[12] ^ (~B[13] & B[14]);
+        A[13] = B[13] ^ (~B[14] & B[10]);
+        A[14] = B[14] ^ (~B[10] & B[11]);
+        A[15] = B[15] ^ (~B[16] & B[17]);
+        A[16] = B[16] ^ (~B[17] & B[18]);
+        A[17] = B[17] ^ (~B[18] & B[19]);
+        A[18] = B[18] ^ (~B[19] & B[15]);
+        A[19] = B[19] ^ (~B[15] & B[16]);
+        A[20] = B[20] ^ (~B[21] & B[22]);
+        A[21] = B[21] ^ (~B[22] & B[23]);
+        A[22] = B[22] ^ (~B[23] & B[24]);
+        A[23] = B[23] ^ (~B[24] & B[20]);
+        A[24] = B[24] ^ (~B[20] & B[21]);
 
-        {   /* iota-step */
-            for (unsigned int j = 0; j < 7; j++) {
-                unsigned int bitPosition = (1<<j)-1; /* 2^j-1 */
-                if (LFSR86540(&LFSRstate))
-                    XORLane(hash, 0, 0, (tKeccakLane)1<<bitPosition);
-            }
-        }
+        /* iota-step */
+        A[0] ^= KeccakRoundConstants[round];
     }
 }
 
@@ -115,85 +100,287 @@ KeccakHash c_new_hash(unsigned int rate, unsigned int capacity) {
         .rate_bytes = rate / 8,
         .block_size = 0,
         .capacity = capacity,
-        .digest_size = capacity / 8
+        .digest_size = capacity / 16,
+        .delimiter = SHA3_DELIMITER,
+        .squeezing = false
     };
 
     return hash;
 }
-void new_hash(PyObject *hashObj, unsigned int rate, unsigned int capacity) {
-    to_PyObject(hashObj, c_new_hash(rate, capacity));
+KeccakHash *new_hash(unsigned int rate, unsigned int capacity) {
+    KeccakHash *hash = malloc(sizeof(KeccakHash));
+    *hash = c_new_hash(rate, capacity);
+    return hash;
 }
 
 
-string c_squeeze(KeccakHash hash) {
+KeccakHash c_new_xof(unsigned int rate, unsigned int capacity) {
+    KeccakHash hash = c_new_hash(rate, capacity);
+    hash.delimiter = SHAKE_DELIMITER;
+    return hash;
+}
+KeccakHash *new_xof(unsigned int rate, unsigned int capacity) {
+    KeccakHash *hash = malloc(sizeof(KeccakHash));
+    *hash = c_new_xof(rate, capacity);
+    return hash;
+}
+
+
+KeccakHash c_new_cshake(unsigned int rate, unsigned int capacity) {
+    KeccakHash hash = c_new_hash(rate, capacity);
+    hash.delimiter = CSHAKE_DELIMITER;
+    return hash;
+}
+KeccakHash *new_cshake(unsigned int rate, unsigned int capacity) {
+    KeccakHash *hash = malloc(sizeof(KeccakHash));
+    *hash = c_new_cshake(rate, capacity);
+    return hash;
+}
+
+
+KeccakHash *copy_hash(KeccakHash *hash) {
+    KeccakHash *copy = malloc(sizeof(KeccakHash));
+    memcpy(copy, hash, sizeof(KeccakHash));
+    return copy;
+}
+
+
+void free_hash(KeccakHash *hash) {
+    free(hash);
+}
+
+
+void c_extract(KeccakHash *hash, UINT8 *output, unsigned int offset, unsigned int len) {
+    /* Copy out len bytes of the state from offset, a lane at a time where possible */
+    unsigned int i = offset, end = offset + len;
+    for (; i < end && i % 8 != 0; i++)
+        *output++ = readByte(hash, i);
+    for (; i + 8 <= end; i += 8, output += 8)
+        store64(output, hash->state[i / 8]);
+    for (; i < end; i++)
+        *output++ = readByte(hash, i);
+}
+
+
+void c_finalise(KeccakHash *hash) {
     /* Do the padding and switch to the squeezing phase */
-    /* Absorb the last few bits and add the first bit of padding (which coincides with the delimiter 0x06) */
-    hash.state[hash.block_size] ^= 0x06;
+    /* Absorb the last few bits and add the first bit of padding (which coincides with the delimiter) */
+    XORByte(hash, hash->block_size, hash->delimiter);
     /* Add the second bit of padding */
-    hash.state[hash.rate_bytes-1] ^= 0x80;
+    XORByte(hash, hash->rate_bytes-1, 0x80);
     /* Switch to the squeezing phase */
-    permute(&hash);
+    permute(hash);
+    hash->block_size = 0;
+    hash->squeezing = true;
+}
+
 
-    /* Squeeze out all the output blocks */
-    unsigned int digest_size = hash.digest_size;
+void c_read_bytes(KeccakHash *hash, UINT8 *output, unsigned long long int len) {
+    /* Squeeze out len bytes, continuing from wherever the last read stopped */
+    unsigned int chunk;
+    if (!hash->squeezing)
+        c_finalise(hash);
+    while (len > 0) {
+        if (hash->block_size == hash->rate_bytes) {
+            permute(hash);
+            hash->block_size = 0;
+        }
+        chunk = MIN(len, hash->rate_bytes - hash->block_size);
+        c_extract(hash, output, hash->block_size, chunk);
+        hash->block_size += chunk;
+        output += chunk;
+        len -= chunk;
+    }
+}
+PyObject *read_bytes(KeccakHash *hash, long len) {
+    if (len < 0) {
+        PyErr_SetString(PyExc_ValueError, "length must be non-negative");
+        return NULL;
+    }
+    PyObject *ret = PyBytes_FromStringAndSize(NULL, len);
+    if (ret == NULL)
+        return NULL;
+    if (len >= GIL_MINSIZE) {
+        Py_BEGIN_ALLOW_THREADS
+        c_read_bytes(hash, (UINT8 *) PyBytes_AS_STRING(ret), len);
+        Py_END_ALLOW_THREADS
+    } else {
+        c_read_bytes(hash, (UINT8 *) PyBytes_AS_STRING(ret), len);
+    }
+    return ret;
+}
+
+
+void c_digest(KeccakHash *hash, char *output) {
+    c_read_bytes(hash, (UINT8 *) output, hash->digest_size);
+}
+
+
+string c_squeeze(KeccakHash *hash) {
     string output = (string) {
-        .str = malloc(hash.digest_size + 1), 
-        .len = hash.digest_size
+        .str = malloc(hash->digest_size + 1),
+        .len = hash->digest_size
     };
-    char *outputPtr = output.str;
-    while (digest_size > 0) {
-        hash.block_size = MIN(digest_size, hash.rate_bytes);
-        memcpy(outputPtr, hash.state, hash.block_size);
-        outputPtr += hash.block_size;
-        digest_size -= hash.block_size;
-
-        if (digest_size > 0)
-            permute(&hash);
-    }
+    c_digest(hash, output.str);
     return output;
 }
-PyObject *squeeze(PyObject *hashObject) {
-    KeccakHash hash = from_PyObject(hashObject);
-    string squeezed = c_squeeze(hash);
-    PyObject *ret = PyBytes_FromStringAndSize((char*) squeezed.str, squeezed.len);
-    to_PyObject(hashObject, hash);
-    free(squeezed.str);
-    return ret;
+PyObject *squeeze(KeccakHash *hash, long len) {
+    /* Squeeze from a stack copy so the caller's sponge is left untouched */
+    KeccakHash finalised = *hash;
+    return read_bytes(&finalised, len);
 }
 
 
-void c_absorb(KeccakHash hash, string input) {
-    /* Absorb all the input blocks */
-    while (input.len > 0) {
-        hash.block_size = MIN(input.len, hash.rate_bytes);
-        for (unsigned int i = 0; i < hash.block_size; i++)
-            hash.state[i] ^= input.str[i];
-        input.str += hash.block_size;
-        input.len -= hash.block_size;
+void c_absorb(KeccakHash *hash, string input) {
+    const UINT8 *in = (const UINT8 *) input.str;
+    unsigned int lanes = hash->rate_bytes / 8;
 
-        if (hash.block_size == hash.rate_bytes) {
-            permute(&hash);
-            hash.block_size = 0;
+    /* Top up any partially filled block byte by byte */
+    while (hash->block_size != 0 && input.len > 0) {
+        XORByte(hash, hash->block_size, *in);
+        in++; input.len--;
+        if (++hash->block_size == hash->rate_bytes) {
+            permute(hash);
+            hash->block_size = 0;
         }
     }
+
+    /* Absorb all the whole input blocks a lane at a time */
+    while (input.len >= hash->rate_bytes) {
+        for (unsigned int i = 0; i < lanes; i++)
+            hash->state[i] ^= load64(in + 8 * i);
+        for (unsigned int i = 8 * lanes; i < hash->rate_bytes; i++)
+            XORByte(hash, i, in[i]);
+        permute(hash);
+        in += hash->rate_bytes;
+        input.len -= hash->rate_bytes;
+    }
+
+    /* Start a new partial block with whatever remains */
+    for (; input.len > 0; in++, input.len--, hash->block_size++)
+        XORByte(hash, hash->block_size, *in);
 }
-void absorb(PyObject *hashObject, PyObject *bytesObj) {
+PyObject *absorb(KeccakHash *hash, PyObject *bufferObj) {
+    /* Absorb straight from the exported buffer of any bytes-like object */
+    Py_buffer view;
+    if (hash->squeezing) {
+        PyErr_SetString(PyExc_ValueError, "cannot absorb into a sponge that is already squeezing");
+        return NULL;
+    }
+    if (PyObject_GetBuffer(bufferObj, &view, PyBUF_SIMPLE) == -1)
+        return NULL;
     string input = (string) {
-        .len = PyBytes_Size(bytesObj),
+        .str = view.buf,
+        .len = view.len
     };
-    input.str = malloc(sizeof(char) * input.len);
-    memcpy(input.str, PyBytes_AsString(bytesObj), input.len);
-    KeccakHash hash = from_PyObject(hashObject);
-    c_absorb(hash, input);
-    to_PyObject(hashObject, hash);
-    free(input.str);
+    if (input.len >= GIL_MINSIZE) {
+        Py_BEGIN_ALLOW_THREADS
+        c_absorb(hash, input);
+        Py_END_ALLOW_THREADS
+    } else {
+        c_absorb(hash, input);
+    }
+    PyBuffer_Release(&view);
+    Py_RETURN_NONE;
+}
+
+
+typedef struct {
+    KeccakHash *template;
+    Py_buffer *inputs;
+    char **outputs;
+    Py_ssize_t count, start, step;
+    unsigned int length;
+} HashJob;
+
+void *c_hash_many_worker(void *arg) {
+    /* Each worker hashes every step'th message, starting from its own offset */
+    HashJob *job = (HashJob *) arg;
+    KeccakHash hash;
+    for (Py_ssize_t i = job->start; i < job->count; i += job->step) {
+        hash = *job->template;
+        c_absorb(&hash, (string) {
+            .str = job->inputs[i].buf,
+            .len = job->inputs[i].len
+        });
+        c_read_bytes(&hash, (UINT8 *) job->outputs[i], job->length);
+    }
+    return NULL;
+}
+
+void c_hash_many(KeccakHash *template, Py_buffer *inputs, char **outputs, Py_ssize_t count, unsigned int length, int workers) {
+    workers = MAX(1, MIN(workers, count));
+    pthread_t *threads = malloc(sizeof(pthread_t) * workers);
+    HashJob *jobs = malloc(sizeof(HashJob) * workers);
+    bool *started = calloc(workers, sizeof(bool));
+    for (int w = 0; w < workers; w++) {
+        jobs[w] = (HashJob) {
+            .template = template,
+            .inputs = inputs,
+            .outputs = outputs,
+            .count = count,
+            .start = w,
+            .step = workers,
+            .length = length
+        };
+    }
+    /* The calling thread takes the first share, and any share whose thread failed to start */
+    for (int w = 1; w < workers; w++)
+        started[w] = pthread_create(&threads[w], NULL, c_hash_many_worker, &jobs[w]) == 0;
+    c_hash_many_worker(&jobs[0]);
+    for (int w = 1; w < workers; w++) {
+        if (started[w])
+            pthread_join(threads[w], NULL);
+        else
+            c_hash_many_worker(&jobs[w]);
+    }
+    free(threads); free(jobs); free(started);
+}
+PyObject *hash_many(KeccakHash *template, PyObject *messages, unsigned int length, int workers) {
+    PyObject *seq = PySequence_Fast(messages, "messages must be a sequence");
+    if (seq == NULL)
+        return NULL;
+    Py_ssize_t count = PySequence_Fast_GET_SIZE(seq);
+    Py_buffer *inputs = calloc(count, sizeof(Py_buffer));
+    char **outputs = calloc(count, sizeof(char *));
+    PyObject *ret = PyList_New(count), *digest;
+
+    /* Export every buffer and allocate every digest while still holding the GIL */
+    for (Py_ssize_t i = 0; ret != NULL && i < count; i++) {
+        if (PyObject_GetBuffer(PySequence_Fast_GET_ITEM(seq, i), &inputs[i], PyBUF_SIMPLE) == -1 ||
+            (digest = PyBytes_FromStringAndSize(NULL, length)) == NULL) {
+            Py_CLEAR(ret);
+            break;
+        }
+        outputs[i] = PyBytes_AS_STRING(digest);
+        PyList_SET_ITEM(ret, i, digest);
+    }
+
+    if (ret != NULL) {
+        Py_BEGIN_ALLOW_THREADS
+        c_hash_many(template, inputs, outputs, count, length, workers);
+        Py_END_ALLOW_THREADS
+    }
+
+    for (Py_ssize_t i = 0; i < count; i++)
+        if (inputs[i].obj != NULL)
+            PyBuffer_Release(&inputs[i]);
+    free(inputs); free(outputs);
+    Py_DECREF(seq);
+    return ret;
 }
 
 
 string c_keccak(string input, int out_bytes) {
-    KeccakHash hash = c_new_hash(input.len, out_bytes);
-    c_absorb(hash, input);
-    return c_squeeze(hash);
+    /* SHAKE256, so callers may ask for any length of output */
+    KeccakHash hash = c_new_xof(1088, 512);
+    string output = (string) {
+        .str = malloc(out_bytes + 1),
+        .len = out_bytes
+    };
+    c_absorb(&hash, input);
+    c_read_bytes(&hash, (UINT8 *) output.str, output.len);
+    return output;
 }
 string c_hash(string input, int out_bytes) {
     return c_keccak(input, out_bytes);
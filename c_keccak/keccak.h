@@ -1,57 +1,60 @@
 #include <Python.h>
+#include <pthread.h>
+#include <stdbool.h>
 #include <stdlib.h>
 #include <string.h>
 
 #ifndef KECCAK_H
     #define KECCAK_H
 
-    typedef char UINT8;
+    typedef unsigned char UINT8;
     typedef unsigned long long int UINT64;
     typedef UINT64 tKeccakLane;
 
-    #define ROL64(a, offset) ((((UINT64)a) << offset) ^ (((UINT64)a) >> (64-offset)))
-    #define i(x, y) ((x)+5*(y))
+    #define ROL64(a, offset) ((((UINT64)(a)) << (offset)) ^ (((UINT64)(a)) >> (64-(offset))))
 
-    #ifndef LITTLE_ENDIAN
-        static UINT64 load64(const UINT8 *x) {
-            int i;
-            UINT64 u=0;
+    /* Lanes are held natively; bytes are addressed little-endian within each lane */
+    #define readByte(h, i)          ((UINT8) ((h)->state[(i) / 8] >> (8 * ((i) % 8))))
+    #define XORByte(h, i, byte)     ((h)->state[(i) / 8] ^= (tKeccakLane) (UINT8) (byte) << (8 * ((i) % 8)))
 
-            for (i = 7; i >= 0; --i) {
+    #if defined(__BYTE_ORDER__) && __BYTE_ORDER__ == __ORDER_LITTLE_ENDIAN__
+        static inline UINT64 load64(const UINT8 *x) {
+            UINT64 u;
+            memcpy(&u, x, sizeof(u));
+            return u;
+        }
+        static inline void store64(UINT8 *x, UINT64 u) {
+            memcpy(x, &u, sizeof(u));
+        }
+    #else
+        static inline UINT64 load64(const UINT8 *x) {
+            UINT64 u = 0;
+
+            for (int i = 7; i >= 0; --i) {
                 u <<= 8;
                 u |= x[i];
             }
             return u;
         }
-        static void store64(UINT8 *x, UINT64 u) {
-            unsigned int i;
-
-            for (i = 0; i < 8; ++i) {
+        static inline void store64(UINT8 *x, UINT64 u) {
+            for (unsigned int i = 0; i < 8; ++i) {
                 x[i] = u;
                 u >>= 8;
             }
         }
-        static void xor64(UINT8 *x, UINT64 u) {
-            unsigned int i;
-
-            for (i = 0; i < 8; ++i) {
-                x[i] ^= u;
-                u >>= 8;
-            }
-        }
-        #define readLane(h, x, y)          load64((UINT8*)h->state+sizeof(tKeccakLane)*i(x, y))
-        #define writeLane(h, x, y, lane)   store64((UINT8*)h->state+sizeof(tKeccakLane)*i(x, y), lane)
-        #define XORLane(h, x, y, lane)     xor64((UINT8*)h->state+sizeof(tKeccakLane)*i(x, y), lane)
-    #else
-        #define readLane(h, x, y)          (((tKeccakLane*)h->state)[i(x, y)])
-        #define writeLane(h, x, y, lane)   (((tKeccakLane*)h->state)[i(x, y)]) = (lane)
-        #define XORLane(h, x, y, lane)     (((tKeccakLane*)h->state)[i(x, y)]) ^= (lane)
     #endif
 
 
+    /* Domain separation suffixes, including the first bit of padding */
+    #define SHA3_DELIMITER 0x06
+    #define SHAKE_DELIMITER 0x1F
+    #define CSHAKE_DELIMITER 0x04
+
     typedef struct {
-        UINT8 state[200];
+        tKeccakLane state[25];
         unsigned int rate, rate_bytes, block_size, capacity, digest_size;
+        UINT8 delimiter;
+        bool squeezing;
     } KeccakHash;
 
     #ifndef STRUCT_STRING
@@ -64,17 +67,28 @@
     
     #endif
 
-    KeccakHash from_PyObject(PyObject *);
-    void to_PyObject(PyObject *, KeccakHash);
-
     KeccakHash c_new_hash(unsigned int, unsigned int);
-    void new_hash(PyObject *, unsigned int, unsigned int);
-
-    string c_squeeze(KeccakHash);
-    PyObject *squeeze(PyObject *);
-
-    void c_absorb(KeccakHash, string);
-    void absorb(PyObject *, PyObject *);
+    KeccakHash *new_hash(unsigned int, unsigned int);
+    KeccakHash c_new_xof(unsigned int, unsigned int);
+    KeccakHash *new_xof(unsigned int, unsigned int);
+    KeccakHash c_new_cshake(unsigned int, unsigned int);
+    KeccakHash *new_cshake(unsigned int, unsigned int);
+    KeccakHash *copy_hash(KeccakHash *);
+    void free_hash(KeccakHash *);
+
+    void c_extract(KeccakHash *, UINT8 *, unsigned int, unsigned int);
+    void c_finalise(KeccakHash *);
+    void c_read_bytes(KeccakHash *, UINT8 *, unsigned long long int);
+    PyObject *read_bytes(KeccakHash *, long);
+    void c_digest(KeccakHash *, char *);
+    string c_squeeze(KeccakHash *);
+    PyObject *squeeze(KeccakHash *, long);
+
+    void c_absorb(KeccakHash *, string);
+    PyObject *absorb(KeccakHash *, PyObject *);
+
+    void c_hash_many(KeccakHash *, Py_buffer *, char **, Py_ssize_t, unsigned int, int);
+    PyObject *hash_many(KeccakHash *, PyObject *, unsigned int, int);
 
     string c_hash(string, int);
 
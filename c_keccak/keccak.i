@@ -4,9 +4,33 @@
     #include "keccak.h"
 %}
 
-extern void new_hash(PyObject *, unsigned int, unsigned int);
+/* Native sponge state, owned by the Python proxy and freed on collection.
+   Only its parameters are visible from Python. */
+%nodefaultctor KeccakHash;
+%immutable;
+typedef struct {
+    unsigned int rate, capacity, digest_size;
+} KeccakHash;
+%mutable;
+%extend KeccakHash {
+    ~KeccakHash() {
+        free_hash($self);
+    }
+}
+
+%newobject new_hash;
+extern KeccakHash *new_hash(unsigned int, unsigned int);
+%newobject new_xof;
+extern KeccakHash *new_xof(unsigned int, unsigned int);
+%newobject new_cshake;
+extern KeccakHash *new_cshake(unsigned int, unsigned int);
+%newobject copy_hash;
+extern KeccakHash *copy_hash(KeccakHash *);
 
 %apply char {char};
-extern PyObject *squeeze(PyObject *);
+extern PyObject *squeeze(KeccakHash *, long);
+extern PyObject *read_bytes(KeccakHash *, long);
+
+extern PyObject *absorb(KeccakHash *, PyObject *);
 
-extern void absorb(PyObject *, PyObject *);
+extern PyObject *hash_many(KeccakHash *, PyObject *, unsigned int, int);
@@ -4,7 +4,8 @@ from distutils.core import setup, Extension
 
 keccak_module = Extension('_keccak',
                           sources=['keccak_wrap.c', 'keccak.c'],
-                          extra_compile_args=['-g'])
+                          extra_compile_args=['-g', '-pthread'],
+                          extra_link_args=['-pthread'])
 
 setup(name='keccak',
       version='0.1',
@@ -1,6 +1,6 @@
 #include "polynomial.h"
 
-// TODO: Implement full NTRU algorithm in C, then rename to ntruencrypt.c
+// TODO: Rename to ntruencrypt.c, now that the NTRU block operations are implemented in C
 
 
 Polynomial *new_polynomial(int len) {
@@ -19,29 +19,89 @@ void free_polynomial(Polynomial *p) {
 }
 
 
-Polynomial *from_PyTuple(PyObject *pyTuple) {
-	int tupleSize = PyTuple_Size(pyTuple);
-	Polynomial *ret = new_polynomial(tupleSize);
-	for (int i = 0; i < tupleSize; i ++) {
-	   PyObject *tupleItem = PyTuple_GetItem(pyTuple, i);
-	   if (PyLong_Check(tupleItem)) {
-	      ret->coeffs[i] = PyLong_AsLong(tupleItem);
-	   } else {
-	      printf("Error: tuple contains a non-int value\n");
-	      exit(1);
-	   }
+/* Views a buffer of native ints, such as an NTRUPolynomial, as a Polynomial without copying */
+int view_polynomial(PyObject *obj, Py_buffer *view, Polynomial *p, int flags) {
+	if (PyObject_GetBuffer(obj, view, flags | PyBUF_FORMAT) < 0) {
+		return -1;
 	}
-	return ret;
+	if (view->itemsize != sizeof(int) || strcmp(view->format, "i") != 0) {
+		PyErr_SetString(PyExc_TypeError, "polynomial coefficients must be a buffer of native ints");
+		PyBuffer_Release(view);
+		return -1;
+	}
+	*p = (Polynomial) {
+		.len = view->len / sizeof(int),
+		.coeffs = view->buf
+	};
+	return 0;
 }
 
 
-PyObject *to_PyTuple(Polynomial *poly) {
-	PyObject *ret = PyTuple_New(poly->len);
-	for (int i = 0; i < poly->len; i ++) {
-		PyTuple_SetItem(ret, i, PyLong_FromLong(poly->coeffs[i]));
+/* Views a writable output buffer, which must match the length of the input */
+int view_output(PyObject *obj, Py_buffer *view, Polynomial *o, int len) {
+	if (view_polynomial(obj, view, o, PyBUF_WRITABLE) < 0) {
+		return -1;
 	}
-	free_polynomial(poly);
-	return ret;
+	if (o->len != len) {
+		PyErr_Format(PyExc_ValueError, "output has %d coefficients, expected %d", o->len, len);
+		PyBuffer_Release(view);
+		return -1;
+	}
+	return 0;
+}
+
+
+/* Applies p (op) x -> o, where o may be p itself */
+PyObject *apply_scalar(void (*op)(Polynomial, int, Polynomial *), PyObject *P, int x, PyObject *O) {
+	Py_buffer pv, ov;
+	Polynomial p, o;
+	if (view_polynomial(P, &pv, &p, PyBUF_SIMPLE) < 0) {
+		return NULL;
+	}
+	if (view_output(O, &ov, &o, p.len) < 0) {
+		PyBuffer_Release(&pv);
+		return NULL;
+	}
+	op(p, x, &o);
+	PyBuffer_Release(&pv); PyBuffer_Release(&ov);
+	Py_INCREF(O);
+	return O;
+}
+
+
+/* Applies p (op) q -> o. Products write o before reading all of p and q,
+ * so when o is one of the operands they are computed in a temporary first */
+PyObject *apply_binary(void (*op)(Polynomial, Polynomial, Polynomial *), PyObject *P, PyObject *Q, PyObject *O,
+                       int same_len, int in_place) {
+	Py_buffer pv, qv, ov;
+	Polynomial p, q, o;
+	if (view_polynomial(P, &pv, &p, PyBUF_SIMPLE) < 0) {
+		return NULL;
+	}
+	if (view_polynomial(Q, &qv, &q, PyBUF_SIMPLE) < 0) {
+		PyBuffer_Release(&pv);
+		return NULL;
+	}
+	if (same_len && q.len != p.len) {
+		PyErr_Format(PyExc_ValueError, "operands have %d and %d coefficients", p.len, q.len);
+		PyBuffer_Release(&pv); PyBuffer_Release(&qv);
+		return NULL;
+	}
+	if (view_output(O, &ov, &o, p.len) < 0) {
+		PyBuffer_Release(&pv); PyBuffer_Release(&qv);
+		return NULL;
+	}
+	if (!in_place && (o.coeffs == p.coeffs || o.coeffs == q.coeffs)) {
+		Polynomial *t = new_polynomial(o.len);
+		op(p, q, t);
+		memcpy(o.coeffs, t->coeffs, o.len * sizeof(int));
+		free_polynomial(t);
+	} else {
+		op(p, q, &o);
+	}
+	PyBuffer_Release(&pv); PyBuffer_Release(&qv); PyBuffer_Release(&ov);
+	Py_INCREF(O);
+	return O;
 }
 
 
@@ -69,20 +129,16 @@ void c_rshift(Polynomial p, int n, Polynomial *o) {
 	reverse(o->coeffs, 0, n - 1);
 	reverse(o->coeffs, n, o->len - 1);
 }
-PyObject *rshift(PyObject *P, int n) {
-	Polynomial *p = from_PyTuple(P);
-	c_rshift(*p, n, p);
-	return to_PyTuple(p);
+PyObject *rshift(PyObject *P, int n, PyObject *O) {
+	return apply_scalar(c_rshift, P, n, O);
 }
 
 
 void c_lshift(Polynomial p, int n, Polynomial *o) {
 	c_rshift(p, mod(-n, p.len), o);
 }
-PyObject *lshift(PyObject *P, int n) {
-	Polynomial *p = from_PyTuple(P);
-	c_lshift(*p, n, p);
-	return to_PyTuple(p);
+PyObject *lshift(PyObject *P, int n, PyObject *O) {
+	return apply_scalar(c_lshift, P, n, O);
 }
 
 
@@ -97,7 +153,14 @@ int c_degree(Polynomial p) {
 	}
 }
 int degree(PyObject *P) {
-	return c_degree(*from_PyTuple(P));
+	Py_buffer pv;
+	Polynomial p;
+	if (view_polynomial(P, &pv, &p, PyBUF_SIMPLE) < 0) {
+		return -1;
+	}
+	int d = c_degree(p);
+	PyBuffer_Release(&pv);
+	return d;
 }
 
 
@@ -106,10 +169,8 @@ void c_centerlift(Polynomial p, int n, Polynomial *o) {
 		o->coeffs[i] = p.coeffs[i] > (float)(n / 2.) ? p.coeffs[i] - n : p.coeffs[i];
 	}
 }
-PyObject *centerlift(PyObject *P, int n) {
-	Polynomial *p = from_PyTuple(P);
-	c_centerlift(*p, n, p);
-	return to_PyTuple(p);
+PyObject *centerlift(PyObject *P, int n, PyObject *O) {
+	return apply_scalar(c_centerlift, P, n, O);
 }
 
 
@@ -119,10 +180,8 @@ void c_s_add(Polynomial p, int x, Polynomial *o) {
 	}
 	o->coeffs[0] += x;
 }
-PyObject *s_add(PyObject *P, int x) {
-	Polynomial *p = from_PyTuple(P);
-	c_s_add(*p, x, p);
-	return to_PyTuple(p);
+PyObject *s_add(PyObject *P, int x, PyObject *O) {
+	return apply_scalar(c_s_add, P, x, O);
 }
 
 
@@ -131,10 +190,8 @@ void c_s_mul(Polynomial p, int x, Polynomial *o) {
 		o->coeffs[i] = p.coeffs[i] * x;
 	}
 }
-PyObject *s_mul(PyObject *P, int x) {
-	Polynomial *p = from_PyTuple(P);
-	c_s_mul(*p, x, p);
-	return to_PyTuple(p);
+PyObject *s_mul(PyObject *P, int x, PyObject *O) {
+	return apply_scalar(c_s_mul, P, x, O);
 }
 
 
@@ -143,10 +200,23 @@ void c_s_mod(Polynomial p, int x, Polynomial *o) {
 		o->coeffs[i] = mod(p.coeffs[i], x);
 	}
 }
-PyObject *s_mod(PyObject *P, int x) {
-	Polynomial *p = from_PyTuple(P);
-	c_s_mod(*p, x, p);
-	return to_PyTuple(p);
+PyObject *s_mod(PyObject *P, int x, PyObject *O) {
+	return apply_scalar(c_s_mod, P, x, O);
+}
+
+
+/* Exact division, for coefficients known to be multiples of x; others are truncated */
+void c_s_div(Polynomial p, int x, Polynomial *o) {
+	for (int i = 0; i < p.len; i ++) {
+		o->coeffs[i] = p.coeffs[i] / x;
+	}
+}
+PyObject *s_div(PyObject *P, int x, PyObject *O) {
+	if (x == 0) {
+		PyErr_SetString(PyExc_ZeroDivisionError, "polynomial division by zero");
+		return NULL;
+	}
+	return apply_scalar(c_s_div, P, x, O);
 }
 
 
@@ -155,13 +225,8 @@ void c_v_add(Polynomial p, Polynomial q, Polynomial *o) {
 		o->coeffs[i] = p.coeffs[i] + q.coeffs[i];
 	}
 }
-PyObject *v_add(PyObject *P, PyObject *Q) {
-	Polynomial *p = from_PyTuple(P),
-	           *q = from_PyTuple(Q),
-			   *r = new_polynomial(p->len);
-	c_v_add(*p, *q, r);
-	free_polynomial(p); free_polynomial(q);
-	return to_PyTuple(r);
+PyObject *v_add(PyObject *P, PyObject *Q, PyObject *O) {
+	return apply_binary(c_v_add, P, Q, O, true, true);
 }
 
 
@@ -170,17 +235,12 @@ void c_v_sub(Polynomial p, Polynomial q, Polynomial *o) {
 		o->coeffs[i] = p.coeffs[i] - q.coeffs[i];
 	}
 }
-PyObject *v_sub(PyObject *P, PyObject *Q) {
-	Polynomial *p = from_PyTuple(P),
-	           *q = from_PyTuple(Q),
-			   *r = new_polynomial(p->len);
-	c_v_sub(*p, *q, r);
-	free_polynomial(p); free_polynomial(q);
-	return to_PyTuple(r);
+PyObject *v_sub(PyObject *P, PyObject *Q, PyObject *O) {
+	return apply_binary(c_v_sub, P, Q, O, true, true);
 }
 
 
-void c_v_mul(Polynomial p, Polynomial q, Polynomial *o) {
+void c_schoolbook_mul(Polynomial p, Polynomial q, Polynomial *o) {
 	memset(o->coeffs, 0, o->len * sizeof(int));
 	for (int i = 0; i < p.len; i ++) {
 		for (int j = 0; j < q.len; j ++) {
@@ -188,13 +248,144 @@ void c_v_mul(Polynomial p, Polynomial q, Polynomial *o) {
 		}
 	}
 }
-PyObject *v_mul(PyObject *P, PyObject *Q) {
-	Polynomial *p = from_PyTuple(P),
-	           *q = from_PyTuple(Q),
-			   *r = new_polynomial(p->len);
-	c_v_mul(*p, *q, r);
-	free_polynomial(p); free_polynomial(q);
-	return to_PyTuple(r);
+PyObject *schoolbook_mul(PyObject *P, PyObject *Q, PyObject *O) {
+	return apply_binary(c_schoolbook_mul, P, Q, O, false, false);
+}
+
+
+/* Collects the nonzero terms of p, giving up once there are more than limit of them */
+int c_sparse_terms(Polynomial p, int *index, int *value, int limit) {
+	int weight = 0;
+	for (int i = 0; i < p.len; i ++) {
+		if (p.coeffs[i] != 0) {
+			if (weight == limit) {
+				return -1;
+			}
+			index[weight] = i;
+			value[weight ++] = p.coeffs[i];
+		}
+	}
+	return weight;
+}
+
+
+/* Cyclic product of a dense polynomial with a sparse one given as index/value lists,
+ * costing O(weight * N) rather than O(N^2) */
+void c_sparse_mul(Polynomial q, const int *index, const int *value, int weight, Polynomial *o) {
+	int N = q.len;
+	memset(o->coeffs, 0, o->len * sizeof(int));
+	for (int t = 0; t < weight; t ++) {
+		int k = index[t], v = value[t];
+		int *lo = o->coeffs + k, *hi = o->coeffs + k - N;
+		if (v == 1) {
+			for (int j = 0; j < N - k; j ++) lo[j] += q.coeffs[j];
+			for (int j = N - k; j < N; j ++) hi[j] += q.coeffs[j];
+		} else if (v == -1) {
+			for (int j = 0; j < N - k; j ++) lo[j] -= q.coeffs[j];
+			for (int j = N - k; j < N; j ++) hi[j] -= q.coeffs[j];
+		} else {
+			for (int j = 0; j < N - k; j ++) lo[j] += v * q.coeffs[j];
+			for (int j = N - k; j < N; j ++) hi[j] += v * q.coeffs[j];
+		}
+	}
+}
+void c_sparse_dense_mul(Polynomial p, Polynomial q, Polynomial *o) {
+	int *index = malloc(p.len * sizeof(int)),
+	    *value = malloc(p.len * sizeof(int));
+	c_sparse_mul(q, index, value, c_sparse_terms(p, index, value, p.len), o);
+	free(index); free(value);
+}
+PyObject *sparse_mul(PyObject *P, PyObject *Q, PyObject *O) {
+	return apply_binary(c_sparse_dense_mul, P, Q, O, true, false);
+}
+
+
+/* Linear (acyclic) product of two length-n coefficient arrays into out[0 .. 2n-2].
+ * Splits each side into halves of h and l = n - h coefficients, recursing into three products
+ * rather than four. scratch must hold at least 4n + 4 * log2(n) coefficients. */
+void c_karatsuba(const long long *a, const long long *b, int n, long long *out, long long *scratch) {
+	if (n <= KARATSUBA_CUTOFF) {
+		memset(out, 0, (2 * n - 1) * sizeof(long long));
+		for (int i = 0; i < n; i ++) {
+			for (int j = 0; j < n; j ++) {
+				out[i+j] += a[i] * b[j];
+			}
+		}
+		return;
+	}
+	int h = (n + 1) / 2, l = n - h;
+	long long *sa = scratch, *sb = sa + h, *mid = sb + h;
+
+	c_karatsuba(a, b, h, out, scratch);
+	out[2 * h - 1] = 0;
+	c_karatsuba(a + h, b + h, l, out + 2 * h, scratch);
+
+	for (int i = 0; i < h; i ++) {
+		sa[i] = a[i] + (i < l ? a[h+i] : 0);
+		sb[i] = b[i] + (i < l ? b[h+i] : 0);
+	}
+	c_karatsuba(sa, sb, h, mid, mid + 2 * h - 1);
+	for (int i = 0; i < 2 * h - 1; i ++) {
+		mid[i] -= out[i];
+	}
+	for (int i = 0; i < 2 * l - 1; i ++) {
+		mid[i] -= out[2*h + i];
+	}
+	for (int i = 0; i < 2 * h - 1; i ++) {
+		out[h+i] += mid[i];
+	}
+}
+
+
+/* Cyclic product of two dense, equal length polynomials by Karatsuba, folding modulo X^N - 1,
+ * and reducing modulo m unless it is 0. Intermediates are 64-bit, so N * m^2 must fit a long long */
+void c_karatsuba_mul_mod(Polynomial p, Polynomial q, int m, Polynomial *o) {
+	int N = p.len;
+	if (N <= 0) {
+		return;
+	}
+	long long *a = malloc((8 * N + 64) * sizeof(long long)),
+	          *b = a + N, *out = b + N, *scratch = out + 2 * N;
+	for (int i = 0; i < N; i ++) {
+		a[i] = p.coeffs[i];
+		b[i] = q.coeffs[i];
+	}
+	c_karatsuba(a, b, N, out, scratch);
+	for (int i = 0; i < N; i ++) {
+		long long x = out[i] + (i + N < 2 * N - 1 ? out[i+N] : 0);
+		o->coeffs[i] = (int) (m ? mod(x, m) : x);
+	}
+	free(a);
+}
+void c_karatsuba_mul(Polynomial p, Polynomial q, Polynomial *o) {
+	c_karatsuba_mul_mod(p, q, 0, o);
+}
+PyObject *karatsuba_mul(PyObject *P, PyObject *Q, PyObject *O) {
+	return apply_binary(c_karatsuba_mul, P, Q, O, true, false);
+}
+
+
+/* Multiplies in Z[X]/(X^N - 1), choosing an index-list product when either side is sparse,
+ * as the NTRU blinding and key polynomials are, and Karatsuba otherwise */
+void c_v_mul(Polynomial p, Polynomial q, Polynomial *o) {
+	int N = p.len;
+	if (q.len != N || N == 0) {
+		c_schoolbook_mul(p, q, o);
+		return;
+	}
+	int limit = N / SPARSE_RATIO, weight;
+	int *index = malloc(2 * (limit + 1) * sizeof(int)), *value = index + limit + 1;
+	if ((weight = c_sparse_terms(p, index, value, limit)) >= 0) {
+		c_sparse_mul(q, index, value, weight, o);
+	} else if ((weight = c_sparse_terms(q, index, value, limit)) >= 0) {
+		c_sparse_mul(p, index, value, weight, o);
+	} else {
+		c_karatsuba_mul(p, q, o);
+	}
+	free(index);
+}
+PyObject *v_mul(PyObject *P, PyObject *Q, PyObject *O) {
+	return apply_binary(c_v_mul, P, Q, O, false, false);
 }
 
 
@@ -214,13 +405,12 @@ int inv(int a, int p) {
 
 
 int is_zero(Polynomial F) {
-	if (F.len > 0) {
-		F.len --;
-		F.coeffs += sizeof(int);
-		return (F.coeffs[-1] == 0) && is_zero(F);
-	} else {
-		return true;
+	for (int i = 0; i < F.len; i ++) {
+		if (F.coeffs[i] != 0) {
+			return false;
+		}
 	}
+	return true;
 }
 
 
@@ -231,7 +421,214 @@ void swap(Polynomial *a, Polynomial *b) {
 }
 
 
+/* Inverts p into o, returning o, or None if p is not invertible */
+PyObject *apply_inverse(void (*op)(Polynomial, int, Polynomial *), PyObject *P, int n, PyObject *O) {
+	Py_buffer pv, ov;
+	Polynomial p, o, *t = NULL;
+	if (view_polynomial(P, &pv, &p, PyBUF_SIMPLE) < 0) {
+		return NULL;
+	}
+	if (view_output(O, &ov, &o, p.len) < 0) {
+		PyBuffer_Release(&pv);
+		return NULL;
+	}
+	if (o.coeffs == p.coeffs) {
+		t = new_polynomial(p.len);
+		memcpy(t->coeffs, p.coeffs, p.len * sizeof(int));
+		p = *t;
+	}
+	Py_BEGIN_ALLOW_THREADS
+	op(p, n, &o);
+	Py_END_ALLOW_THREADS
+	int invertible = !is_zero(o);
+	if (t) free_polynomial(t);
+	PyBuffer_Release(&pv); PyBuffer_Release(&ov);
+	if (invertible) {
+		Py_INCREF(O);
+		return O;
+	} else {
+		Py_INCREF(Py_None);
+		return Py_None;
+	}
+}
+
+
+/* Bitsliced arithmetic over Z/2 and Z/3, 64 coefficients to a word */
+PackedPolynomial *new_packed(int words) {
+	PackedPolynomial *x = malloc(sizeof(PackedPolynomial));
+	*x = (PackedPolynomial) {
+		.words = words,
+		.degree = -1,
+		.pos = calloc(2 * words, sizeof(unsigned long long int))
+	};
+	x->neg = x->pos + words;
+	return x;
+}
+
+
+void free_packed(PackedPolynomial *x) {
+	free(x->pos);
+	free(x);
+}
+
+
+int packed_get(const PackedPolynomial *x, int i) {
+	unsigned long long int bit = 1ULL << (i % 64);
+	return (x->pos[i / 64] & bit) ? 1 : (x->neg[i / 64] & bit) ? -1 : 0;
+}
+
+
+void packed_set(PackedPolynomial *x, int i, int v) {
+	unsigned long long int bit = 1ULL << (i % 64);
+	x->pos[i / 64] &= ~bit; x->neg[i / 64] &= ~bit;
+	if (v == 1) x->pos[i / 64] |= bit;
+	if (v == -1) x->neg[i / 64] |= bit;
+}
+
+
+/* The highest nonzero coefficient at or below from, or -1 for the zero polynomial */
+int packed_degree(const PackedPolynomial *x, int from) {
+	for (int w = from / 64; w >= 0; w --) {
+		unsigned long long int bits = x->pos[w] | x->neg[w];
+		if (w == from / 64 && from % 64 != 63) {
+			bits &= (2ULL << (from % 64)) - 1;
+		}
+		if (bits) {
+			return w * 64 + 63 - __builtin_clzll(bits);
+		}
+	}
+	return -1;
+}
+
+
+/* The number of zero coefficients below the lowest nonzero one */
+int packed_valuation(const PackedPolynomial *x) {
+	for (int w = 0; w < x->words; w ++) {
+		unsigned long long int bits = x->pos[w] | x->neg[w];
+		if (bits) {
+			return w * 64 + __builtin_ctzll(bits);
+		}
+	}
+	return -1;
+}
+
+
+/* Divides (up = false) or multiplies (up = true) a single plane by X^n */
+void plane_shift(unsigned long long int *x, int words, int n, bool up) {
+	int ws = n / 64, bs = n % 64;
+	if (up) {
+		for (int w = words - 1; w >= 0; w --) {
+			unsigned long long int hi = w - ws >= 0 ? x[w - ws] : 0,
+			                       lo = w - ws - 1 >= 0 ? x[w - ws - 1] : 0;
+			x[w] = bs ? (hi << bs) | (lo >> (64 - bs)) : hi;
+		}
+	} else {
+		for (int w = 0; w < words; w ++) {
+			unsigned long long int lo = w + ws < words ? x[w + ws] : 0,
+			                       hi = w + ws + 1 < words ? x[w + ws + 1] : 0;
+			x[w] = bs ? (lo >> bs) | (hi << (64 - bs)) : lo;
+		}
+	}
+}
+
+
+void packed_shift(PackedPolynomial *x, int n, bool up) {
+	plane_shift(x->pos, x->words, n, up);
+	plane_shift(x->neg, x->words, n, up);
+}
+
+
+/* x += y, or x -= y, over the first words of each, modulo p in {2, 3} */
+void packed_add(PackedPolynomial *x, const PackedPolynomial *y, bool subtract, int p, int words) {
+	const unsigned long long int *yp = subtract ? y->neg : y->pos,
+	                             *ym = subtract ? y->pos : y->neg;
+	if (p == 2) {
+		for (int w = 0; w < words; w ++) {
+			x->pos[w] ^= y->pos[w];
+		}
+		return;
+	}
+	for (int w = 0; w < words; w ++) {
+		unsigned long long int xp = x->pos[w], xm = x->neg[w],
+		                       xz = ~(xp | xm), yz = ~(yp[w] | ym[w]);
+		x->pos[w] = (xz & yp[w]) | (xp & yz) | (xm & ym[w]);
+		x->neg[w] = (xz & ym[w]) | (xm & yz) | (xp & yp[w]);
+	}
+}
+
+
+void swap_packed(PackedPolynomial **a, PackedPolynomial **b) {
+	PackedPolynomial *temp = *a;
+	*a = *b;
+	*b = temp;
+}
+
+
+/* Almost-inverse algorithm (Silverman, NTRU Tech Report #14) over bitsliced Z/2 or Z/3.
+ * Maintains a.b = X^k f and a.c = X^k g modulo X^N - 1, with g = X^N - 1 to start,
+ * so the inverse is X^-k b / f once f is reduced to a constant.
+ * k stays below 2N, so b and c are held unreduced in 2N + 2 coefficients and folded at the end.
+ * Returns false, leaving o zero, if F is not invertible */
+int c_inverse_packed(Polynomial F, int p, Polynomial *o) {
+	int N = F.len, k = 0, words = (2 * N + 2) / 64 + 2, invertible = false;
+	PackedPolynomial *b = new_packed(words), *c = new_packed(words),
+	                 *f = new_packed(words), *g = new_packed(words);
+	memset(o->coeffs, 0, o->len * sizeof(int));
+
+	packed_set(b, 0, 1);
+	for (int i = 0; i < N; i ++) {
+		int v = mod(F.coeffs[i], p);
+		packed_set(f, i, v == 2 ? -1 : v);
+	}
+	packed_set(g, 0, p == 2 ? 1 : -1);
+	packed_set(g, N, 1);
+	f->degree = packed_degree(f, N - 1);
+	g->degree = N;
+
+	while (f->degree >= 0) {
+		int n = packed_valuation(f);
+		if (n) {
+			packed_shift(f, n, false);
+			packed_shift(c, n, true);
+			f->degree -= n;
+			k += n;
+		}
+		if (f->degree == 0) {
+			invertible = true;
+			break;
+		}
+		if (f->degree < g->degree) {
+			swap_packed(&f, &g);
+			swap_packed(&b, &c);
+		}
+		/* Cancel the constant term, so the next pass divides out at least one X */
+		bool subtract = packed_get(f, 0) == packed_get(g, 0);
+		packed_add(f, g, subtract, p, f->degree / 64 + 1);
+		packed_add(b, c, subtract, p, words);
+		f->degree = packed_degree(f, f->degree);
+	}
+
+	if (invertible) {
+		/* f0 is +-1, its own inverse */
+		int f0 = packed_get(f, 0);
+		for (int i = 0; i < words * 64; i ++) {
+			int v = packed_get(b, i);
+			if (v) {
+				int j = mod(i - k, N);
+				o->coeffs[j] = mod(o->coeffs[j] + f0 * v, p);
+			}
+		}
+	}
+	free_packed(b); free_packed(c); free_packed(f); free_packed(g);
+	return invertible;
+}
+
+
 void c_inverse_modp(Polynomial F, int p, Polynomial *o) {
+	if (p == 2 || p == 3) {
+		c_inverse_packed(F, p, o);
+		return;
+	}
 	int N = F.len, k = N, u;
 	Polynomial *b = new_polynomial(N + 1),
 	           *c = new_polynomial(N + 1),
@@ -243,9 +640,10 @@ void c_inverse_modp(Polynomial F, int p, Polynomial *o) {
 	memcpy(f->coeffs, F.coeffs, N * sizeof(int));
 	g->coeffs[0] = -1; g->coeffs[g->len - 1] = 1;
 	
-	// FIXME: c_inverse_modp infinite loop in mod 2
-	// Loops when f = (1 0 ... 0 1) mod 2 (= 0 in Z2[X^N - 1])
-	while (true) {
+	/* Every pass after the first divides at least one X out of f, and deg f + deg g starts below 2N,
+	 * so if f is not reduced to a constant within 2N passes then F is not invertible */
+	bool invertible = false;
+	for (int pass = 0; pass < 2 * N; pass ++) {
 		while (c_degree(*f) != 0 && f->coeffs[0] == 0) {
 			c_lshift(*f, 1, f);
 			c_rshift(*c, 1, c);
@@ -253,6 +651,7 @@ void c_inverse_modp(Polynomial F, int p, Polynomial *o) {
 		}
 
 		if (c_degree(*f) == 0) {
+			invertible = mod(f->coeffs[0], p) != 0;
 			break;
 		}
 
@@ -266,7 +665,7 @@ void c_inverse_modp(Polynomial F, int p, Polynomial *o) {
 		c_s_mod(*g, p, g);  c_s_mod(*c, p, c);
 	}
 
-	if (f->coeffs[0] != 0) {
+	if (invertible) {
 		b->len --;
 		c_s_mul(*b, inv(f->coeffs[0], p), o);
 		c_lshift(*o, k % N, o);
@@ -278,18 +677,13 @@ void c_inverse_modp(Polynomial F, int p, Polynomial *o) {
 	free_polynomial(t1); free_polynomial(t2);
 	return;
 }
-PyObject *inverse_modp(PyObject *P, int n) {
-	Polynomial *p = from_PyTuple(P);
-	c_inverse_modp(*p, n, p);
-	if (is_zero(*p)) {
-		Py_INCREF(Py_None);
-		return Py_None;
-	} else {
-		return to_PyTuple(p);
-	}
+PyObject *inverse_modp(PyObject *P, int n, PyObject *O) {
+	return apply_inverse(c_inverse_modp, P, n, O);
 }
 
 
+/* Inverts modulo p, then Newton lifts b <- b(2 - Fb), doubling the power of p inverted modulo each pass.
+ * Works modulo pn throughout, so N * pn^2 must fit a long long */
 void c_inverse_modpn(Polynomial F, int pn, Polynomial *o) {
 	int *factorise_pn(int pn, int *ret) {
 		ret[0] = 2; ret[1] = 0;
@@ -303,44 +697,675 @@ void c_inverse_modpn(Polynomial F, int pn, Polynomial *o) {
 		return ret;
 	}
 
-	int pow(int x, int n) {
-		return n > 1 ? x * pow(x, n - 1) : x;
-	}
-	
 	int ret[2];
 	int *pr = factorise_pn(pn, ret);
 	int p = pr[0], r = pr[1];
 	c_inverse_modp(F, p, o);
 	if (!is_zero(*o)) {
-		Polynomial *t1 = new_polynomial(F.len),
-				   *t2 = new_polynomial(F.len),
-				   *t3 = new_polynomial(F.len);
-		int n = 2;
-		do {
-			c_v_mul(F, *o, t1);
-			c_s_add(*t1, -2, t2);
-			c_s_mul(*t2, -1, t2);
-			c_v_mul(*t2, *o, t3);
-			c_s_mod(*t3, pow(p, n), o);
-			r /= 2;
-			n *= 2;
-		} while (r > 1);
-		c_s_mod(*o, pn, o);
-		free_polynomial(t1); free_polynomial(t2); free_polynomial(t3);
-	}
-}
-PyObject *inverse_modpn(PyObject *P, int n) {
-	Polynomial *p = from_PyTuple(P);
-	c_inverse_modpn(*p, n, p);
-	if (is_zero(*p)) {
-		Py_INCREF(Py_None);
-		return Py_None;
+		Polynomial *f = new_polynomial(F.len),
+		           *t = new_polynomial(F.len);
+		long long norm = 0;
+		for (int i = 0; i < F.len; i ++) {
+			f->coeffs[i] = lift(mod(F.coeffs[i], pn), pn);
+			norm += abs(f->coeffs[i]);
+		}
+		for (int e = 1; e < r; e *= 2) {
+			/* Small, sparse keys such as 1 + pF multiply exactly in ints */
+			if (norm * pn < INT_MAX) {
+				c_v_mul(*f, *o, t);
+				c_s_mod(*t, pn, t);
+			} else {
+				c_karatsuba_mul_mod(*f, *o, pn, t);
+			}
+			c_s_mul(*t, -1, t);
+			c_s_add(*t, 2, t);
+			c_s_mod(*t, pn, t);
+			c_karatsuba_mul_mod(*o, *t, pn, o);
+		}
+		free_polynomial(f); free_polynomial(t);
+	}
+}
+PyObject *inverse_modpn(PyObject *P, int n, PyObject *O) {
+	return apply_inverse(c_inverse_modpn, P, n, O);
+}
+
+
+/* Messages are packed at a fixed width: each byte as a run of digits when base < 256,
+ * or each digit as a run of little-endian bytes otherwise */
+int c_digits_per_byte(int base) {
+	int k = 1;
+	for (long v = base; v < 256; v *= base) {
+		k ++;
+	}
+	return k;
+}
+
+
+int c_bytes_per_digit(int base) {
+	int w = 1;
+	for (long long int v = 256; v < base; v *= 256) {
+		w ++;
+	}
+	return w;
+}
+
+
+long encoded_length(long len, int base) {
+	if (base < 256) {
+		return len * c_digits_per_byte(base);
 	} else {
-		return to_PyTuple(p);
+		int w = c_bytes_per_digit(base);
+		return (len + w - 1) / w;
+	}
+}
+
+
+/* Fills o with digits [start, start + o.len) of the encoding of data,
+ * followed by a terminating 1 and then zero padding */
+void c_encode_block(const unsigned char *data, long len, int base, long start, Polynomial *o) {
+	long digits = encoded_length(len, base);
+	int k = c_digits_per_byte(base), w = c_bytes_per_digit(base);
+	int power[8] = {1};
+	for (int i = 1; i < k && i < 8; i ++) {
+		power[i] = power[i-1] * base;
+	}
+	for (int i = 0; i < o->len; i ++) {
+		long j = start + i;
+		if (j >= digits) {
+			o->coeffs[i] = j == digits;
+		} else if (base < 256) {
+			o->coeffs[i] = (data[j / k] / power[j % k]) % base;
+		} else {
+			int digit = 0;
+			for (int b = w - 1; b >= 0; b --) {
+				digit = digit * 256 + (j * w + b < len ? data[j * w + b] : 0);
+			}
+			o->coeffs[i] = digit;
+		}
+	}
+}
+PyObject *encode_block(PyObject *data, int base, long start, PyObject *O) {
+	Py_buffer dv, ov;
+	Polynomial o;
+	if (base < 2) {
+		PyErr_Format(PyExc_ValueError, "invalid base %d", base);
+		return NULL;
+	}
+	if (PyObject_GetBuffer(data, &dv, PyBUF_SIMPLE) < 0) {
+		return NULL;
+	}
+	if (view_polynomial(O, &ov, &o, PyBUF_WRITABLE) < 0) {
+		PyBuffer_Release(&dv);
+		return NULL;
+	}
+	c_encode_block(dv.buf, dv.len, base, start, &o);
+	PyBuffer_Release(&dv); PyBuffer_Release(&ov);
+	Py_INCREF(O);
+	return O;
+}
+
+
+/* Packs the first count digits of d back into bytes, treating any missing digits
+ * of a final partial group as zero. Returns false if a digit is out of range */
+int c_decode_digits(Polynomial d, long count, int base, unsigned char *out) {
+	int k = c_digits_per_byte(base), w = c_bytes_per_digit(base);
+	if (base < 256) {
+		for (long i = 0; i < count; i += k) {
+			int byte = 0;
+			for (int j = k - 1; j >= 0; j --) {
+				byte = byte * base + (i + j < count ? d.coeffs[i + j] : 0);
+			}
+			if (byte < 0 || byte > 255) {
+				return false;
+			}
+			out[i / k] = byte;
+		}
+	} else {
+		for (long i = 0; i < count; i ++) {
+			unsigned long long int digit = d.coeffs[i];
+			if (d.coeffs[i] < 0 || d.coeffs[i] >= base) {
+				return false;
+			}
+			for (int b = 0; b < w; b ++, digit >>= 8) {
+				out[i * w + b] = digit & 0xFF;
+			}
+		}
+	}
+	return true;
+}
+PyObject *decode_digits(PyObject *D, long count, int base) {
+	Py_buffer dv;
+	Polynomial d;
+	if (base < 2) {
+		PyErr_Format(PyExc_ValueError, "invalid base %d", base);
+		return NULL;
+	}
+	if (view_polynomial(D, &dv, &d, PyBUF_SIMPLE) < 0) {
+		return NULL;
+	}
+	if (count < 0 || count > d.len) {
+		PyErr_Format(PyExc_ValueError, "cannot decode %ld of %d digits", count, d.len);
+		PyBuffer_Release(&dv);
+		return NULL;
+	}
+	int k = c_digits_per_byte(base), w = c_bytes_per_digit(base);
+	long len = base < 256 ? (count + k - 1) / k : count * w;
+	PyObject *ret = PyBytes_FromStringAndSize(NULL, len);
+	if (ret != NULL && !c_decode_digits(d, count, base, (unsigned char *) PyBytes_AS_STRING(ret))) {
+		PyErr_Format(PyExc_ValueError, "digits out of range for base %d", base);
+		Py_CLEAR(ret);
+	}
+	PyBuffer_Release(&dv);
+	return ret;
+}
+
+
+/* Keys are packed at a fixed width: public key coefficients modulo q as little-endian runs of bits,
+ * and ternary private key coefficients five trits to a byte, as 3^5 = 243 fits */
+long packed_length(int len, int bits) {
+	return bits ? ((long) len * bits + 7) / 8 : (len + TRITS_PER_BYTE - 1) / TRITS_PER_BYTE;
+}
+
+
+void c_pack_bits(Polynomial p, int bits, unsigned char *out) {
+	unsigned long long int acc = 0;
+	int held = 0;
+	long n = 0;
+	for (int i = 0; i < p.len; i ++) {
+		acc |= (unsigned long long int) p.coeffs[i] << held;
+		for (held += bits; held >= 8; held -= 8, acc >>= 8) {
+			out[n ++] = acc & 0xFF;
+		}
+	}
+	if (held) {
+		out[n] = acc & 0xFF;
+	}
+}
+
+
+void c_unpack_bits(const unsigned char *data, int bits, Polynomial *o) {
+	unsigned long long int acc = 0, mask = (1ULL << bits) - 1;
+	int held = 0;
+	long n = 0;
+	for (int i = 0; i < o->len; i ++) {
+		for (; held < bits; held += 8) {
+			acc |= (unsigned long long int) data[n ++] << held;
+		}
+		o->coeffs[i] = acc & mask;
+		acc >>= bits;
+		held -= bits;
+	}
+}
+
+
+void c_pack_trits(Polynomial p, unsigned char *out) {
+	for (int i = 0; i < p.len; i += TRITS_PER_BYTE) {
+		int byte = 0;
+		for (int j = MIN(p.len - i, TRITS_PER_BYTE) - 1; j >= 0; j --) {
+			byte = byte * 3 + mod(p.coeffs[i + j], 3);
+		}
+		out[i / TRITS_PER_BYTE] = byte;
 	}
 }
 
 
+/* Unpacks trits as -1, 0 and 1. Returns false for a byte that is not five trits */
+int c_unpack_trits(const unsigned char *data, Polynomial *o) {
+	for (int i = 0; i < o->len; i += TRITS_PER_BYTE) {
+		int byte = data[i / TRITS_PER_BYTE];
+		if (byte >= 243) {
+			return false;
+		}
+		for (int j = 0; j < TRITS_PER_BYTE && i + j < o->len; j ++, byte /= 3) {
+			o->coeffs[i + j] = lift(byte % 3, 3);
+		}
+	}
+	return true;
+}
+
+
+/* Packs p with bits per coefficient, or as trits if bits is 0 */
+PyObject *pack_key(PyObject *P, int bits) {
+	Py_buffer pv;
+	Polynomial p;
+	if (bits < 0 || bits > 31) {
+		PyErr_Format(PyExc_ValueError, "cannot pack %d bit coefficients", bits);
+		return NULL;
+	}
+	if (view_polynomial(P, &pv, &p, PyBUF_SIMPLE) < 0) {
+		return NULL;
+	}
+	for (int i = 0; bits && i < p.len; i ++) {
+		if (p.coeffs[i] < 0 || p.coeffs[i] >= 1 << bits) {
+			PyErr_Format(PyExc_ValueError, "coefficient %d does not fit %d bits", p.coeffs[i], bits);
+			PyBuffer_Release(&pv);
+			return NULL;
+		}
+	}
+	PyObject *ret = PyBytes_FromStringAndSize(NULL, packed_length(p.len, bits));
+	if (ret != NULL) {
+		unsigned char *out = (unsigned char *) PyBytes_AS_STRING(ret);
+		if (bits) {
+			c_pack_bits(p, bits, out);
+		} else {
+			c_pack_trits(p, out);
+		}
+	}
+	PyBuffer_Release(&pv);
+	return ret;
+}
+
+
+/* Unpacks a key packed by pack_key into o, which sets the number of coefficients */
+PyObject *unpack_key(PyObject *data, int bits, PyObject *O) {
+	Py_buffer dv, ov;
+	Polynomial o;
+	if (bits < 0 || bits > 31) {
+		PyErr_Format(PyExc_ValueError, "cannot unpack %d bit coefficients", bits);
+		return NULL;
+	}
+	if (PyObject_GetBuffer(data, &dv, PyBUF_SIMPLE) < 0) {
+		return NULL;
+	}
+	if (view_polynomial(O, &ov, &o, PyBUF_WRITABLE) < 0) {
+		PyBuffer_Release(&dv);
+		return NULL;
+	}
+	int valid = dv.len == packed_length(o.len, bits);
+	if (!valid) {
+		PyErr_Format(PyExc_ValueError, "packed key is %ld bytes, expected %ld",
+		             (long) dv.len, packed_length(o.len, bits));
+	} else if (bits) {
+		c_unpack_bits(dv.buf, bits, &o);
+	} else if (!(valid = c_unpack_trits(dv.buf, &o))) {
+		PyErr_SetString(PyExc_ValueError, "packed key holds an invalid trit");
+	}
+	PyBuffer_Release(&dv); PyBuffer_Release(&ov);
+	if (!valid) {
+		return NULL;
+	}
+	Py_INCREF(O);
+	return O;
+}
+
+
+static inline unsigned int c_load32(const UINT8 *x) {
+	return (unsigned int) x[0] | (unsigned int) x[1] << 8 | (unsigned int) x[2] << 16 | (unsigned int) x[3] << 24;
+}
+
+
+/* The SHAKE256 stream for the counter'th polynomial drawn under seed */
+KeccakHash c_sample_stream(const UINT8 *seed, unsigned long long int counter) {
+	UINT8 input[SEED_BYTES + 8];
+	memcpy(input, seed, SEED_BYTES);
+	store64(input + SEED_BYTES, counter);
+	KeccakHash stream = c_new_xof(SAMPLE_RATE, SAMPLE_CAPACITY);
+	c_absorb(&stream, (string) {.str = (char *) input, .len = sizeof(input)});
+	return stream;
+}
+
+
+/* Picks d1 distinct positions for 1s and d2 for -1s, as index/value lists, by a partial Fisher-Yates
+ * shuffle of the N positions. The d1 + d2 random words are squeezed from the stream in a single read,
+ * each mapped below its bound by Lemire's multiply-and-shift, with any rejected word redrawn from
+ * further along the stream. perm is N ints, and words 4 * (d1 + d2) bytes, of scratch */
+void c_sample_ternary(int N, int d1, int d2, const UINT8 *seed, unsigned long long int counter,
+                      int *perm, UINT8 *words, int *index, int *value) {
+	KeccakHash stream = c_sample_stream(seed, counter);
+	c_read_bytes(&stream, words, 4 * (d1 + d2));
+	for (int i = 0; i < N; i ++) {
+		perm[i] = i;
+	}
+	for (int t = 0; t < d1 + d2; t ++) {
+		unsigned int bound = N - t;
+		UINT64 m = (UINT64) c_load32(words + 4 * t) * bound;
+		if ((unsigned int) m < bound) {
+			unsigned int threshold = -bound % bound;
+			while ((unsigned int) m < threshold) {
+				UINT8 redraw[4];
+				c_read_bytes(&stream, redraw, 4);
+				m = (UINT64) c_load32(redraw) * bound;
+			}
+		}
+		int j = t + (int) (m >> 32), swap = perm[t];
+		perm[t] = perm[j];
+		perm[j] = swap;
+		index[t] = perm[t];
+		value[t] = t < d1 ? 1 : -1;
+	}
+}
+
+
+/* Views a seed buffer, which must be exactly SEED_BYTES long */
+int view_seed(PyObject *seed, Py_buffer *view) {
+	if (PyObject_GetBuffer(seed, view, PyBUF_SIMPLE) < 0) {
+		return -1;
+	}
+	if (view->len != SEED_BYTES) {
+		PyErr_Format(PyExc_ValueError, "seed is %ld bytes, expected %d", (long) view->len, SEED_BYTES);
+		PyBuffer_Release(view);
+		return -1;
+	}
+	return 0;
+}
+
+
+/* Fills each of count polynomials with d1 1s and d2 -1s, the i'th from counter i */
+void c_sample_many(int d1, int d2, const UINT8 *seed, Polynomial *polys, Py_ssize_t count) {
+	int N = count ? polys[0].len : 0;
+	int *perm = malloc((N + 1) * sizeof(int)),
+	    *index = malloc((d1 + d2 + 1) * sizeof(int)),
+	    *value = malloc((d1 + d2 + 1) * sizeof(int));
+	UINT8 *words = malloc(4 * (d1 + d2) + 1);
+	for (Py_ssize_t i = 0; i < count; i ++) {
+		c_sample_ternary(N, d1, d2, seed, i, perm, words, index, value);
+		memset(polys[i].coeffs, 0, N * sizeof(int));
+		for (int t = 0; t < d1 + d2; t ++) {
+			polys[i].coeffs[index[t]] = value[t];
+		}
+	}
+	free(perm); free(index); free(value); free(words);
+}
+/* Samples into every polynomial of a sequence, which must all be the same length */
+PyObject *sample_many(int d1, int d2, PyObject *seed, PyObject *polys) {
+	Py_buffer sv;
+	if (view_seed(seed, &sv) < 0) {
+		return NULL;
+	}
+	PyObject *seq = PySequence_Fast(polys, "polynomials must be a sequence");
+	if (seq == NULL) {
+		PyBuffer_Release(&sv);
+		return NULL;
+	}
+	Py_ssize_t count = PySequence_Fast_GET_SIZE(seq), exported = 0;
+	Py_buffer *views = calloc(count + 1, sizeof(Py_buffer));
+	Polynomial *o = calloc(count + 1, sizeof(Polynomial));
+	for (; exported < count; exported ++) {
+		PyObject *item = PySequence_Fast_GET_ITEM(seq, exported);
+		if (exported == 0 ? view_polynomial(item, &views[0], &o[0], PyBUF_WRITABLE) < 0
+		                  : view_output(item, &views[exported], &o[exported], o[0].len) < 0)
+			break;
+	}
+	if (exported == count && (d1 < 0 || d2 < 0 || (count && d1 + d2 > o[0].len))) {
+		PyErr_Format(PyExc_ValueError, "cannot place %d nonzero terms in %d coefficients", d1 + d2, o[0].len);
+	} else if (exported == count) {
+		Py_BEGIN_ALLOW_THREADS
+		c_sample_many(d1, d2, sv.buf, o, count);
+		Py_END_ALLOW_THREADS
+	}
+
+	for (Py_ssize_t i = 0; i < exported; i ++)
+		PyBuffer_Release(&views[i]);
+	free(views); free(o);
+	Py_DECREF(seq);
+	PyBuffer_Release(&sv);
+	if (PyErr_Occurred())
+		return NULL;
+	Py_INCREF(polys);
+	return polys;
+}
+PyObject *sample_ternary(int d1, int d2, PyObject *seed, PyObject *O) {
+	PyObject *polys = PyTuple_Pack(1, O);
+	if (polys == NULL) {
+		return NULL;
+	}
+	PyObject *ret = sample_many(d1, d2, seed, polys);
+	Py_DECREF(polys);
+	if (ret == NULL) {
+		return NULL;
+	}
+	Py_DECREF(ret);
+	Py_INCREF(O);
+	return O;
+}
+
+
+/* Copies a polynomial buffer into a new, owned Polynomial */
+Polynomial *copy_polynomial(PyObject *P) {
+	Py_buffer pv;
+	Polynomial p;
+	if (view_polynomial(P, &pv, &p, PyBUF_SIMPLE) < 0) {
+		return NULL;
+	}
+	Polynomial *copy = new_polynomial(p.len);
+	memcpy(copy->coeffs, p.coeffs, p.len * sizeof(int));
+	PyBuffer_Release(&pv);
+	return copy;
+}
+
+
+NTRUContext *new_context(PyObject *pub, PyObject *priv, int d, int p, int q) {
+	NTRUContext *ctx = calloc(1, sizeof(NTRUContext));
+	*ctx = (NTRUContext) {
+		.d = d, .p = p, .q = q,
+		.priv_weight = -1
+	};
+	if ((ctx->pub = copy_polynomial(pub)) == NULL) {
+		free_context(ctx);
+		return NULL;
+	}
+	int N = ctx->N = ctx->pub->len;
+	if (d < 1 || 2 * d - 1 > N) {
+		PyErr_Format(PyExc_ValueError, "cannot place %d nonzero terms in %d coefficients", 2 * d - 1, N);
+		free_context(ctx);
+		return NULL;
+	}
+	if (priv != Py_None) {
+		if ((ctx->priv = copy_polynomial(priv)) == NULL) {
+			free_context(ctx);
+			return NULL;
+		}
+		if (ctx->priv->len != N) {
+			PyErr_Format(PyExc_ValueError, "keys have %d and %d coefficients", N, ctx->priv->len);
+			free_context(ctx);
+			return NULL;
+		}
+		ctx->priv_index = malloc((N / SPARSE_RATIO + 1) * sizeof(int));
+		ctx->priv_value = malloc((N / SPARSE_RATIO + 1) * sizeof(int));
+		ctx->priv_weight = c_sparse_terms(*ctx->priv, ctx->priv_index, ctx->priv_value, N / SPARSE_RATIO);
+	}
+	ctx->scratch = new_scratch(ctx);
+	return ctx;
+}
+
+
+void free_context(NTRUContext *ctx) {
+	if (ctx->pub) free_polynomial(ctx->pub);
+	if (ctx->priv) free_polynomial(ctx->priv);
+	if (ctx->scratch) free_scratch(ctx->scratch);
+	free(ctx->priv_index); free(ctx->priv_value);
+	free(ctx);
+}
+
+
+NTRUScratch *new_scratch(const NTRUContext *ctx) {
+	NTRUScratch *scratch = malloc(sizeof(NTRUScratch));
+	*scratch = (NTRUScratch) {
+		.index = malloc(2 * ctx->d * sizeof(int)),
+		.value = malloc(2 * ctx->d * sizeof(int)),
+		.perm = malloc(ctx->N * sizeof(int)),
+		.words = malloc(4 * 2 * ctx->d),
+		.product = new_polynomial(ctx->N)
+	};
+	return scratch;
+}
+
+
+void free_scratch(NTRUScratch *scratch) {
+	free(scratch->index); free(scratch->value); free(scratch->perm); free(scratch->words);
+	free_polynomial(scratch->product);
+	free(scratch);
+}
+
+
+/* e = r * h + lift(m, p) mod q, for a fresh blinding polynomial r drawn from the seed's counter'th stream.
+ * o may be m itself, as the product is formed in scratch */
+void c_encrypt_block(const NTRUContext *ctx, NTRUScratch *scratch, Polynomial m,
+                     const UINT8 *seed, unsigned long long int counter, Polynomial *o) {
+	int p = ctx->p, q = ctx->q;
+	c_sample_ternary(ctx->N, ctx->d, ctx->d - 1, seed, counter,
+	                 scratch->perm, scratch->words, scratch->index, scratch->value);
+	c_sparse_mul(*ctx->pub, scratch->index, scratch->value, 2 * ctx->d - 1, scratch->product);
+	for (int i = 0; i < ctx->N; i ++) {
+		int e = scratch->product->coeffs[i] + lift(m.coeffs[i], p);
+		o->coeffs[i] = mod(e, q);
+	}
+}
+PyObject *encrypt_block(NTRUContext *ctx, PyObject *M, PyObject *seed, PyObject *O) {
+	Py_buffer mv, ov, sv;
+	Polynomial m, o;
+	if (view_seed(seed, &sv) < 0) {
+		return NULL;
+	}
+	if (view_polynomial(M, &mv, &m, PyBUF_SIMPLE) < 0) {
+		PyBuffer_Release(&sv);
+		return NULL;
+	}
+	if (m.len != ctx->N || view_output(O, &ov, &o, ctx->N) < 0) {
+		if (!PyErr_Occurred()) {
+			PyErr_Format(PyExc_ValueError, "block has %d coefficients, expected %d", m.len, ctx->N);
+		}
+		PyBuffer_Release(&mv); PyBuffer_Release(&sv);
+		return NULL;
+	}
+	c_encrypt_block(ctx, ctx->scratch, m, sv.buf, 0, &o);
+	PyBuffer_Release(&mv); PyBuffer_Release(&ov); PyBuffer_Release(&sv);
+	Py_INCREF(O);
+	return O;
+}
+
+
+/* m = lift(f * e mod q, q) mod p. o may be e itself */
+void c_decrypt_block(const NTRUContext *ctx, NTRUScratch *scratch, Polynomial e, Polynomial *o) {
+	int p = ctx->p, q = ctx->q;
+	if (ctx->priv_weight >= 0) {
+		c_sparse_mul(e, ctx->priv_index, ctx->priv_value, ctx->priv_weight, scratch->product);
+	} else {
+		c_karatsuba_mul_mod(*ctx->priv, e, q, scratch->product);
+	}
+	for (int i = 0; i < ctx->N; i ++) {
+		int a = mod(scratch->product->coeffs[i], q);
+		a = lift(a, q);
+		o->coeffs[i] = mod(a, p);
+	}
+}
+PyObject *decrypt_block(NTRUContext *ctx, PyObject *E, PyObject *O) {
+	Py_buffer ev, ov;
+	Polynomial e, o;
+	if (ctx->priv == NULL) {
+		PyErr_SetString(PyExc_ValueError, "decryption needs a private key");
+		return NULL;
+	}
+	if (view_polynomial(E, &ev, &e, PyBUF_SIMPLE) < 0) {
+		return NULL;
+	}
+	if (e.len != ctx->N || view_output(O, &ov, &o, ctx->N) < 0) {
+		if (!PyErr_Occurred()) {
+			PyErr_Format(PyExc_ValueError, "block has %d coefficients, expected %d", e.len, ctx->N);
+		}
+		PyBuffer_Release(&ev);
+		return NULL;
+	}
+	c_decrypt_block(ctx, ctx->scratch, e, &o);
+	PyBuffer_Release(&ev); PyBuffer_Release(&ov);
+	Py_INCREF(O);
+	return O;
+}
+
+
+void *c_crypt_many_worker(void *arg) {
+	/* Each worker takes every step'th block, starting from its own offset, with its own scratch */
+	NTRUJob *job = (NTRUJob *) arg;
+	NTRUScratch *scratch = new_scratch(job->ctx);
+	for (Py_ssize_t i = job->start; i < job->count; i += job->step) {
+		if (job->seed) {
+			c_encrypt_block(job->ctx, scratch, job->blocks[i], job->seed, i, &job->blocks[i]);
+		} else {
+			c_decrypt_block(job->ctx, scratch, job->blocks[i], &job->blocks[i]);
+		}
+	}
+	free_scratch(scratch);
+	return NULL;
+}
+
+void c_crypt_many(const NTRUContext *ctx, Polynomial *blocks, const UINT8 *seed, Py_ssize_t count, int workers) {
+	workers = MAX(1, MIN(workers, count));
+	pthread_t *threads = malloc(sizeof(pthread_t) * workers);
+	NTRUJob *jobs = malloc(sizeof(NTRUJob) * workers);
+	bool *started = calloc(workers, sizeof(bool));
+	for (int w = 0; w < workers; w++) {
+		jobs[w] = (NTRUJob) {
+			.ctx = ctx,
+			.blocks = blocks,
+			.seed = seed,
+			.count = count,
+			.start = w,
+			.step = workers
+		};
+	}
+	/* The calling thread takes the first share, and any share whose thread failed to start */
+	for (int w = 1; w < workers; w++)
+		started[w] = pthread_create(&threads[w], NULL, c_crypt_many_worker, &jobs[w]) == 0;
+	c_crypt_many_worker(&jobs[0]);
+	for (int w = 1; w < workers; w++) {
+		if (started[w])
+			pthread_join(threads[w], NULL);
+		else
+			c_crypt_many_worker(&jobs[w]);
+	}
+	free(threads); free(jobs); free(started);
+}
+
+/* Encrypts, given seed, or decrypts a sequence of blocks in place on a native thread pool.
+ * The i'th block is blinded from the seed's i'th stream, so the output does not depend on the workers.
+ * Every buffer is exported before the GIL is released */
+PyObject *crypt_many(NTRUContext *ctx, PyObject *blocks, PyObject *seed, int workers) {
+	Py_buffer sv = {0};
+	if (seed == NULL && ctx->priv == NULL) {
+		PyErr_SetString(PyExc_ValueError, "decryption needs a private key");
+		return NULL;
+	}
+	if (seed != NULL && view_seed(seed, &sv) < 0)
+		return NULL;
+	PyObject *seq = PySequence_Fast(blocks, "blocks must be a sequence");
+	if (seq == NULL) {
+		if (seed != NULL)
+			PyBuffer_Release(&sv);
+		return NULL;
+	}
+	Py_ssize_t count = PySequence_Fast_GET_SIZE(seq), exported = 0;
+	Py_buffer *views = calloc(count + 1, sizeof(Py_buffer));
+	Polynomial *polys = calloc(count + 1, sizeof(Polynomial));
+
+	for (; exported < count; exported++) {
+		if (view_output(PySequence_Fast_GET_ITEM(seq, exported), &views[exported], &polys[exported], ctx->N) < 0)
+			break;
+	}
+	if (exported == count) {
+		Py_BEGIN_ALLOW_THREADS
+		c_crypt_many(ctx, polys, seed != NULL ? sv.buf : NULL, count, workers);
+		Py_END_ALLOW_THREADS
+	}
+
+	for (Py_ssize_t i = 0; i < exported; i++)
+		PyBuffer_Release(&views[i]);
+	free(views); free(polys);
+	Py_DECREF(seq);
+	if (seed != NULL)
+		PyBuffer_Release(&sv);
+	if (exported < count)
+		return NULL;
+	Py_INCREF(blocks);
+	return blocks;
+}
+PyObject *encrypt_many(NTRUContext *ctx, PyObject *blocks, PyObject *seed, int workers) {
+	return crypt_many(ctx, blocks, seed, workers);
+}
+PyObject *decrypt_many(NTRUContext *ctx, PyObject *blocks, int workers) {
+	return crypt_many(ctx, blocks, NULL, workers);
+}
+
+
 int main(void) {
 	Polynomial *f = new_polynomial(11),
 	           *g = new_polynomial(11),
@@ -1,32 +1,107 @@
+#include "../c_keccak/keccak.h"
+
 #include <Python.h>
+#include <limits.h>
+#include <pthread.h>
+#include <stdbool.h>
 
 #ifndef POLYNOMIAL_H
     #define POLYNOMIAL_H
     
     #define order(p) (p.len - 1)
     #define mod(a, b) ((b + (a % b)) % b)
-    #define true 1
+    #define TRITS_PER_BYTE 5
+    #define MIN(a, b) ((a) < (b) ? (a) : (b))
+    #define MAX(a, b) ((a) > (b) ? (a) : (b))
+    #define lift(a, n) ((a) > (n) / 2. ? (a) - (n) : (a))
+
+    /* Products of at most this many coefficients are done by schoolbook, not Karatsuba */
+    #define KARATSUBA_CUTOFF 32
+    /* A side with at most N / SPARSE_RATIO nonzero terms is multiplied as an index list */
+    #define SPARSE_RATIO 8
+
+    /* Blinding polynomials are read from a SHAKE256 stream keyed by a seed from the OS and a counter */
+    #define SEED_BYTES 32
+    #define SAMPLE_RATE 1088
+    #define SAMPLE_CAPACITY 512
     
     typedef struct {
         int len;
         int  *coeffs;
     } Polynomial;
 
-    PyObject *rshift(PyObject*, int);
-    PyObject *lshift(PyObject*, int);
+    /* A polynomial over Z/2 or Z/3, as bitmasks of the coefficients equal to 1 and to -1 */
+    typedef struct {
+        int words, degree;
+        unsigned long long int *pos, *neg;
+    } PackedPolynomial;
+
+    typedef struct {
+        int N, d, p, q;
+        /* Owned copies of the public key and, if held, the private key */
+        Polynomial *pub, *priv;
+        /* The private key's nonzero terms, or a weight of -1 if it is too dense for an index list */
+        int *priv_index, *priv_value, priv_weight;
+        /* Scratch for single block calls */
+        struct NTRUScratch *scratch;
+    } NTRUContext;
+
+    /* Per-thread scratch for the blinding polynomial's terms, the shuffled positions
+     * and the random words drawn for them, and for a product */
+    typedef struct NTRUScratch {
+        int *index, *value, *perm;
+        UINT8 *words;
+        Polynomial *product;
+    } NTRUScratch;
+
+    /* A worker's share of a batch: every step'th block from start, encrypted if given a seed */
+    typedef struct {
+        const NTRUContext *ctx;
+        Polynomial *blocks;
+        const UINT8 *seed;
+        Py_ssize_t count, start, step;
+    } NTRUJob;
+
+    /* Python-facing operations read polynomials from, and write them into, buffers of native ints */
+    PyObject *rshift(PyObject*, int, PyObject*);
+    PyObject *lshift(PyObject*, int, PyObject*);
 
     int degree(PyObject*);
-    PyObject *centerlift(PyObject*, int);
+    PyObject *centerlift(PyObject*, int, PyObject*);
+
+    PyObject *s_mul(PyObject*, int, PyObject*);
+    PyObject *s_add(PyObject*, int, PyObject*);
+    PyObject *s_mod(PyObject*, int, PyObject*);
+    PyObject *s_div(PyObject*, int, PyObject*);
+
+    PyObject *v_add(PyObject*, PyObject*, PyObject*);
+    PyObject *v_sub(PyObject*, PyObject*, PyObject*);
+    PyObject *v_mul(PyObject*, PyObject*, PyObject*);
+    PyObject *schoolbook_mul(PyObject*, PyObject*, PyObject*);
+    PyObject *sparse_mul(PyObject*, PyObject*, PyObject*);
+    PyObject *karatsuba_mul(PyObject*, PyObject*, PyObject*);
+
+    PyObject *inverse_modp(PyObject*, int, PyObject*);
+    PyObject *inverse_modpn(PyObject*, int, PyObject*);
+    long encoded_length(long, int);
+    PyObject *encode_block(PyObject*, int, long, PyObject*);
+    PyObject *decode_digits(PyObject*, long, int);
+
+    long packed_length(int, int);
+    PyObject *pack_key(PyObject*, int);
+    PyObject *unpack_key(PyObject*, int, PyObject*);
 
-    PyObject *s_mul(PyObject*, int);
-    PyObject *s_add(PyObject*, int);
-    PyObject *s_mod(PyObject*, int);
+    PyObject *sample_ternary(int, int, PyObject*, PyObject*);
+    PyObject *sample_many(int, int, PyObject*, PyObject*);
 
-    PyObject *v_add(PyObject*, PyObject*);
-    PyObject *v_sub(PyObject*, PyObject*);
-    PyObject *v_mul(PyObject*, PyObject*);
+    NTRUContext *new_context(PyObject*, PyObject*, int, int, int);
+    void free_context(NTRUContext*);
+    PyObject *encrypt_block(NTRUContext*, PyObject*, PyObject*, PyObject*);
+    PyObject *decrypt_block(NTRUContext*, PyObject*, PyObject*);
 
-    PyObject *inverse_modp(PyObject*, int);
-    PyObject *inverse_modpn(PyObject*, int);
+    NTRUScratch *new_scratch(const NTRUContext*);
+    void free_scratch(NTRUScratch*);
+    PyObject *encrypt_many(NTRUContext*, PyObject*, PyObject*, int);
+    PyObject *decrypt_many(NTRUContext*, PyObject*, int);
 
 #endif /* end of include guard: POLYNOMIAL_H */
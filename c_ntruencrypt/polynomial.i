@@ -4,19 +4,59 @@
     #include "polynomial.h"
 %}
 
-extern PyObject *rshift(PyObject*, int);
-extern PyObject *lshift(PyObject*, int);
+extern PyObject *rshift(PyObject*, int, PyObject*);
+extern PyObject *lshift(PyObject*, int, PyObject*);
 
+%exception degree {
+    $action
+    if (PyErr_Occurred()) SWIG_fail;
+}
 extern int degree(PyObject*);
-extern PyObject *centerlift(PyObject*, int);
+extern PyObject *centerlift(PyObject*, int, PyObject*);
 
-extern PyObject *s_mul(PyObject*, int);
-extern PyObject *s_add(PyObject*, int);
-extern PyObject *s_mod(PyObject*, int);
+extern PyObject *s_mul(PyObject*, int, PyObject*);
+extern PyObject *s_add(PyObject*, int, PyObject*);
+extern PyObject *s_mod(PyObject*, int, PyObject*);
+extern PyObject *s_div(PyObject*, int, PyObject*);
 
-extern PyObject *v_add(PyObject*, PyObject*);
-extern PyObject *v_sub(PyObject*, PyObject*);
-extern PyObject *v_mul(PyObject*, PyObject*);
+extern PyObject *v_add(PyObject*, PyObject*, PyObject*);
+extern PyObject *v_sub(PyObject*, PyObject*, PyObject*);
+extern PyObject *v_mul(PyObject*, PyObject*, PyObject*);
+extern PyObject *schoolbook_mul(PyObject*, PyObject*, PyObject*);
+extern PyObject *sparse_mul(PyObject*, PyObject*, PyObject*);
+extern PyObject *karatsuba_mul(PyObject*, PyObject*, PyObject*);
 
-extern PyObject *inverse_modp(PyObject*, int);
-extern PyObject *inverse_modpn(PyObject*, int);
+extern PyObject *inverse_modp(PyObject*, int, PyObject*);
+extern PyObject *inverse_modpn(PyObject*, int, PyObject*);
+
+extern long encoded_length(long, int);
+extern PyObject *encode_block(PyObject*, int, long, PyObject*);
+extern PyObject *decode_digits(PyObject*, long, int);
+
+extern long packed_length(int, int);
+extern PyObject *pack_key(PyObject*, int);
+extern PyObject *unpack_key(PyObject*, int, PyObject*);
+
+%constant int SEED_BYTES = SEED_BYTES;
+extern PyObject *sample_ternary(int, int, PyObject*, PyObject*);
+extern PyObject *sample_many(int, int, PyObject*, PyObject*);
+
+/* Opaque cipher context, owned by the Python proxy and freed on collection */
+%nodefaultctor NTRUContext;
+typedef struct {} NTRUContext;
+%extend NTRUContext {
+    ~NTRUContext() {
+        free_context($self);
+    }
+}
+
+%exception new_context {
+    $action
+    if (PyErr_Occurred()) SWIG_fail;
+}
+%newobject new_context;
+extern NTRUContext *new_context(PyObject*, PyObject*, int, int, int);
+extern PyObject *encrypt_block(NTRUContext*, PyObject*, PyObject*, PyObject*);
+extern PyObject *decrypt_block(NTRUContext*, PyObject*, PyObject*);
+extern PyObject *encrypt_many(NTRUContext*, PyObject*, PyObject*, int);
+extern PyObject *decrypt_many(NTRUContext*, PyObject*, int);
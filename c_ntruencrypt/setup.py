@@ -3,7 +3,9 @@
 from distutils.core import setup, Extension
 
 polynomial_module = Extension('_polynomial',
-                              sources=['polynomial_wrap.c', 'polynomial.c'])
+                              sources=['polynomial_wrap.c', 'polynomial.c', '../c_keccak/keccak.c'],
+                              extra_compile_args=['-pthread'],
+                              extra_link_args=['-pthread'])
 
 setup(name='polynomial',
       version='0.1',
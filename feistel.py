@@ -2,6 +2,7 @@
 
 from __future__ import annotations
 from base64 import b64encode as encode, b64decode as decode
+from os import cpu_count, urandom
 from random import randint
 
 from abcs import SymmetricCipher
@@ -15,19 +16,21 @@ class FeistelCipher(SymmetricCipher):
     MODE_PCBC = 2
     MODE_CFB = 3
     MODE_OFB = 4
-    __modes = [MODE_ECB, MODE_CBC, MODE_PCBC, MODE_CFB, MODE_OFB]
+    MODE_CTR = 5
+    __modes = [MODE_ECB, MODE_CBC, MODE_PCBC, MODE_CFB, MODE_OFB, MODE_CTR]
 
-    __pad_delimiter = 0xFF
-    __pad_byte = 0x00
     KEY_LEN = 16
     IV_LEN = 16
+    BLOCK_LEN = 1024
+    NONCE_LEN = cLib.NONCE_LEN
 
-    def __init__(self, key: str = None, iv: str = None, mode: int = MODE_CBC) -> None:
-        self.key = key if key else self.keygen()
-        self.iv = iv if iv else ''.join([chr(randint(0, 255)) for _ in range(self.IV_LEN)])
+    def __init__(self, key: str = None, iv: str = None, mode: int = MODE_CBC, workers: int = None) -> None:
         if mode not in self.__modes:
             raise Exception("Error: mode %s not found" % mode)
         self.mode = mode
+        self.workers = workers or cpu_count() or 1
+        self.iv = iv if iv else ''.join([chr(randint(0, 255)) for _ in range(self.IV_LEN)])
+        self.key = key if key else self.keygen()
 
     @property
     def key(self) -> str:
@@ -35,24 +38,184 @@ class FeistelCipher(SymmetricCipher):
     @key.setter
     def key(self, value: str) -> None:
         self._key = value
+        self._context = None
+
+    @property
+    def iv(self) -> str:
+        return self._iv
+    @iv.setter
+    def iv(self, value: str) -> None:
+        self._iv = value
+        self._context = None
+
+    @property
+    def mode(self) -> int:
+        return self._mode
+    @mode.setter
+    def mode(self, value: int) -> None:
+        self._mode = value
+        self._context = None
+
+    @property
+    def workers(self) -> int:
+        """
+        The number of threads CTR mode spreads its blocks over, with the GIL released.
+        The chained modes are inherently serial.
+        """
+        return self._workers
+    @workers.setter
+    def workers(self, value: int) -> None:
+        self._workers = value
+        self._context = None
+
+    @property
+    def context(self) -> object:
+        """
+        The native cipher context, holding the keyed round sponge and per-block work areas.
+        It is built on first use and rebuilt whenever the key, IV or mode changes.
+        """
+        def as_bytes(value: str | bytes) -> bytes:
+            return bytes(value, 'latin1') if isinstance(value, str) else value
+        if self._context is None:
+            self._context = self.cLib.new_context(as_bytes(self.key), as_bytes(self.iv),
+                                                  self.mode, self.workers)
+        return self._context
 
     @classmethod
     def keygen(cls) -> str:
         return ''.join([chr(randint(0, 255)) for _ in range(cls.KEY_LEN)])
 
-    def __encrypt_bytes(self, b: bytes) -> bytes:
-        return self.cLib.encrypt_(b, self.key, self.iv, self.mode)
+    def padded_length(self, length: int) -> int:
+        """
+        Returns the ciphertext length for a plaintext of the given length.
+        Messages are terminated by a 0xFF delimiter and zero-padded to a whole block,
+        and in CTR mode are led by their nonce.
+        """
+        return (length // self.BLOCK_LEN + 1) * self.BLOCK_LEN + self.nonce_len
+
+    @property
+    def nonce_len(self) -> int:
+        """
+        The length of the nonce leading each message: NONCE_LEN in CTR mode, as the other modes take none
+        """
+        return self.NONCE_LEN if self.mode == self.MODE_CTR else 0
+
+    def nonce(self) -> bytes:
+        """
+        Returns a fresh random nonce for a message in CTR mode, so no two messages share a keystream
+        """
+        return urandom(self.nonce_len)
+
+    def encrypt_bytes(self, data: bytes) -> bytes:
+        """
+        Encrypts any bytes-like object, padding it to a whole number of blocks
+        """
+        return self.cLib.encrypt_bytes(self.context, data, self.nonce())
+
+    def encrypt_into(self, data: bytes, out: bytearray) -> int:
+        """
+        Encrypts any bytes-like object into a writable buffer of at least padded_length(len(data)) bytes,
+        returning the number of bytes written
+        """
+        return self.cLib.encrypt_into(self.context, data, out, self.nonce())
 
     def encrypt(self, text: str) -> str:
-        def pad(_bytes: bytes, len_multiple: int):
-            return _bytes + bytes([self.__pad_delimiter] +
-                                  [self.__pad_byte for _ in range((len(_bytes) + 1) % len_multiple)])
-        return str(encode(self.__encrypt_bytes(bytes(text, 'utf8'))))
+        return str(encode(self.encrypt_bytes(bytes(text, 'utf8'))), 'utf8')
 
-    def __decrypt_bytes(self, b: bytes) -> bytes:
-        return self.cLib.decrypt_(b, self.key, self.iv, self.mode)
+    def decrypt_bytes(self, data: bytes) -> bytes:
+        """
+        Decrypts any bytes-like object, stripping its padding
+        """
+        return self.cLib.decrypt_bytes(self.context, data)
+
+    def decrypt_into(self, data: bytes, out: bytearray) -> int:
+        """
+        Decrypts any bytes-like object into a writable buffer of at least len(data) bytes,
+        returning the length of the unpadded plaintext written
+        """
+        return self.cLib.decrypt_into(self.context, data, out)
 
     def decrypt(self, text: str) -> str:
-        def unpad(_bytes):
-            return _bytes.rstrip(self.__pad_byte)[:-1]
-        return str(self.__decrypt_bytes(decode(text)))
+        return str(self.decrypt_bytes(decode(text)), 'utf8')
+
+    def encryptor(self) -> FeistelStream:
+        """
+        Returns a stream that encrypts a message incrementally, in constant memory
+        """
+        return FeistelStream(self, encrypting=True)
+
+    def decryptor(self) -> FeistelStream:
+        """
+        Returns a stream that decrypts a message incrementally, in constant memory
+        """
+        return FeistelStream(self, encrypting=False)
+
+
+class FeistelStream:
+    """
+    Incremental encryption or decryption of a single message.
+    The stream works on its own copy of the cipher's native context, carrying the chaining value
+    and any partial block between calls, so its output matches a one-shot call on the whole message.
+    In CTR mode an encrypting stream draws a nonce and writes it first, and a decrypting stream reads it first.
+    """
+    cLib = FeistelCipher.cLib
+
+    def __init__(self, cipher: FeistelCipher, encrypting: bool) -> None:
+        self.block_len = cipher.BLOCK_LEN
+        self.encrypting = encrypting
+        self.__context = self.cLib.copy_context(cipher.context)
+        self.__pending = bytearray()
+        # Nonce still to be written, or the length of the nonce still to be read
+        self.__nonce, self.__nonce_len = b'', 0
+        if encrypting:
+            self.__nonce = cipher.nonce()
+            self.cLib.set_nonce(self.__context, self.__nonce)
+        else:
+            self.__nonce_len = cipher.nonce_len
+
+    def update(self, chunk: bytes) -> bytes:
+        """
+        Processes as many whole blocks as are available, holding back any remainder.
+        Decryption also holds back the last whole block, as it may carry the padding.
+        """
+        if self.__context is None:
+            raise ValueError("stream has already been finalized")
+        self.__pending += chunk
+        if self.__nonce_len:
+            if len(self.__pending) < self.__nonce_len:
+                return b''
+            self.cLib.set_nonce(self.__context, bytes(self.__pending[:self.__nonce_len]))
+            del self.__pending[:self.__nonce_len]
+            self.__nonce_len = 0
+        ready = len(self.__pending) - len(self.__pending) % self.block_len
+        if not self.encrypting and ready == len(self.__pending):
+            ready -= self.block_len
+        if ready <= 0:
+            return self.__lead(b'')
+        with memoryview(self.__pending) as view:
+            if self.encrypting:
+                out = self.cLib.encrypt_blocks(self.__context, view[:ready])
+            else:
+                out = self.cLib.decrypt_blocks(self.__context, view[:ready])
+        del self.__pending[:ready]
+        return self.__lead(out)
+
+    def __lead(self, out: bytes) -> bytes:
+        """
+        Puts any nonce not yet written in front of the output
+        """
+        nonce, self.__nonce = self.__nonce, b''
+        return nonce + out if nonce else out
+
+    def finalize(self) -> bytes:
+        """
+        Processes the final block, padding or unpadding it, and closes the stream
+        """
+        if self.__context is None:
+            raise ValueError("stream has already been finalized")
+        if self.encrypting:
+            out = self.__lead(self.cLib.encrypt_final(self.__context, self.__pending))
+        else:
+            out = self.cLib.decrypt_final(self.__context, self.__pending)
+        self.__context, self.__pending = None, bytearray()
+        return out
@@ -1,49 +1,127 @@
 #! /usr/bin/env python3
 
 from __future__ import annotations
-from base64 import b64decode as decode
-from collections.abc import Callable
-from copy import deepcopy
+from collections.abc import Callable, Sequence
+from mmap import mmap, ACCESS_READ
+from os import cpu_count, fstat
 
 from abcs import Hash
 
 
+def left_encode(x: int) -> bytes:
+    """
+    Encodes an integer as its big-endian bytes, prefixed by their count (NIST SP 800-185)
+    """
+    n = max(1, (x.bit_length() + 7) // 8)
+    return bytes([n]) + x.to_bytes(n, 'big')
+
+
+def right_encode(x: int) -> bytes:
+    """
+    Encodes an integer as its big-endian bytes, suffixed by their count (NIST SP 800-185)
+    """
+    n = max(1, (x.bit_length() + 7) // 8)
+    return x.to_bytes(n, 'big') + bytes([n])
+
+
+def encode_string(s: bytes) -> bytes:
+    """
+    Encodes a byte string prefixed by its length in bits (NIST SP 800-185)
+    """
+    return left_encode(8 * len(s)) + s
+
+
+def bytepad(x: bytes, w: int) -> bytes:
+    """
+    Prefixes a byte string with the encoded width w, and pads it to a multiple of w (NIST SP 800-185)
+    """
+    padded = left_encode(w) + x
+    return padded + bytes(-len(padded) % w)
+
+
 class KeccakHash(Hash):
     import c_keccak.keccak as cLib
 
-    def __init__(self, rate: int, capacity: int) -> None:
-        self.cLib.new_hash(self, rate, capacity)
+    def __init__(self, rate: int, capacity: int, xof: bool = False) -> None:
+        self.state = (self.cLib.new_xof if xof else self.cLib.new_hash)(rate, capacity)
+
+    @classmethod
+    def cshake(cls, rate: int, capacity: int, name: bytes = b'', customization: bytes = b'') -> KeccakHash:
+        """
+        Returns a customisable SHAKE sponge, domain-separated by a function name and customisation string.
+        With neither given, this is plain SHAKE.
+        """
+        if not name and not customization:
+            return cls(rate, capacity, xof=True)
+        h = cls.__new__(cls)
+        h.state = cls.cLib.new_cshake(rate, capacity)
+        h.update(bytepad(encode_string(name) + encode_string(customization), rate // 8))
+        return h
+
+    @property
+    def digest_size(self) -> int:
+        return self.state.digest_size
 
-    def __squeeze(self) -> str:
-        return self.cLib.squeeze(self)
+    def __squeeze(self, length: int) -> bytes:
+        return self.cLib.squeeze(self.state, length)
 
-    def __absorb(self, _bytes: bytes):
-        self.cLib.absorb(self, _bytes)
+    def __absorb(self, buffer: bytes):
+        self.cLib.absorb(self.state, buffer)
 
     def copy(self) -> KeccakHash:
-        return deepcopy(self)
+        """
+        Returns an independent copy of the sponge, cloned natively with a single memcpy
+        """
+        copied = type(self).__new__(type(self))
+        copied.state = self.cLib.copy_hash(self.state)
+        return copied
 
-    def update(self, s: str):
-        self.__absorb(bytes(s, 'utf8'))
+    def update(self, data: str | bytes):
+        """
+        Absorbs a string (as UTF-8) or any object supporting the buffer protocol.
+        Buffers are hashed in place, without copying, and the GIL is released for large inputs.
+        """
+        if isinstance(data, str):
+            data = bytes(data, 'utf8')
+        self.__absorb(data)
 
-    def digest(self) -> str:
-        finalised = self.copy()
-        digest = finalised.__squeeze()
-        return decode(digest)
+    def update_file(self, path: str) -> None:
+        """
+        Absorbs the contents of a file through a read-only memory map,
+        so the file is never loaded into Python memory.
+        """
+        with open(path, 'rb') as f:
+            # Empty files cannot be mapped, and have nothing to absorb
+            if fstat(f.fileno()).st_size == 0:
+                return
+            with mmap(f.fileno(), 0, access=ACCESS_READ) as mapped:
+                self.__absorb(mapped)
 
-    def hexdigest(self) -> str:
-        finalised = self.copy()
-        digest = finalised.__squeeze()
-        return digest.hex()
+    def digest(self, length: int = None) -> bytes:
+        """
+        Returns the digest of everything absorbed so far, leaving the sponge untouched.
+        Extendable-output presets may ask for any length of digest.
+        """
+        return self.__squeeze(self.digest_size if length is None else length)
+
+    def hexdigest(self, length: int = None) -> str:
+        return self.digest(length).hex()
+
+    def read(self, n: int) -> bytes:
+        """
+        Squeezes the next n bytes of output, continuing from the end of the previous read.
+        The first read finalises the sponge, after which no more input may be absorbed.
+        """
+        return self.cLib.read_bytes(self.state, n)
 
     @staticmethod
-    def preset(rate: int, capacity: int) -> Callable:
+    def preset(rate: int, capacity: int, xof: bool = False) -> Callable:
         """
         Returns a factory function for the given bitrate, sponge capacity and output length.
         The function accepts an optional initial input, ala hashlib.
         """
         def create(initial_input: str = None):
-            h = KeccakHash(rate, capacity)
+            h = KeccakHash(rate, capacity, xof)
             if initial_input is not None:
                 h.update(initial_input)
             return h
@@ -55,3 +133,109 @@ Keccak224 = KeccakHash.preset(1152, 448)
 Keccak256 = KeccakHash.preset(1088, 512)
 Keccak384 = KeccakHash.preset(832, 768)
 Keccak512 = KeccakHash.preset(576, 1024)
+
+# SHAKE extendable-output presets
+Shake128 = KeccakHash.preset(1344, 256, xof=True)
+Shake256 = KeccakHash.preset(1088, 512, xof=True)
+
+
+def hash_many(messages: Sequence, preset: Callable = Keccak256, workers: int = None) -> list:
+    """
+    Hashes many independent messages at once, returning their digests in input order.
+    Messages may be strings (as UTF-8) or bytes-like objects, and are spread across
+    a native thread pool of the given number of workers with the GIL released.
+    """
+    template = preset()
+    buffers = [bytes(m, 'utf8') if isinstance(m, str) else m for m in messages]
+    return KeccakHash.cLib.hash_many(template.state, buffers, template.digest_size,
+                                     workers or cpu_count() or 1)
+
+
+class ParallelHash(Hash):
+    """
+    Tree hash following NIST SP 800-185 ParallelHash.
+    Input is split into fixed-size chunks, each hashed independently on the native thread pool,
+    and their chaining values are absorbed in order by a final cSHAKE node.
+    Chunks are dispatched as soon as they are complete, so hashing keeps pace with streamed input.
+    """
+
+    def __init__(self, security: int = 256, chunk_size: int = 8192,
+                 customization: bytes = b'', workers: int = None) -> None:
+        rate, capacity = 1600 - 2 * security, 2 * security
+        self.chunk_size = chunk_size
+        self.workers = workers or cpu_count() or 1
+        self.digest_size = capacity // 8
+        self.__leaf = KeccakHash(rate, capacity, xof=True)
+        self.__node = KeccakHash.cshake(rate, capacity, b'ParallelHash', customization)
+        self.__node.update(left_encode(chunk_size))
+        self.__chunks = 0
+        self.__pending = bytearray()
+
+    def copy(self) -> ParallelHash:
+        copied = type(self).__new__(type(self))
+        copied.__dict__.update(self.__dict__)
+        copied.__node = self.__node.copy()
+        copied.__pending = bytearray(self.__pending)
+        return copied
+
+    def __absorb_chunks(self, chunks: list) -> None:
+        values = KeccakHash.cLib.hash_many(self.__leaf.state, chunks, self.digest_size, self.workers)
+        self.__node.update(b''.join(values))
+        self.__chunks += len(chunks)
+
+    def update(self, data: str | bytes):
+        """
+        Absorbs a string (as UTF-8) or any object supporting the buffer protocol.
+        Every chunk completed by this input is hashed before returning; any remainder is held back.
+        """
+        if isinstance(data, str):
+            data = bytes(data, 'utf8')
+        view = memoryview(data).cast('B')
+        chunks = []
+        # Top up the held-back partial chunk first
+        if self.__pending:
+            fill = min(len(view), self.chunk_size - len(self.__pending))
+            self.__pending += view[:fill]
+            view = view[fill:]
+            if len(self.__pending) < self.chunk_size:
+                return
+            chunks.append(bytes(self.__pending))
+            self.__pending = bytearray()
+        # Whole chunks are hashed straight from the caller's buffer
+        whole = len(view) - len(view) % self.chunk_size
+        chunks += [view[i:i + self.chunk_size] for i in range(0, whole, self.chunk_size)]
+        self.__pending += view[whole:]
+        if chunks:
+            self.__absorb_chunks(chunks)
+
+    def digest(self, length: int = None) -> bytes:
+        """
+        Returns a digest of the given length of everything absorbed so far, leaving the hash untouched
+        """
+        length = self.digest_size if length is None else length
+        finalised = self.copy()
+        if finalised.__pending:
+            finalised.__absorb_chunks([bytes(finalised.__pending)])
+        finalised.__node.update(right_encode(finalised.__chunks) + right_encode(8 * length))
+        return finalised.__node.read(length)
+
+    def hexdigest(self, length: int = None) -> str:
+        return self.digest(length).hex()
+
+    @staticmethod
+    def preset(security: int) -> Callable:
+        """
+        Returns a factory function for the given security strength.
+        The function accepts an optional initial input, ala hashlib, and the ParallelHash options.
+        """
+        def create(initial_input: str = None, **kwargs):
+            h = ParallelHash(security, **kwargs)
+            if initial_input is not None:
+                h.update(initial_input)
+            return h
+        return create
+
+
+# ParallelHash parameter presets
+ParallelHash128 = ParallelHash.preset(128)
+ParallelHash256 = ParallelHash.preset(256)
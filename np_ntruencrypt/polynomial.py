@@ -0,0 +1,480 @@
+#! /usr/bin/env python3
+"""
+A NumPy implementation of the c_ntruencrypt.polynomial interface.
+Every function takes the same arguments as its native counterpart, views NTRUPolynomial buffers
+as arrays of native ints and writes its result into the caller's output buffer, returning it.
+Any polynomial may instead be a 2-D array holding one polynomial per row, to work on a whole batch
+of polynomials in a single vectorised call.
+"""
+
+from __future__ import annotations
+from collections.abc import Sequence
+from hashlib import shake_256
+from struct import pack
+
+import numpy as np
+
+
+# Products are formed from index lists when a side has at most N / SPARSE_RATIO nonzero terms
+SPARSE_RATIO = 8
+TRITS_PER_BYTE = 5
+# Blinding polynomials are read from a SHAKE256 stream keyed by a seed from the OS and a counter
+SEED_BYTES = 32
+
+
+def view(P: object) -> np.ndarray:
+    """
+    Views a polynomial buffer as an array of native ints, or passes an array of polynomials through
+    """
+    if isinstance(P, np.ndarray):
+        return P
+    with memoryview(P) as mv:
+        if mv.format != 'i':
+            raise ValueError("expected a buffer of native ints, not '%s'" % mv.format)
+    return np.frombuffer(P, dtype=np.intc)
+
+
+def write(O: object, result: np.ndarray) -> object:
+    out = view(O)
+    if out.shape != result.shape:
+        raise ValueError("output has shape %s, expected %s" % (out.shape, result.shape))
+    out[...] = result
+    return O
+
+
+def operands(P: object, Q: object) -> tuple:
+    p, q = view(P), view(Q)
+    if p.shape[-1] != q.shape[-1]:
+        raise ValueError("operands have %d and %d coefficients" % (p.shape[-1], q.shape[-1]))
+    return p, q
+
+
+def rshift(P: object, n: int, O: object) -> object:
+    return write(O, np.roll(view(P), n, axis=-1))
+
+
+def lshift(P: object, n: int, O: object) -> object:
+    return write(O, np.roll(view(P), -n, axis=-1))
+
+
+def degree(P: object) -> int:
+    nonzero = np.flatnonzero(view(P))
+    return int(nonzero[-1]) if nonzero.size else 0
+
+
+def centerlift(P: object, n: int, O: object) -> object:
+    p = view(P)
+    return write(O, np.where(p > n / 2, p - n, p))
+
+
+def s_mul(P: object, x: int, O: object) -> object:
+    return write(O, view(P).astype(np.int64) * x)
+
+
+def s_add(P: object, x: int, O: object) -> object:
+    p = view(P).astype(np.int64)
+    p[..., 0] += x
+    return write(O, p)
+
+
+def s_mod(P: object, x: int, O: object) -> object:
+    return write(O, view(P) % x)
+
+
+def s_div(P: object, x: int, O: object) -> object:
+    """
+    Divides each coefficient by x, truncating towards zero as C does
+    """
+    p = view(P).astype(np.int64)
+    return write(O, np.sign(p) * np.sign(x) * (np.abs(p) // abs(x)))
+
+
+def v_add(P: object, Q: object, O: object) -> object:
+    p, q = operands(P, Q)
+    return write(O, p.astype(np.int64) + q)
+
+
+def v_sub(P: object, Q: object, O: object) -> object:
+    p, q = operands(P, Q)
+    return write(O, p.astype(np.int64) - q)
+
+
+def circulant(q: np.ndarray) -> np.ndarray:
+    """
+    Returns the matrix C with C[i, k] = q[k - i mod N], so that p @ C is the product p * q
+    """
+    N = q.shape[-1]
+    return q[(np.arange(N) - np.arange(N)[:, None]) % N]
+
+
+def sparse_terms(p: np.ndarray) -> tuple:
+    index = np.flatnonzero(p)
+    return index, p[index].astype(np.int64)
+
+
+def sparse_convolve(index: np.ndarray, value: np.ndarray, q: np.ndarray) -> np.ndarray:
+    """
+    Multiplies q by the polynomials given as rows of nonzero terms, adding a rotation of q per term
+    """
+    N = q.shape[-1]
+    out = np.zeros(np.broadcast_shapes(index.shape[:-1], q.shape[:-1]) + (N,), np.int64)
+    for t in range(index.shape[-1]):
+        out += value[..., t, None] * q[..., (np.arange(N) - index[..., t, None]) % N]
+    return out
+
+
+def convolve(p: np.ndarray, q: np.ndarray) -> np.ndarray:
+    """
+    Multiplies in Z[X]/(X^N - 1) as a product with the circulant matrix of one side.
+    Each row of a 2-D side is multiplied in turn, and a 1-D side is shared by every row.
+    Works in doubles, through BLAS, while the products are bounded below 2^53, and exactly in 64-bit ints otherwise.
+    """
+    if q.ndim > 1 and p.ndim == 1:
+        p, q = q, p
+    if q.ndim > 1:
+        return np.stack([convolve(a, b) for a, b in zip(p, q)]) if len(p) else p.astype(np.int64)
+    bound = q.shape[-1] * float(np.abs(p).max(initial=0)) * float(np.abs(q).max(initial=0))
+    dtype = np.float64 if bound < 2**53 else np.int64
+    return (p.astype(dtype) @ circulant(q.astype(dtype))).astype(np.int64)
+
+
+def schoolbook_mul(P: object, Q: object, O: object) -> object:
+    return write(O, convolve(*operands(P, Q)))
+
+
+def sparse_mul(P: object, Q: object, O: object) -> object:
+    p, q = operands(P, Q)
+    if p.ndim > 1:
+        return write(O, convolve(p, q))
+    return write(O, sparse_convolve(*sparse_terms(p), q.astype(np.int64)))
+
+
+karatsuba_mul = schoolbook_mul
+
+
+def v_mul(P: object, Q: object, O: object) -> object:
+    """
+    Multiplies in Z[X]/(X^N - 1), from index lists when a single polynomial is sparse
+    """
+    p, q = operands(P, Q)
+    limit = p.shape[-1] // SPARSE_RATIO
+    if p.ndim == 1 and np.count_nonzero(p) <= limit:
+        return sparse_mul(p, q, O)
+    if q.ndim == 1 and np.count_nonzero(q) <= limit:
+        return sparse_mul(q, p, O)
+    return write(O, convolve(p, q))
+
+
+def inverse_prime(f: np.ndarray, p: int) -> np.ndarray | None:
+    """
+    Inverts f modulo a prime p by the almost-inverse algorithm, returning None if f is not invertible.
+    Keeps b * F = X^k f and c * F = X^k g modulo X^N - 1 while f and g are reduced,
+    so b and c are held reduced in the ring, and dividing f by X rotates c.
+    """
+    N = f.size
+    f = np.append(f.astype(np.int64) % p, 0)
+    g = np.zeros(N + 1, np.int64)
+    g[0], g[N] = p - 1, 1
+    b, c = np.zeros(N, np.int64), np.zeros(N, np.int64)
+    b[0], k = 1, 0
+    while True:
+        nonzero = np.flatnonzero(f)
+        if not nonzero.size:
+            return None
+        shift = int(nonzero[0])
+        if shift:
+            f, c, k = np.roll(f, -shift), np.roll(c, shift), k + shift
+        if nonzero[-1] == shift:
+            break
+        if nonzero[-1] - shift < np.flatnonzero(g)[-1]:
+            f, g, b, c = g, f, c, b
+        u = int(f[0]) * pow(int(g[0]), -1, p) % p
+        f = (f - u * g) % p
+        b = (b - u * c) % p
+    return np.roll(b * pow(int(f[0]), -1, p) % p, -k)
+
+
+def inverse_prime_power(f: np.ndarray, pn: int) -> np.ndarray | None:
+    """
+    Inverts modulo p, then Newton lifts b <- b(2 - fb), doubling the power of p inverted modulo each pass
+    """
+    p = next(x for x in range(2, pn + 1) if pn % x == 0)
+    b = inverse_prime(f, p)
+    if b is None:
+        return None
+    f = f.astype(np.int64) % pn
+    f = np.where(f > pn / 2, f - pn, f)
+    e = p
+    while e < pn:
+        t = (2 * (np.arange(f.size) == 0) - convolve(f, b)) % pn
+        b = convolve(b, t) % pn
+        e *= e
+    return b
+
+
+def inverse_modp(P: object, n: int, O: object) -> object | None:
+    result = inverse_prime(view(P), n)
+    return None if result is None else write(O, result)
+
+
+def inverse_modpn(P: object, n: int, O: object) -> object | None:
+    result = inverse_prime_power(view(P), n)
+    return None if result is None else write(O, result)
+
+
+def digits_per_byte(base: int) -> int:
+    k, v = 1, base
+    while v < 256:
+        k, v = k + 1, v * base
+    return k
+
+
+def bytes_per_digit(base: int) -> int:
+    w, v = 1, 256
+    while v < base:
+        w, v = w + 1, v * 256
+    return w
+
+
+def encoded_length(length: int, base: int) -> int:
+    if base < 256:
+        return length * digits_per_byte(base)
+    w = bytes_per_digit(base)
+    return (length + w - 1) // w
+
+
+def encode_block(data: object, base: int, start: int, O: object) -> object:
+    """
+    Fills O with digits [start, start + len(O)) of the encoding of data,
+    followed by a terminating 1 and then zero padding
+    """
+    if base < 2:
+        raise ValueError("invalid base %d" % base)
+    data = np.frombuffer(data, dtype=np.uint8)
+    N, digits = view(O).shape[-1], encoded_length(data.size, base)
+    out = (np.arange(start, start + N) == digits).astype(np.int64)
+    end = min(max(digits - start, 0), N)
+    if base < 256:
+        k = digits_per_byte(base)
+        j = np.arange(start, start + end)
+        out[:end] = data[j // k] // base ** (j % k) % base
+    else:
+        w = bytes_per_digit(base)
+        window = np.zeros(end * w, np.int64)
+        chunk = data[start * w:(start + end) * w]
+        window[:chunk.size] = chunk
+        out[:end] = window.reshape(end, w) @ 256 ** np.arange(w, dtype=np.int64)
+    return write(O, out)
+
+
+def decode_digits(D: object, count: int, base: int) -> bytes:
+    """
+    Packs the first count digits of D back into bytes, treating any missing digits
+    of a final partial group as zero
+    """
+    if base < 2:
+        raise ValueError("invalid base %d" % base)
+    d = view(D)
+    if count < 0 or count > d.size:
+        raise ValueError("cannot decode %d of %d digits" % (count, d.size))
+    if base < 256:
+        k = digits_per_byte(base)
+        digits = np.zeros(-(-count // k) * k, np.int64)
+        digits[:count] = d[:count]
+        out = digits.reshape(-1, k) @ base ** np.arange(k, dtype=np.int64)
+        if out.size and (out.min() < 0 or out.max() > 255):
+            raise ValueError("digits out of range for base %d" % base)
+    else:
+        digits = d[:count].astype(np.int64)
+        if digits.size and (digits.min() < 0 or digits.max() >= base):
+            raise ValueError("digits out of range for base %d" % base)
+        w = bytes_per_digit(base)
+        out = digits[:, None] >> 8 * np.arange(w) & 0xFF
+    return out.astype(np.uint8).tobytes()
+
+
+def packed_length(length: int, bits: int) -> int:
+    return (length * bits + 7) // 8 if bits else (length + TRITS_PER_BYTE - 1) // TRITS_PER_BYTE
+
+
+def pack_key(P: object, bits: int) -> bytes:
+    """
+    Packs P with bits per coefficient as little-endian runs of bits, or five trits to a byte if bits is 0
+    """
+    if bits < 0 or bits > 31:
+        raise ValueError("cannot pack %d bit coefficients" % bits)
+    p = view(P).astype(np.int64)
+    if bits:
+        if p.size and (p.min() < 0 or p.max() >= 1 << bits):
+            raise ValueError("coefficient does not fit %d bits" % bits)
+        return np.packbits((p[:, None] >> np.arange(bits) & 1).astype(np.uint8), bitorder='little').tobytes()
+    trits = np.zeros(packed_length(p.size, 0) * TRITS_PER_BYTE, np.int64)
+    trits[:p.size] = p % 3
+    return (trits.reshape(-1, TRITS_PER_BYTE) @ 3 ** np.arange(TRITS_PER_BYTE)).astype(np.uint8).tobytes()
+
+
+def unpack_key(data: object, bits: int, O: object) -> object:
+    """
+    Unpacks a key packed by pack_key into O, which sets the number of coefficients
+    """
+    if bits < 0 or bits > 31:
+        raise ValueError("cannot unpack %d bit coefficients" % bits)
+    data, N = np.frombuffer(data, dtype=np.uint8), view(O).size
+    if data.size != packed_length(N, bits):
+        raise ValueError("packed key is %d bytes, expected %d" % (data.size, packed_length(N, bits)))
+    if bits:
+        unpacked = np.unpackbits(data, bitorder='little')[:N * bits].reshape(N, bits)
+        return write(O, unpacked.astype(np.int64) @ (1 << np.arange(bits, dtype=np.int64)))
+    if data.size and data.max() >= 3 ** TRITS_PER_BYTE:
+        raise ValueError("packed key holds an invalid trit")
+    trits = data[:, None].astype(np.int64) // 3 ** np.arange(TRITS_PER_BYTE) % 3
+    return write(O, np.where(trits == 2, -1, trits).ravel()[:N])
+
+
+def sample(seed: bytes, shape: tuple, N: int, d1: int, d2: int) -> tuple:
+    """
+    Picks d1 distinct positions for 1s and d2 for -1s in each of shape polynomials, as index/value rows,
+    drawing the same positions as the native sampler. The i'th polynomial shuffles its positions by a partial
+    Fisher-Yates, run across every polynomial at once, with words from the seed's i'th SHAKE256 stream
+    mapped below each bound by Lemire's multiply-and-shift. Rejected words are redrawn from further along
+    """
+    if len(seed) != SEED_BYTES:
+        raise ValueError("seed is %d bytes, expected %d" % (len(seed), SEED_BYTES))
+    if d1 < 0 or d2 < 0 or d1 + d2 > N:
+        raise ValueError("cannot place %d nonzero terms in %d coefficients" % (d1 + d2, N))
+    k, count = d1 + d2, int(np.prod(shape))
+    streams = [shake_256(bytes(seed) + pack('<Q', i)) for i in range(count)]
+    words = np.frombuffer(b''.join(stream.digest(4 * k) for stream in streams), '<u4')
+    words = words.reshape(count, k).astype(np.uint64)
+    perm, rows, redraws = np.tile(np.arange(N), (count, 1)), np.arange(count), [0] * count
+    for t in range(k):
+        bound = N - t
+        m = words[:, t] * np.uint64(bound)
+        for i in np.flatnonzero(m & np.uint64(0xFFFFFFFF) < np.uint64((2**32 - bound) % bound)):
+            while int(m[i]) & 0xFFFFFFFF < (2**32 - bound) % bound:
+                redraws[i] += 1
+                word = streams[i].digest(4 * (k + redraws[i]))[-4:]
+                m[i] = int.from_bytes(word, 'little') * bound
+        j = t + (m >> np.uint64(32)).astype(np.int64)
+        perm[rows, t], perm[rows, j] = perm[rows, j], perm[rows, t]
+    value = np.concatenate([np.ones(d1, np.int64), -np.ones(d2, np.int64)])
+    index = perm[:, :k].reshape(shape + (k,))
+    return index, np.broadcast_to(value, index.shape)
+
+
+def sample_ternary(d1: int, d2: int, seed: bytes, O: object) -> object:
+    o = view(O)
+    index, value = sample(seed, o.shape[:-1], o.shape[-1], d1, d2)
+    out = np.zeros(o.shape, np.int64)
+    np.put_along_axis(out, index, value, axis=-1)
+    return write(O, out)
+
+
+def sample_many(d1: int, d2: int, seed: bytes, polys: Sequence) -> Sequence:
+    """
+    Samples into every polynomial of a sequence, the i'th from the seed's i'th stream
+    """
+    if len(polys):
+        out = sample_ternary(d1, d2, seed, np.stack([view(poly) for poly in polys]))
+        for poly, row in zip(polys, out):
+            write(poly, row)
+    return polys
+
+
+def lift(a: np.ndarray, n: int) -> np.ndarray:
+    a = a % n
+    return np.where(a > n // 2, a - n, a)
+
+
+class NTRUContext:
+    """
+    Copies of the keys for a block cipher, with the private key's nonzero terms when it is sparse.
+    Batches are multiplied through the circulant matrices of the keys, which are built on first use.
+    """
+
+    def __init__(self, pub: object, priv: object, d: int, p: int, q: int) -> None:
+        self.pub = view(pub).astype(np.int64)
+        self.N, self.d, self.p, self.q = self.pub.size, d, p, q
+        if d < 1 or 2 * d - 1 > self.N:
+            raise ValueError("cannot place %d nonzero terms in %d coefficients" % (2 * d - 1, self.N))
+        self.priv, self.priv_terms = None, None
+        if priv is not None:
+            self.priv = view(priv).astype(np.int64)
+            if self.priv.size != self.N:
+                raise ValueError("keys have %d and %d coefficients" % (self.N, self.priv.size))
+            if np.count_nonzero(self.priv) <= self.N // SPARSE_RATIO:
+                self.priv_terms = sparse_terms(self.priv)
+        self.circulants: dict = {}
+
+    def circulant(self, key: str) -> np.ndarray:
+        """
+        Returns the circulant matrix of a key, for multiplying by polynomials reduced modulo q.
+        It is held in doubles, for BLAS, while the products are bounded below 2^53
+        """
+        if key not in self.circulants:
+            k = getattr(self, key)
+            exact = self.N * float(self.q) * float(np.abs(k).max(initial=0)) < 2**53
+            self.circulants[key] = circulant(k.astype(np.float64 if exact else np.int64))
+        return self.circulants[key]
+
+
+def new_context(pub: object, priv: object, d: int, p: int, q: int) -> NTRUContext:
+    return NTRUContext(pub, priv, d, p, q)
+
+
+def check_blocks(ctx: NTRUContext, M: object) -> np.ndarray:
+    m = view(M)
+    if m.shape[-1] != ctx.N:
+        raise ValueError("block has %d coefficients, expected %d" % (m.shape[-1], ctx.N))
+    return m
+
+
+def encrypt_block(ctx: NTRUContext, M: object, seed: bytes, O: object) -> object:
+    """
+    e = r * h + lift(m, p) mod q, for fresh blinding polynomials r drawn from seed, the i'th row of M
+    blinded from the seed's i'th stream as in encrypt_many.
+    A single block is multiplied from the index list of r, and a batch in one matrix product.
+    O may be M itself
+    """
+    m = check_blocks(ctx, M)
+    index, value = sample(seed, m.shape[:-1], ctx.N, ctx.d, ctx.d - 1)
+    if m.ndim == 1:
+        e = sparse_convolve(index, value, ctx.pub)
+    else:
+        r = np.zeros(m.shape, np.int64)
+        np.put_along_axis(r, index, value, axis=-1)
+        e = (r @ ctx.circulant('pub')).astype(np.int64)
+    return write(O, (e + lift(m, ctx.p)) % ctx.q)
+
+
+def decrypt_block(ctx: NTRUContext, E: object, O: object) -> object:
+    """
+    m = lift(f * e mod q, q) mod p, for each row of E. O may be E itself
+    """
+    if ctx.priv is None:
+        raise ValueError("decryption needs a private key")
+    e = check_blocks(ctx, E).astype(np.int64) % ctx.q
+    if e.ndim == 1 and ctx.priv_terms is not None:
+        a = sparse_convolve(*ctx.priv_terms, e)
+    else:
+        circulant = ctx.circulant('priv')
+        a = (e.astype(circulant.dtype) @ circulant).astype(np.int64)
+    return write(O, lift(a, ctx.q) % ctx.p)
+
+
+def crypt_many(blocks: Sequence, crypt) -> Sequence:
+    """
+    Stacks the blocks into one array, runs a single batched call over it and writes each row back
+    """
+    if len(blocks):
+        for block, row in zip(blocks, crypt(np.stack([view(block) for block in blocks]))):
+            write(block, row)
+    return blocks
+
+
+def encrypt_many(ctx: NTRUContext, blocks: Sequence, seed: bytes, workers: int) -> Sequence:
+    return crypt_many(blocks, lambda m: encrypt_block(ctx, m, seed, m))
+
+
+def decrypt_many(ctx: NTRUContext, blocks: Sequence, workers: int) -> Sequence:
+    return crypt_many(blocks, lambda e: decrypt_block(ctx, e, e))
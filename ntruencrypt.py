@@ -1,157 +1,232 @@
 #! /usr/bin/env python3
 
 from __future__ import annotations
+from array import array
 from base64 import b64encode as encode, b64decode as decode
-from collections.abc import Callable, Iterable
-from random import randint
+from collections.abc import Callable, Iterable, Iterator, Sequence
+from mmap import mmap, ACCESS_READ
+from os import cpu_count, environ, urandom
+from queue import Empty, Full, Queue
+from struct import Struct
+from threading import Event, Thread
 
 from abcs import AsymmetricCipher
 
 
-def base_convert(digits: bytes, fromBase: int, toBase: int) -> list:
+def iter_bytes2base(_bytes: bytes, base: int, N: int) -> Iterator[NTRUPolynomial]:
     """
-    Converts a list of ints, digits, from a given base to any other
+    Converts a string to length-N polynomials of digits in a given base, one block at a time
+    Each byte is packed at a fixed width, then terminated with a 0x01 digit and zero-padded
+    Bases wider than a byte pack whole digits instead, so only round-trip strings from base2bytes
     """
-    n = 0
-    for i, d in enumerate(digits):
-        n += (d % fromBase) * (fromBase**i)
-    if n == 0:
-        return [0]
-    newDigits = []
-    while n:
-        newDigits.append(int(n % toBase))
-        n //= toBase
-    return newDigits
+    length = NTRUPolynomial.cLib.encoded_length(len(_bytes), base) + 1
+    for start in range(0, length, N):
+        yield NTRUPolynomial.cLib.encode_block(_bytes, base, start, NTRUPolynomial.zeros(N))
 
 
-def split(unpadded_list: list, N: int) -> list:
+def bytes2base(_bytes: bytes, base: int, N: int = 0) -> list:
     """
-    Splits a list into a series of N-length lists
-    Pads the last list with terminator 0x01 and then 0x00 chars
+    Converts a string to lists of ints, length N, in a given base
+    With N = 0, the whole message is returned as a single block
     """
-    terminated_list = unpadded_list + [1]
-    padded_lists = []
-    for n in range(0, len(terminated_list), N):
-        padded_lists.append(terminated_list[n:n + N])
-    padded_lists[-1].extend([0 for _ in range(N - len(padded_lists[-1]))])
-    return padded_lists
+    N = N or NTRUPolynomial.cLib.encoded_length(len(_bytes), base) + 1
+    return list(iter_bytes2base(_bytes, base, N))
 
 
-def join(padded_lists: Iterable[bytes]) -> Iterable:
+def iter_base2bytes(lists: Iterable[Iterable[int]], base: int) -> Iterator[bytes]:
+    """
+    Converts lists of ints in a given base back to a string, one block at a time
+    The last list is held back until the input ends, as it carries the terminator
     """
-    Joins a series of lists, stripping trailing 0s from the output
+    width = NTRUPolynomial.cLib.encoded_length(1, base) if base < 256 else 1
+    digits, held = array('i'), None
+    for l in lists:
+        if held is not None:
+            digits.extend(held)
+            ready = len(digits) - len(digits) % width
+            yield NTRUPolynomial.cLib.decode_digits(digits, ready, base)
+            del digits[:ready]
+        held = l
+    digits.extend(held or [])
+    end = len(digits)
+    while end and digits[end - 1] == 0:
+        end -= 1
+    if not end:
+        raise ValueError("Error: message terminator not found")
+    yield NTRUPolynomial.cLib.decode_digits(digits, end - 1, base)
+
+
+def base2bytes(lists: Iterable[Iterable[int]], base: int) -> bytes:
     """
-    unpadded_list: list = []
-    for l in padded_lists:
-        unpadded_list.extend(l)
-    while unpadded_list[-1] == 0:
-        del unpadded_list[-1]
-    return unpadded_list[:-1]
+    Converts lists of ints in a given base to a string
+    """
+    return b''.join(iter_base2bytes(lists, base))
 
 
-def bytes2base(_bytes: bytes, base: int, N: int = 0):
+def blocks2bytes(blocks: Iterable[NTRUPolynomial], base: int) -> bytes:
     """
-    Converts a string to lists of ints, length N, in a given base
+    Packs whole blocks of digits, such as ciphertexts modulo q, with no terminator
     """
-    unpadded_list = base_convert(_bytes, 256, base)
-    return split(unpadded_list, N) if N else [unpadded_list]
+    return b''.join(NTRUPolynomial.cLib.decode_digits(block, len(block), base) for block in blocks)
 
 
-def base2bytes(lists: Iterable[bytes], base: int) -> bytes:
+def iter_bytes2blocks(_bytes: bytes, base: int, N: int) -> Iterator[NTRUPolynomial]:
     """
-    Converts lists of ints in a given base to a string
+    Unpacks length-N blocks of digits packed by blocks2bytes, one block at a time
     """
-    return bytes(base_convert(join(lists), base, 256))
+    for start in range(0, NTRUPolynomial.cLib.encoded_length(len(_bytes), base), N):
+        yield NTRUPolynomial.cLib.encode_block(_bytes, base, start, NTRUPolynomial.zeros(N))
+
 
+class NTRUPolynomial(array):
+    """
+    A polynomial in Z[X]/(X^N - 1), held as contiguous native ints behind the buffer protocol.
+    Arithmetic runs natively on the buffers, so coefficients only become Python ints when read,
+    and the in-place operators reuse the left operand's storage.
+    The arithmetic backend is chosen at import time: the native SWIG module by default,
+    or the NumPy module with NTRU_BACKEND=numpy in the environment.
+    """
+    if environ.get('NTRU_BACKEND', 'c') == 'numpy':
+        import np_ntruencrypt.polynomial as cLib
+    else:
+        import c_ntruencrypt.polynomial as cLib
 
-class NTRUPolynomial(tuple):
-    import c_ntruencrypt.polynomial as cLib
+    def __new__(cls, coeffs: Iterable = ()):
+        return super().__new__(cls, 'i', coeffs)
 
     @classmethod
-    def new(cls, coeffs: Iterable):
+    def zeros(cls, N: int) -> NTRUPolynomial:
+        return cls(bytes(N * cls().itemsize))
+
+    def blank(self) -> NTRUPolynomial:
         """
-        Shorthand to create new NTRUPolynomial instances
+        Returns a zero polynomial of the same length, to write a result into
         """
-        for coeff in coeffs:
-            assert isinstance(coeff, int)
-        return cls(coeffs)
-
-    def __new__(cls, coeffs: Iterable):
-        return super().__new__(cls, tuple(coeffs))
+        return self.zeros(len(self))
 
     def is_zero(self) -> bool:
-        return all(x == 0 for x in self)
+        return not any(self)
 
     def __rshift__(self, n: int) -> NTRUPolynomial:
         return self << -n
 
     def __lshift__(self, n: int) -> NTRUPolynomial:
-        return self.new(self.cLib.lshift(self, n))
+        return self.cLib.lshift(self, n, self.blank())
+
+    def __ilshift__(self, n: int) -> NTRUPolynomial:
+        return self.cLib.lshift(self, n, self)
+
+    def __irshift__(self, n: int) -> NTRUPolynomial:
+        return self.cLib.lshift(self, -n, self)
+
+    def __add__(self, other: object) -> NTRUPolynomial:
+        return self.__add(other, self.blank())
 
     def __radd__(self, other: object) -> NTRUPolynomial:
         return self + other
 
+    def __iadd__(self, other: object) -> NTRUPolynomial:
+        return self.__add(other, self)
+
+    def __add(self, other: object, out: NTRUPolynomial) -> NTRUPolynomial:
+        if isinstance(other, NTRUPolynomial):
+            return self.cLib.v_add(self, other, out)
+
+        return self.cLib.s_add(self, other, out)
+
     def __sub__(self, other: object) -> NTRUPolynomial:
-        return self + other * -1
+        return self.__sub(other, self.blank())
 
     def __rsub__(self, other: object) -> NTRUPolynomial:
         return other + self * -1
 
-    def __add__(self, other: object) -> NTRUPolynomial:
+    def __isub__(self, other: object) -> NTRUPolynomial:
+        return self.__sub(other, self)
+
+    def __sub(self, other: object, out: NTRUPolynomial) -> NTRUPolynomial:
         if isinstance(other, NTRUPolynomial):
-            return self.new(self.cLib.v_add(self, other))
+            return self.cLib.v_sub(self, other, out)
+
+        return self.cLib.s_add(self, -other, out)
+
+    def __mul__(self, other: object) -> NTRUPolynomial:
+        return self.__mul(other, self.blank())
 
-        return self.new(self.cLib.s_add(self, other))
+    def __rmul__(self, other: object) -> NTRUPolynomial:
+        return self * other
 
-    def __mul__(self, other: NTRUPolynomial):
+    def __imul__(self, other: object) -> NTRUPolynomial:
+        return self.__mul(other, self)
+
+    def __mul(self, other: object, out: NTRUPolynomial) -> NTRUPolynomial:
         if isinstance(other, NTRUPolynomial):
-            return self.new(self.cLib.v_mul(self, other))
+            return self.cLib.v_mul(self, other, out)
 
-        return self.new(self.cLib.s_mul(self, other))
+        return self.cLib.s_mul(self, other, out)
 
     def __mod__(self, other: int) -> NTRUPolynomial:
-        return self.new(self.cLib.s_mod(self, other))
+        return self.cLib.s_mod(self, other, self.blank())
+
+    def __imod__(self, other: int) -> NTRUPolynomial:
+        return self.cLib.s_mod(self, other, self)
 
-    def centerlift(self, n: int) -> NTRUPolynomial:
-        return self.new(self.cLib.centerlift(self, n))
+    def centerlift(self, n: int, inplace: bool = False) -> NTRUPolynomial:
+        return self.cLib.centerlift(self, n, self if inplace else self.blank())
 
     def degree(self) -> int:
         return self.cLib.degree(self)
 
     def inverse_modp(self, p: int) -> NTRUPolynomial:
-        return self.new(self.cLib.inverse_modp(self, p))
+        return self.cLib.inverse_modp(self, p, self.blank())
 
     def inverse_modpn(self, pn: int) -> NTRUPolynomial:
-        return self.new(self.cLib.inverse_modpn(self, pn))
+        return self.cLib.inverse_modpn(self, pn, self.blank())
 
 
 class NTRUCipher(AsymmetricCipher):
+    cLib = NTRUPolynomial.cLib
 
     def __init__(self, params: dict, keypair: dict = None) -> None:
         self.key = keypair if keypair else self.keygen(params)
         self.params = params
 
+    @property
+    def key(self) -> dict:
+        return self._key
+    @key.setter
+    def key(self, value: dict) -> None:
+        self._key = value
+        self._context = None
+
+    @property
+    def context(self) -> object:
+        """
+        The native cipher context, holding copies of the keys and scratch space for a single block.
+        It is built on first use and rebuilt whenever the key changes.
+        """
+        if self._context is None:
+            self._context = self.cLib.new_context(self.key['pub'], self.key.get('priv'),
+                                                  self.params['d'], self.params['p'], self.params['q'])
+        return self._context
+
     def __repr__(self) -> str:
         return '<NTRUCipher with f=%s, h=%s, params=%s>' % \
             (self.key['priv'], self.key['pub'], self.params)
 
     @staticmethod
     def __random_poly(params: dict) -> NTRUPolynomial:
+        """
+        Draws d 1s and d - 1 -1s at uniformly random positions, from a SHAKE256 stream seeded by the OS
+        """
         # In need of improvement to meet spec, see docs/ntru/ntru_params.pdf
-        k = [0 for n in range(params['N'])]
-        d1, d2 = params['d'], params['d'] - 1
-        for d, i in ((d1, 1), (d2, -1)):
-            while d:
-                r = randint(0, params['N'] - 1)
-                if not k[r]:
-                    k[r] = i
-                    d -= 1
-        return NTRUPolynomial(k)
+        return NTRUCipher.cLib.sample_ternary(params['d'], params['d'] - 1, urandom(NTRUCipher.cLib.SEED_BYTES),
+                                              NTRUPolynomial.zeros(params['N']))
 
     @staticmethod
     def keygen(params: dict) -> dict:
         """
         Generates a new valid, random public/private keypair
+        The private key f = 1 + pF is inverted modulo q natively, with the GIL released
         """
         while True:
             f = NTRUCipher.__random_poly(params) * params['p'] + 1
@@ -163,16 +238,14 @@ class NTRUCipher(AsymmetricCipher):
         return {'priv': f, 'pub': h}
 
     def __encrypt_poly(self, poly: NTRUPolynomial) -> NTRUPolynomial:
-        poly = poly.centerlift(self.params['p'])
-        r = self.__random_poly(self.params)
-        e = r * self.key['pub'] + poly
-        e %= self.params['q']
-        return e.centerlift(self.params['q']) % self.params['p']
+        """
+        Blinds, multiplies, adds and reduces a single block in one native call, in place
+        """
+        return self.cLib.encrypt_block(self.context, poly, urandom(self.cLib.SEED_BYTES), poly)
 
     def __encrypt_bytes(self, b: bytes) -> bytes:
-        polys = [self.__encrypt_poly(NTRUPolynomial(x))
-                 for x in bytes2base(b, self.params['p'], self.params['N'])]
-        return base2bytes(polys, self.params['q'])
+        polys = map(self.__encrypt_poly, iter_bytes2base(b, self.params['p'], self.params['N']))
+        return blocks2bytes(polys, self.params['q'])
 
     def encrypt(self, text: str) -> str:
         """
@@ -180,15 +253,11 @@ class NTRUCipher(AsymmetricCipher):
         """
         return str(encode(self.__encrypt_bytes(bytes(text, 'utf8'))), 'utf8')
         
-    def __decrypt_poly(self, poly):
-        a = (self.key['priv'] * poly) % self.params['q']
-        a = a.centerlift(self.params['q'])
-        b = a % self.params['p']
-        return b
-
-    def __decrypt_bytes(self, b: bytes) -> str:
-        polys = [self.__decrypt_poly(NTRUPolynomial(x))
-                 for x in bytes2base(b, self.params['q'], self.params['N'])]
+    def __decrypt_poly(self, poly: NTRUPolynomial) -> NTRUPolynomial:
+        return self.cLib.decrypt_block(self.context, poly, poly)
+
+    def __decrypt_bytes(self, b: bytes) -> bytes:
+        polys = map(self.__decrypt_poly, iter_bytes2blocks(b, self.params['q'], self.params['N']))
         return base2bytes(polys, self.params['p'])
 
     def decrypt(self, text: str) -> str:
@@ -197,19 +266,51 @@ class NTRUCipher(AsymmetricCipher):
         """
         return str(self.__decrypt_bytes(decode(text)), 'utf8')
 
-    def pubkey(self) -> str:
-        return base2bytes([self.key['pub'] % self.params['p']] + [[1]],
-                          self.params['p'])
+    def encrypt_many(self, messages: Sequence[str], workers: int = None) -> list:
+        """
+        Encrypts many strings under the current public key, returning their ciphertexts in input order.
+        Every block of every message is encrypted at once, in place, on a native thread pool of the
+        given number of workers with the GIL released. The blocks share a single seed from the OS,
+        each reading its blinding polynomial from its own stream.
+        """
+        p, q, N = self.params['p'], self.params['q'], self.params['N']
+        messages = [list(iter_bytes2base(bytes(m, 'utf8'), p, N)) for m in messages]
+        self.cLib.encrypt_many(self.context, [block for m in messages for block in m],
+                               urandom(self.cLib.SEED_BYTES), workers or cpu_count() or 1)
+        return [str(encode(blocks2bytes(m, q)), 'utf8') for m in messages]
 
-    def privkey(self) -> str:
-        return base2bytes([self.key['priv'] % self.params['q']] + [[1]],
-                          self.params['q'])
+    def decrypt_many(self, ciphertexts: Sequence[str], workers: int = None) -> list:
+        """
+        Decrypts many ciphertexts under the current private key, returning their plaintexts in input order.
+        Every block is decrypted at once, in place, on a native thread pool as for encrypt_many.
+        """
+        p, q, N = self.params['p'], self.params['q'], self.params['N']
+        ciphertexts = [list(iter_bytes2blocks(decode(c), q, N)) for c in ciphertexts]
+        self.cLib.decrypt_many(self.context, [block for c in ciphertexts for block in c],
+                               workers or cpu_count() or 1)
+        return [str(base2bytes(c, p), 'utf8') for c in ciphertexts]
+
+    def pubkey(self) -> bytes:
+        """
+        Packs the public key at a fixed width of log2(q) bits per coefficient
+        """
+        return self.cLib.pack_key(self.key['pub'], (self.params['q'] - 1).bit_length())
+
+    def privkey(self) -> bytes:
+        """
+        Packs the private key f = 1 + pF as the trits of F, five to a byte
+        """
+        F = self.cLib.s_div(self.key['priv'] - 1, self.params['p'], NTRUPolynomial.zeros(self.params['N']))
+        return self.cLib.pack_key(F, 0)
 
-    def set_key(self, pub: str = '', priv: str = ''):
+    def set_key(self, pub: bytes = b'', priv: bytes = b''):
         if pub:
-            self.key['pub'] = NTRUPolynomial(bytes2base(pub, self.params['p']))
+            self.key['pub'] = self.cLib.unpack_key(pub, (self.params['q'] - 1).bit_length(),
+                                                   NTRUPolynomial.zeros(self.params['N']))
         if priv:
-            self.key['priv'] = NTRUPolynomial(bytes2base(pub, self.params['q']))
+            F = self.cLib.unpack_key(priv, 0, NTRUPolynomial.zeros(self.params['N']))
+            self.key['priv'] = F * self.params['p'] + 1
+        self._context = None
 
     @staticmethod
     def preset(N: int, d: int, Hw: int, p: int, q: int) -> Callable:
@@ -222,13 +323,164 @@ class NTRUCipher(AsymmetricCipher):
         q  - Prime-power modulus for polynomial ring
         """
         # TODO NTRU preset should check against Hw
+        layout = ['N', 'd', 'Hw', 'p', 'q']
+        params = dict(zip(layout, (N, d, Hw, p, q)))
+
         def create(keypair: dict = None) -> NTRUCipher:
-            layout = ['N', 'd', 'Hw', 'p', 'q']
-            c = NTRUCipher(dict(zip(layout, (N, d, Hw, p, q))), keypair)
+            if keypair is None and create.pool is not None:
+                keypair = create.pool.get()
+            c = NTRUCipher(dict(params), keypair)
             return c
+        create.params = params
+        create.pool = None
         return create
 
 
+class NTRUKeyPool:
+    """
+    Keeps a stock of keypairs for a preset, generated ahead of time on background threads.
+    While open, the pool is attached to its preset, so calling the preset takes a pooled keypair.
+    """
+
+    def __init__(self, preset: Callable, size: int = 8, workers: int = 1) -> None:
+        self.preset = preset
+        self.params = preset.params
+        self.__keys: Queue = Queue(maxsize=size)
+        self.__closed = Event()
+        self.__workers = [Thread(target=self.__fill, daemon=True) for _ in range(workers)]
+        for worker in self.__workers:
+            worker.start()
+        preset.pool = self
+
+    def __enter__(self) -> NTRUKeyPool:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return self.__keys.qsize()
+
+    def __fill(self) -> None:
+        while not self.__closed.is_set():
+            keypair = NTRUCipher.keygen(self.params)
+            while not self.__closed.is_set():
+                try:
+                    self.__keys.put(keypair, timeout=0.1)
+                    break
+                except Full:
+                    pass
+
+    def get(self) -> dict:
+        """
+        Takes a pooled keypair, or generates one inline if the pool has run dry
+        """
+        try:
+            return self.__keys.get_nowait()
+        except Empty:
+            return NTRUCipher.keygen(self.params)
+
+    def close(self) -> None:
+        """
+        Stops the background workers and detaches the pool from its preset
+        """
+        self.__closed.set()
+        for worker in self.__workers:
+            worker.join()
+        if self.preset.pool is self:
+            self.preset.pool = None
+
+
+class NTRUKeyStore:
+    """
+    An append-only file of packed public keys, memory-mapped for lookups.
+    Opening the store reads only the fixed-size record headers, indexing each key's offset by id,
+    so a key is only unpacked when it is looked up. A later record for an id replaces earlier ones.
+    """
+    MAGIC = b'NTRUKEY1'
+    # N, d, Hw, p, q, then the lengths of the id and the packed key that follow
+    RECORD = Struct('<HHHHIHI')
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.__file = open(path, 'a+b')
+        if self.__file.tell() == 0:
+            self.__file.write(self.MAGIC)
+            self.__file.flush()
+        self.__map = mmap(self.__file.fileno(), 0, access=ACCESS_READ)
+        if self.__map[:len(self.MAGIC)] != self.MAGIC:
+            self.close()
+            raise ValueError("Error: %s is not an NTRU keystore" % path)
+        self.__index: dict = {}
+        self.__scan(len(self.MAGIC))
+
+    def __enter__(self) -> NTRUKeyStore:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.__index)
+
+    def __contains__(self, id: str | bytes) -> bool:
+        return self.__id(id) in self.__index
+
+    def __iter__(self) -> Iterator[bytes]:
+        return iter(self.__index)
+
+    @staticmethod
+    def __id(id: str | bytes) -> bytes:
+        return bytes(id, 'utf8') if isinstance(id, str) else bytes(id)
+
+    def __scan(self, offset: int) -> None:
+        """
+        Indexes the records from offset onwards. A record cut short by an interrupted add is truncated away,
+        along with anything after it, so a later add starts on a record boundary.
+        """
+        while offset + self.RECORD.size <= len(self.__map):
+            *params, id_len, key_len = self.RECORD.unpack_from(self.__map, offset)
+            start = offset + self.RECORD.size
+            if start + id_len + key_len > len(self.__map):
+                break
+            self.__index[self.__map[start:start + id_len]] = (tuple(params), start + id_len, key_len)
+            offset = start + id_len + key_len
+        if offset < len(self.__map):
+            self.__map.close()
+            self.__file.truncate(offset)
+            self.__file.seek(0, 2)
+            self.__map = mmap(self.__file.fileno(), 0, access=ACCESS_READ)
+
+    def add(self, id: str | bytes, cipher: NTRUCipher) -> None:
+        """
+        Appends the cipher's public key under the given id
+        """
+        id, key = self.__id(id), cipher.pubkey()
+        layout = ('N', 'd', 'Hw', 'p', 'q')
+        offset = len(self.__map)
+        self.__file.write(self.RECORD.pack(*(cipher.params[k] for k in layout), len(id), len(key)))
+        self.__file.write(id + key)
+        self.__file.flush()
+        self.__map.close()
+        self.__map = mmap(self.__file.fileno(), 0, access=ACCESS_READ)
+        self.__scan(offset)
+
+    def __getitem__(self, id: str | bytes) -> NTRUCipher:
+        """
+        Returns an encrypt-only cipher for the public key stored under the given id
+        """
+        params, start, length = self.__index[self.__id(id)]
+        params = dict(zip(('N', 'd', 'Hw', 'p', 'q'), params))
+        with memoryview(self.__map)[start:start + length] as key:
+            pub = NTRUCipher.cLib.unpack_key(key, (params['q'] - 1).bit_length(),
+                                             NTRUPolynomial.zeros(params['N']))
+        return NTRUCipher(params, {'pub': pub, 'priv': None})
+
+    def close(self) -> None:
+        self.__map.close()
+        self.__file.close()
+
+
 # NTRUEncrypt parameter presets
 NTRUEncrypt80 = NTRUCipher.preset(251, 8, 72, 3, 3**8)
 NTRUEncrypt112 = NTRUCipher.preset(347, 11, 132, 3, 3**9)
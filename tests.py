@@ -1,7 +1,14 @@
 #! /usr/bin/env python3
 
+import hashlib
+import importlib.util
+import json
+import os
 import random
 import string
+import tempfile
+import threading
+import time
 import unittest
 
 
@@ -48,6 +55,26 @@ def asciistr(i: int):
     return ''.join([random.choice(string.ascii_lowercase) for _ in range(i)])
 
 
+def import_backend(name: str, backend: str):
+    """
+    Imports a separate copy of a module with NTRU_BACKEND set, or returns None if the backend is unavailable
+    """
+    spec = importlib.util.find_spec(name)
+    module = importlib.util.module_from_spec(spec)
+    saved = os.environ.get('NTRU_BACKEND')
+    os.environ['NTRU_BACKEND'] = backend
+    try:
+        spec.loader.exec_module(module)
+    except ImportError:
+        return None
+    finally:
+        if saved is None:
+            del os.environ['NTRU_BACKEND']
+        else:
+            os.environ['NTRU_BACKEND'] = saved
+    return module
+
+
 
 class CipherTests:
 
@@ -59,8 +86,7 @@ class CipherTests:
 
 
 
-class TestNTRUEncryptMethods(CipherTests, metaclass=TestSuiteMeta):
-    import ntruencrypt
+class NTRUTests(CipherTests):
 
     def setUp(self):
         self.cipher = self.ntruencrypt.NTRUEncrypt256()
@@ -68,12 +94,172 @@ class TestNTRUEncryptMethods(CipherTests, metaclass=TestSuiteMeta):
     def test_keygen(self):
         assert self.cipher.keygen(self.cipher.params)
 
+    def test_inverse(self):
+        Polynomial, N = self.ntruencrypt.NTRUPolynomial, self.cipher.params['N']
+        f, one = self.cipher.key['priv'], Polynomial([1] + [0] * (N - 1))
+        for modulus in (3, self.cipher.params['q']):
+            inverse = f.inverse_modpn(modulus)
+            assert inverse is not None and (f * inverse) % modulus == one
+        inverse = None
+        while inverse is None:
+            g = Polynomial(random.randint(-1, 1) for _ in range(N))
+            inverse = g.inverse_modpn(2**16)
+        assert (g * inverse) % 2**16 == one
+        assert Polynomial([1, -1] + [0] * (N - 2)).inverse_modp(3) is None
+        assert Polynomial.zeros(N).inverse_modp(2) is None
+        # Primes other than 2 and 3 take the general path, which gives up on a key sharing a factor with X^N - 1
+        for F in ([1, -1] + [0] * (N - 2), [1] * N, [2, 0, 3] + [0] * (N - 3)):
+            assert Polynomial(F).inverse_modpn(5**3) is None
+
+    def test_encrypt_many(self):
+        texts = [asciistr(random.randint(0, 600)) for _ in range(20)]
+        for workers in (1, 4):
+            encrs = self.cipher.encrypt_many(texts, workers=workers)
+            assert [self.cipher.decrypt(e) for e in encrs] == texts
+            assert self.cipher.decrypt_many(encrs, workers=workers) == texts
+
+    def test_key_serialisation(self):
+        pub, priv = self.cipher.pubkey(), self.cipher.privkey()
+        N, q = self.cipher.params['N'], self.cipher.params['q']
+        assert len(pub) == (N * (q - 1).bit_length() + 7) // 8 and len(priv) == (N + 4) // 5
+        other = self.ntruencrypt.NTRUEncrypt256()
+        other.set_key(pub=pub, priv=priv)
+        assert other.key['pub'] == self.cipher.key['pub'] and other.key['priv'] == self.cipher.key['priv']
+        text = asciistr(64)
+        assert other.decrypt(self.cipher.encrypt(text)) == text
+
+    def test_keystore(self):
+        ciphers = {'node%d' % i: self.ntruencrypt.NTRUEncrypt80() for i in range(5)}
+        with tempfile.TemporaryDirectory() as tmp:
+            path = tmp + '/keys'
+            with self.ntruencrypt.NTRUKeyStore(path) as store:
+                for id, cipher in ciphers.items():
+                    store.add(id, cipher)
+                assert len(store) == 5 and 'node3' in store
+            with self.ntruencrypt.NTRUKeyStore(path) as store:
+                for id, cipher in ciphers.items():
+                    assert store[id].key['pub'] == cipher.key['pub']
+                text = asciistr(64)
+                assert ciphers['node2'].decrypt(store['node2'].encrypt(text)) == text
+            # An add interrupted part way through a key, then one interrupted part way through a header
+            size = os.path.getsize(path)
+            for kept in (-10, 3):
+                with self.ntruencrypt.NTRUKeyStore(path) as store:
+                    store.add('node5', ciphers['node0'])
+                with open(path, 'r+b') as file:
+                    file.truncate(size + kept if kept > 0 else file.seek(0, 2) + kept)
+                with self.ntruencrypt.NTRUKeyStore(path) as store:
+                    assert len(store) == 5 and 'node5' not in store
+                    assert store['node4'].key['pub'] == ciphers['node4'].key['pub']
+                assert os.path.getsize(path) == size
+
+    def test_key_pool(self):
+        preset = self.ntruencrypt.NTRUEncrypt80
+        with self.ntruencrypt.NTRUKeyPool(preset, size=2) as pool:
+            assert preset.pool is pool
+            cipher = preset()
+            text = asciistr(64)
+            assert cipher.decrypt(cipher.encrypt(text)) == text
+        assert preset.pool is None
+
     def test_encode(self):
         text = bytes(asciistr(64), 'utf8')
         encd = self.ntruencrypt.bytes2base(text, self.cipher.params['p'], self.cipher.params['N'])
         decd = self.ntruencrypt.base2bytes(encd, self.cipher.params['p'])
         assert text == decd
 
+    def test_encode_streaming(self):
+        N, q = self.cipher.params['N'], self.cipher.params['q']
+        for base in (self.cipher.params['p'], 256):
+            for length in (0, 1, N - 1, N, 3 * N + 5):
+                text = bytes(random.getrandbits(8) for _ in range(length))
+                blocks = list(self.ntruencrypt.iter_bytes2base(text, base, N))
+                assert all(len(block) == N for block in blocks)
+                assert b''.join(self.ntruencrypt.iter_base2bytes(iter(blocks), base)) == text
+        digits = [self.ntruencrypt.NTRUPolynomial(random.randrange(q) for _ in range(N)) for _ in range(3)]
+        digits[-1][-1] = 1
+        assert self.ntruencrypt.bytes2base(self.ntruencrypt.base2bytes(digits, q), q, N)[:3] == digits
+
+    def test_multiply(self):
+        Polynomial, N = self.ntruencrypt.NTRUPolynomial, self.cipher.params['N']
+        cLib = Polynomial.cLib
+        dense = Polynomial(random.randint(-1000, 1000) for _ in range(N))
+        other = Polynomial(random.randint(-1000, 1000) for _ in range(N))
+        sparse = self.cipher._NTRUCipher__random_poly(self.cipher.params)
+        expected = cLib.schoolbook_mul(dense, other, Polynomial.zeros(N))
+        assert cLib.karatsuba_mul(dense, other, Polynomial.zeros(N)) == expected
+        assert dense * other == expected
+        assert cLib.sparse_mul(sparse, dense, Polynomial.zeros(N)) == \
+            cLib.schoolbook_mul(sparse, dense, Polynomial.zeros(N))
+        for p, q in ((sparse, dense), (dense, sparse)):
+            assert p * q == cLib.schoolbook_mul(p, q, Polynomial.zeros(N))
+
+    def test_inplace(self):
+        Polynomial, q = self.ntruencrypt.NTRUPolynomial, self.cipher.params['q']
+        r = self.cipher._NTRUCipher__random_poly(self.cipher.params)
+        h, m = self.cipher.key['pub'], Polynomial(random.randint(-1, 1) for _ in range(len(r)))
+        expected = Polynomial((x + y) % q for x, y in zip(r * h, m))
+        e = r * h
+        e += m
+        e %= q
+        assert e == (r * h + m) % q == expected
+        e *= r
+        assert e == expected * r
+        assert memoryview(e).format == 'i' and memoryview(e).nbytes == len(r) * e.itemsize
+
+    def test_sample(self):
+        Polynomial, cLib = self.ntruencrypt.NTRUPolynomial, self.cipher.cLib
+        N, d, seed = self.cipher.params['N'], self.cipher.params['d'], os.urandom(cLib.SEED_BYTES)
+        polys = cLib.sample_many(d, d - 1, seed, [Polynomial.zeros(N) for _ in range(50)])
+        assert all(sorted(r) == [-1] * (d - 1) + [0] * (N - 2 * d + 1) + [1] * d for r in polys)
+        assert len(set(map(bytes, polys))) == len(polys)
+        assert cLib.sample_ternary(d, d - 1, seed, Polynomial.zeros(N)) == polys[0]
+        assert cLib.sample_many(d, d - 1, seed, [Polynomial.zeros(N) for _ in range(50)]) == polys
+        with self.assertRaises(ValueError):
+            cLib.sample_ternary(d, d - 1, seed[1:], Polynomial.zeros(N))
+
+    def test_blocks(self):
+        Polynomial, params = self.ntruencrypt.NTRUPolynomial, self.cipher.params
+        cLib, N, d, p, q = self.cipher.cLib, params['N'], params['d'], params['p'], params['q']
+        f, h = self.cipher.key['priv'], self.cipher.key['pub']
+        m, seed = Polynomial(random.randrange(p) for _ in range(N)), os.urandom(cLib.SEED_BYTES)
+        r = cLib.sample_ternary(d, d - 1, seed, Polynomial.zeros(N))
+        assert sorted(r) == [-1] * (d - 1) + [0] * (N - 2 * d + 1) + [1] * d
+        e = cLib.encrypt_block(self.cipher.context, m, seed, Polynomial.zeros(N))
+        assert e == (r * h + m.centerlift(p)) % q
+        a = cLib.decrypt_block(self.cipher.context, e, Polynomial.zeros(N))
+        assert a == ((f * e) % q).centerlift(q) % p
+
+
+
+class TestNTRUEncryptMethods(NTRUTests, metaclass=TestSuiteMeta):
+    import ntruencrypt
+
+
+
+class TestNTRUEncryptNumpyMethods(NTRUTests, metaclass=TestSuiteMeta):
+    ntruencrypt = import_backend('ntruencrypt', 'numpy')
+
+    def setUp(self):
+        if self.ntruencrypt is None:
+            raise unittest.SkipTest('NumPy is not installed')
+        super().setUp()
+
+    def test_batch(self):
+        cLib, params = self.ntruencrypt.NTRUPolynomial.cLib, self.cipher.params
+        np, N, p = cLib.np, params['N'], params['p']
+        m = np.random.randint(0, p, (50, N)).astype(np.intc)
+        e = cLib.encrypt_block(self.cipher.context, m, os.urandom(cLib.SEED_BYTES), np.zeros_like(m))
+        assert (cLib.decrypt_block(self.cipher.context, e, np.zeros_like(e)) == m).all()
+        product = cLib.v_mul(m, self.cipher.key['pub'], np.zeros_like(m))
+        seed = os.urandom(cLib.SEED_BYTES)
+        native = TestNTRUEncryptMethods.ntruencrypt.NTRUPolynomial.cLib
+        assert (cLib.sample_ternary(params['d'], params['d'] - 1, seed, np.zeros_like(m)) ==
+                native.sample_many(params['d'], params['d'] - 1, seed, [np.zeros(N, np.intc) for _ in m])).all()
+        for row, expected in zip(m, product):
+            assert self.ntruencrypt.NTRUPolynomial(row) * self.cipher.key['pub'] == \
+                self.ntruencrypt.NTRUPolynomial(expected)
+
 
 
 class TestKeccakHashMethods(metaclass=TestSuiteMeta):
@@ -86,6 +272,78 @@ class TestKeccakHashMethods(metaclass=TestSuiteMeta):
         k2 = self.keccak.Keccak512(text)
         assert k1.digest() == k2.digest()
 
+    def test_known_answers(self):
+        presets = ((self.keccak.Keccak224, hashlib.sha3_224),
+                   (self.keccak.Keccak256, hashlib.sha3_256),
+                   (self.keccak.Keccak384, hashlib.sha3_384),
+                   (self.keccak.Keccak512, hashlib.sha3_512))
+        for length in (0, 1, 71, 72, 73, 135, 136, 137, 1000):
+            text = bytes(random.getrandbits(8) for _ in range(length))
+            split = random.randint(0, length)
+            for preset, reference in presets:
+                k = preset(text[:split])
+                k.update(text[split:])
+                assert k.hexdigest() == reference(text).hexdigest()
+
+    def test_xof(self):
+        text = bytes(asciistr(256), 'utf8')
+        for preset, reference in ((self.keccak.Shake128, hashlib.shake_128),
+                                  (self.keccak.Shake256, hashlib.shake_256)):
+            k = preset(text)
+            stream = reference(text).digest(1000)
+            assert k.digest(1000) == stream
+            reads = [k.read(n) for n in (0, 1, 7, 200, 300, 492)]
+            assert b''.join(reads) == stream
+
+    def test_parallel_hash(self):
+        # NIST SP 800-185 ParallelHash128 samples #1 and #2
+        text = bytes.fromhex('000102030405060710111213141516172021222324252627')
+        k = self.keccak.ParallelHash128(text, chunk_size=8)
+        assert k.hexdigest(32) == 'ba8dc1d1d979331d3f813603c67f7260' \
+                                  '9ab5e44b94a0b8f9af46514454a2b4f5'
+        k = self.keccak.ParallelHash128(text, chunk_size=8, customization=b'Parallel Data')
+        assert k.hexdigest(32) == 'fc484dcb3f84dceedc353438151bee58' \
+                                  '157d6efed0445a81f165e495795b7206'
+
+    def test_parallel_hash_streaming(self):
+        text = bytes(asciistr(5000), 'utf8')
+        digest = self.keccak.ParallelHash256(text, chunk_size=256).digest()
+        k = self.keccak.ParallelHash256(chunk_size=256, workers=4)
+        position = 0
+        while position < len(text):
+            step = random.randint(1, 600)
+            k.update(text[position:position + step])
+            position += step
+        assert k.digest() == digest
+
+    def test_copy(self):
+        text = asciistr(64)
+        k1 = self.keccak.Keccak256(text)
+        k2 = k1.copy()
+        k2.update(text)
+        assert k1.digest() == self.keccak.Keccak256(text).digest()
+        assert k2.digest() == self.keccak.Keccak256(text + text).digest()
+
+    def test_buffer(self):
+        text = bytes(asciistr(4096), 'utf8')
+        digest = self.keccak.Keccak256(text).digest()
+        for buffer in (bytearray(text), memoryview(text), str(text, 'utf8')):
+            assert self.keccak.Keccak256(buffer).digest() == digest
+
+    def test_update_file(self):
+        text = bytes(asciistr(4096), 'utf8')
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(text)
+            f.flush()
+            k = self.keccak.Keccak256()
+            k.update_file(f.name)
+        assert k.digest() == self.keccak.Keccak256(text).digest()
+
+    def test_hash_many(self):
+        texts = [asciistr(random.randint(0, 512)) for _ in range(64)]
+        digests = self.keccak.hash_many(texts, preset=self.keccak.Keccak384, workers=4)
+        assert digests == [self.keccak.Keccak384(text).digest() for text in texts]
+
 
 
 class TestFeistelCipherMethods(CipherTests, metaclass=TestSuiteMeta):
@@ -94,6 +352,401 @@ class TestFeistelCipherMethods(CipherTests, metaclass=TestSuiteMeta):
     def setUp(self):
         self.cipher = self.feistel.FeistelCipher()
 
+    def test_encrypt_bytes(self):
+        for mode in (self.cipher.MODE_ECB, self.cipher.MODE_CBC, self.cipher.MODE_PCBC,
+                     self.cipher.MODE_CFB, self.cipher.MODE_OFB, self.cipher.MODE_CTR):
+            self.cipher.mode = mode
+            for length in (0, 1, 1023, 1024, 3000):
+                data = bytes(random.getrandbits(8) for _ in range(length)) + b'\x00'
+                encr = self.cipher.encrypt_bytes(data)
+                assert len(encr) == self.cipher.padded_length(len(data))
+                assert self.cipher.decrypt_bytes(encr) == data
+
+    def test_ctr_workers(self):
+        data = bytes(random.getrandbits(8) for _ in range(10000))
+        nonce = os.urandom(self.cipher.NONCE_LEN)
+        self.cipher.mode = self.cipher.MODE_CTR
+        self.cipher.workers = 1
+        encr = self.cipher.cLib.encrypt_bytes(self.cipher.context, data, nonce)
+        self.cipher.workers = 4
+        assert self.cipher.cLib.encrypt_bytes(self.cipher.context, data, nonce) == encr
+        assert self.cipher.decrypt_bytes(encr) == data
+
+    def test_ctr_nonce(self):
+        data = bytes(2 * self.cipher.BLOCK_LEN)
+        assert self.cipher.nonce_len == 0 and self.cipher.nonce() == b''
+        self.cipher.mode = self.cipher.MODE_CTR
+        assert self.cipher.nonce_len == self.cipher.NONCE_LEN == 16
+        assert self.cipher.padded_length(len(data)) == 3 * self.cipher.BLOCK_LEN + self.cipher.NONCE_LEN
+        first, second = self.cipher.encrypt_bytes(data), self.cipher.encrypt_bytes(data)
+        assert first != second and first[self.cipher.NONCE_LEN:] != second[self.cipher.NONCE_LEN:]
+        assert self.cipher.decrypt_bytes(first) == self.cipher.decrypt_bytes(second) == data
+        # Reusing the keystream would make the XOR of the ciphertexts that of the plaintexts, here all zero
+        xored = bytes(a ^ b for a, b in zip(first[self.cipher.NONCE_LEN:], second[self.cipher.NONCE_LEN:]))
+        assert xored != bytes(len(xored))
+
+    def test_stream(self):
+        data = bytes(random.getrandbits(8) for _ in range(5000))
+        for mode in (self.cipher.MODE_CBC, self.cipher.MODE_CTR):
+            self.cipher.mode = mode
+            encryptor, decryptor = self.cipher.encryptor(), self.cipher.decryptor()
+            encr, decr = b'', b''
+            for i in range(0, len(data), 700):
+                encr += encryptor.update(data[i:i + 700])
+            encr += encryptor.finalize()
+            assert len(encr) == self.cipher.padded_length(len(data))
+            if mode != self.cipher.MODE_CTR:
+                assert encr == self.cipher.encrypt_bytes(data)
+            assert self.cipher.decrypt_bytes(encr) == data
+            for i in range(0, len(encr), 300):
+                decr += decryptor.update(encr[i:i + 300])
+            decr += decryptor.finalize()
+            assert decr == data
+
+    def test_encrypt_into(self):
+        data = bytes(random.getrandbits(8) for _ in range(3000))
+        for mode in (self.cipher.MODE_CBC, self.cipher.MODE_CTR):
+            self.cipher.mode = mode
+            encr = bytearray(self.cipher.padded_length(len(data)))
+            assert self.cipher.encrypt_into(data, encr) == len(encr)
+            decr = bytearray(len(encr))
+            assert self.cipher.decrypt_into(memoryview(encr), decr) == len(data)
+            assert decr[:len(data)] == data
+
+
+
+class TestBlockchainMethods(metaclass=TestSuiteMeta):
+    try:
+        import blockchain
+    except ImportError:
+        blockchain = None
+
+    def setUp(self):
+        if self.blockchain is None:
+            raise unittest.SkipTest('Flask is not installed')
+        self.chain = self.blockchain.Blockchain(workers=2)
+
+    def test_proof_of_work(self):
+        last_block = self.chain.last_block
+        proof = self.chain.proof_of_work(last_block, difficulty=4)
+        last_hash = self.chain.hash(last_block)
+        assert self.chain.valid_proof(last_block.proof, proof, last_hash, difficulty=4)
+        guess = hashlib.sha256(f'{last_block.proof}{proof}{last_hash}'.encode()).hexdigest()
+        assert guess[:4] == '0000'
+        assert self.chain.miner.hashes > 0 and self.chain.miner.hashrate > 0
+
+    def test_hashrate(self):
+        miner, last_block = self.chain.miner, self.chain.last_block
+        # Every proof meets difficulty 0, so each worker stops at its first guess rather than a whole chunk
+        assert miner.search(last_block.proof, last_block.hash, 0) is not None
+        assert 1 <= miner.hashes <= miner.workers < miner.chunk
+        for difficulty in (-1, self.blockchain.MAX_DIFFICULTY + 1):
+            try:
+                miner.search(last_block.proof, last_block.hash, difficulty)
+                assert False
+            except ValueError:
+                pass
+
+    def grow(self, chain, count: int) -> None:
+        for _ in range(count):
+            last_block, proof = chain.last_block, 0
+            while not chain.valid_proof(last_block.proof, proof, last_block.hash, chain.difficulty):
+                proof += 1
+            chain.new_transaction('0', asciistr(8), random.randint(1, 10))
+            chain.new_block(proof, last_block.hash)
+
+    def test_valid_chain(self):
+        Block = self.blockchain.Block
+        self.chain.difficulty = 2
+        self.grow(self.chain, 20)
+        peer = self.blockchain.Blockchain(difficulty=2)
+        peer.chain = list(self.chain.chain)
+        self.grow(peer, 5)
+        assert self.chain.valid_chain(peer.chain)
+        received = [Block(**block) for block in json.loads(json.dumps([b._asdict() for b in peer.chain]))]
+        assert received == peer.chain and self.chain.valid_chain(received)
+        forged = list(peer.chain)
+        forged[22] = forged[22]._replace(proof=forged[22].proof + 1)
+        assert not self.chain.valid_chain(forged)
+        forged[22] = forged[22]._replace(hash=self.chain.hash(forged[22]))
+        assert not self.chain.valid_chain(forged)
+        # Rewriting an early block forks the chain there, as every later block must be relinked to it
+        forged = list(peer.chain)
+        forged[3] = forged[3]._replace(timestamp=0)
+        for i in range(3, len(forged)):
+            if i > 3:
+                forged[i] = forged[i]._replace(previous_hash=forged[i - 1].hash)
+            forged[i] = forged[i]._replace(hash=self.chain.hash(forged[i]))
+        assert not self.chain.valid_chain(forged)
+        # Blocks up to the fork are matched by hash and kept from our own chain, so only the rest are checked
+        assert self.chain.common_prefix(forged) == 3 and self.chain.common_prefix(peer.chain) == 21
+        assert self.chain.common_prefix(peer.chain[21:], 21) == 21
+
+    def test_encoding(self):
+        bc = self.blockchain
+        self.chain.difficulty = 1
+        self.chain.new_transaction('alice', 'b\u00f6b', -3)
+        self.grow(self.chain, 3)
+        for block in self.chain.chain:
+            encoded = bc.encode_block(block)
+            assert bc.decode_block(encoded, block.hash) == block
+            assert hashlib.sha256(encoded).hexdigest() == block.hash == self.chain.hash(block)
+        assert bc.unpack_blocks(b''.join(bc.pack_blocks(self.chain.chain))) == self.chain.chain
+        block = self.chain.last_block
+        assert self.chain.hash(block._replace(hash='00' * 32, message='ignored')) == block.hash
+        assert self.chain.hash(block._replace(timestamp=block.timestamp + 1)) != block.hash
+        try:
+            bc.decode_block(bc.encode_block(block) + b'\x00')
+            assert False
+        except ValueError:
+            pass
+        assert not self.chain.valid_chain(self.chain.chain[:-1] + [block._replace(proof='1', hash='ff' * 32)])
+        # Hashes that would be padded, truncated or read loosely into the fixed-width encoding
+        for hash in ('ab', 'ab' + '00' * 32, block.hash.upper(), ' ' + block.hash[1:], block.hash[:-2] + ' 0',
+                     'zz' + block.hash[2:], None):
+            for bad in (block._replace(previous_hash=hash), block._replace(hash=hash)):
+                try:
+                    list(bc.pack_blocks([bad]))
+                    assert False
+                except ValueError:
+                    pass
+
+    def test_transaction_limits(self):
+        node = self.blockchain.BlockchainNode(__name__)
+        node.blockchain.difficulty = 1
+        client = node.test_client()
+        for sender, recipient, amount in (('a', 'b', 1 << 64), ('a', 'b', -(1 << 63) - 1), ('a', 'b', True),
+                                          ('a', 'b', 1.5), ('a', 'b', '1'), ('a' * 0x10000, 'b', 1),
+                                          ('a', '\u00e9' * 0x8000, 1), (5, 'b', 1), ('\ud800', 'b', 1)):
+            response = client.post('/transactions/new', json={'sender': sender, 'recipient': recipient,
+                                                              'amount': amount})
+            assert response.status_code == 400
+        assert client.post('/transactions/new', json=[1, 2, 3]).status_code == 400
+        assert node.blockchain.current_transactions == []
+        for amount in ((1 << 63) - 1, -1 << 63):
+            response = client.post('/transactions/new', json={'sender': 'a' * 0xFFFF, 'recipient': 'b',
+                                                              'amount': amount})
+            assert response.status_code == 201
+        assert client.get('/mine').status_code == 200 and len(node.blockchain.last_block.transactions) == 3
+        # A block that cannot be encoded is not forged, and takes no reward with it
+        node.blockchain.current_transactions.append(self.blockchain.Transaction('a', 'b', 1 << 64))
+        node.logger.disabled = True
+        assert client.get('/mine').status_code == 500
+        assert len(node.blockchain.current_transactions) == 1 and len(node.blockchain.chain) == 2
+
+    def test_block_store(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = tmp + '/chain'
+            chain = self.blockchain.Blockchain(difficulty=1, path=path)
+            self.grow(chain, 10)
+            blocks = list(chain.chain)
+            chain.chain.close()
+            with self.blockchain.BlockStore(path) as store:
+                assert len(store) == 11 and store[:] == blocks and store[-1] == blocks[-1]
+                assert store.get(blocks[4].hash) == blocks[4] and store.height(blocks[7].hash) == 7
+                assert store.get('00' * 32) is None
+                del store[8:]
+                assert len(store) == 8 and store.height(blocks[9].hash) is None
+                store.extend(blocks[8:])
+                assert list(store) == blocks
+            # An append interrupted after the block was written, then one interrupted part way through it
+            with open(path + '.idx', 'r+b') as index:
+                index.truncate(index.seek(0, 2) - self.blockchain.BlockStore.ENTRY.size)
+            with open(path, 'ab') as data:
+                data.write(b'\xff\x00')
+            chain = self.blockchain.Blockchain(difficulty=1, path=path)
+            assert chain.chain[:] == blocks and chain.chain.get(blocks[-1].hash) == blocks[-1]
+            self.grow(chain, 2)
+            self.chain.difficulty = 1
+            assert self.chain.valid_chain(chain.chain[:])
+            chain.chain.close()
+
+    def test_block_store_hashes(self):
+        Block, BlockStore = self.blockchain.Block, self.blockchain.BlockStore
+        blocks, previous = [], '00' * 32
+        for index in range(1, 1501):
+            previous = hashlib.sha256(previous.encode()).hexdigest()
+            blocks.append(Block(None, index, float(index), [], index, '00' * 32, previous))
+        with tempfile.TemporaryDirectory() as tmp:
+            path = tmp + '/chain'
+            # Grows past the table's first size, so it is rebuilt along the way
+            with BlockStore(path) as store:
+                store.extend(blocks[:1000])
+                assert all(store.height(block.hash) == block.index - 1 for block in blocks[:1000])
+                del store[900:]
+                store.extend(blocks[950:1000])
+                assert store.height(blocks[920].hash) is None and store.height(blocks[960].hash) == 910
+            # A table that has fallen behind the chain, then a damaged one, then a missing one
+            with open(path + '.hash', 'r+b') as table:
+                hashes = table.read()
+            with BlockStore(path) as store:
+                store.extend(blocks[1000:])
+            for table in (hashes, b'\xff' + hashes[1:], None):
+                if table is None:
+                    os.remove(path + '.hash')
+                else:
+                    with open(path + '.hash', 'wb') as file:
+                        file.write(table)
+                with BlockStore(path) as store:
+                    assert len(store) == 1450 and store.height(blocks[-1].hash) == 1449
+                    assert store.get(blocks[960].hash) == blocks[960] and store.height(blocks[920].hash) is None
+
+    def test_block_store_threads(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            chain = self.blockchain.Blockchain(difficulty=1, path=tmp + '/chain')
+            store, errors, done = chain.chain, [], threading.Event()
+
+            def read():
+                while not done.is_set():
+                    try:
+                        height = random.randrange(len(store))
+                        block = store[height]
+                        assert block.index == height + 1 and store.get(block.hash) is not None
+                        store[-3:]
+                    except IndexError:
+                        # Only a block truncated away between len and the lookup may be missing
+                        pass
+                    except Exception as e:
+                        errors.append(e)
+                        return
+
+            readers = [threading.Thread(target=read) for _ in range(4)]
+            for reader in readers:
+                reader.start()
+            try:
+                for i in range(200):
+                    chain.new_transaction('0', asciistr(8), 1)
+                    chain.new_block(0, None)
+                    if i % 50 == 49:
+                        del store[len(store) - 10:]
+                    assert chain.last_block.index == len(store)
+            finally:
+                done.set()
+                for reader in readers:
+                    reader.join()
+                store.close()
+            assert errors == []
+
+    def serve(self, app):
+        from werkzeug.serving import make_server
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def test_resolve_conflicts(self):
+        flask = self.blockchain.Flask
+        nodes = [self.blockchain.BlockchainNode(__name__) for _ in range(3)]
+        for node in nodes:
+            node.blockchain.difficulty = 2
+            node.blockchain.chain = list(self.chain.chain)
+        self.grow(nodes[0].blockchain, 3)
+        self.grow(nodes[1].blockchain, 6)
+        slow = flask(__name__)
+        slow.add_url_rule('/chain/tip', view_func=lambda: time.sleep(3) or ('', 200))
+        dead = flask(__name__)
+        dead.add_url_rule('/chain/tip', view_func=lambda: ('', 500))
+        # Neighbours whose tips are well-formed JSON, but not a length
+        malformed = []
+        for tip in ({'height': 99}, [99], {'length': '99'}, {'length': True}):
+            malformed.append(flask(__name__))
+            malformed[-1].add_url_rule('/chain/tip', view_func=lambda tip=tip: (json.dumps(tip), 200))
+        self.chain.difficulty, self.chain.timeout = 2, 0.5
+        servers = [self.serve(app) for app in nodes + [slow, dead] + malformed]
+        try:
+            for server in servers:
+                self.chain.register_node('http://127.0.0.1:%d' % server.server_port)
+            start = time.perf_counter()
+            assert self.chain.resolve_conflicts()
+            assert time.perf_counter() - start < 2
+            assert self.chain.chain == nodes[1].blockchain.chain
+            assert not self.chain.resolve_conflicts()
+        finally:
+            for server in servers:
+                server.shutdown()
+
+    def test_stored_node(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            node = self.blockchain.BlockchainNode(__name__, path=tmp + '/chain')
+            store = node.blockchain.chain
+            try:
+                node.blockchain.difficulty = 1
+                self.grow(node.blockchain, 10)
+                response = node.test_client().get('/mine')
+                assert response.status_code == 200 and len(store) == 12
+                # A longer neighbour that forks from our chain at height 8
+                peer = self.blockchain.BlockchainNode(__name__)
+                peer.blockchain.difficulty = 1
+                peer.blockchain.chain = store[:8]
+                self.grow(peer.blockchain, 6)
+                server = self.serve(peer)
+                try:
+                    node.blockchain.register_node('127.0.0.1:%d' % server.server_port)
+                    assert node.blockchain.sync('127.0.0.1:%d' % server.server_port) == (8, peer.blockchain.chain[8:])
+                    assert node.blockchain.resolve_conflicts()
+                finally:
+                    server.shutdown()
+                assert isinstance(node.blockchain.chain, self.blockchain.BlockStore)
+                assert store[:] == peer.blockchain.chain
+            finally:
+                store.close()
+            with self.blockchain.BlockStore(tmp + '/chain') as store:
+                assert store[:] == peer.blockchain.chain
+
+    def test_chain_range(self):
+        node = self.blockchain.BlockchainNode(__name__)
+        node.blockchain.difficulty = 1
+        self.grow(node.blockchain, 9)
+        client = node.test_client()
+        response = client.get('/chain?from=3&limit=4').get_json()
+        assert response['length'] == 10 and [block['index'] for block in response['chain']] == [3, 4, 5, 6]
+        response = client.get('/chain?from=8', headers={'Accept': self.blockchain.NDJSON})
+        assert response.mimetype == self.blockchain.NDJSON and response.headers['X-Chain-Length'] == '10'
+        blocks = [self.blockchain.Block(**json.loads(line)) for line in response.data.splitlines()]
+        assert blocks == node.blockchain.chain[7:]
+        assert client.get('/chain/tip').get_json() == {'length': 10, 'hash': node.blockchain.last_block.hash}
+        assert client.get('/chain?from=0').status_code == 400
+        # A stream carries the chain as it was when requested, even if it is replaced part way through
+        expected = list(node.blockchain.chain[2:])
+        for mimetype in (self.blockchain.NDJSON, self.blockchain.BLOCKS):
+            response = client.get('/chain?from=3', headers={'Accept': mimetype}, buffered=False)
+            stream = iter(response.response)
+            first = next(stream)
+            del node.blockchain.chain[5:]
+            self.grow(node.blockchain, 7)
+            data = first + b''.join(stream)
+            if mimetype == self.blockchain.NDJSON:
+                assert [self.blockchain.Block(**json.loads(line)) for line in data.splitlines()] == expected
+            else:
+                assert self.blockchain.unpack_blocks(data) == expected
+            expected = list(node.blockchain.chain[2:])
+
+    def test_sync(self):
+        self.chain.difficulty = 1
+        self.grow(self.chain, 20)
+        node = self.blockchain.BlockchainNode(__name__)
+        node.blockchain.difficulty = 1
+        node.blockchain.chain = self.chain.chain[:15]
+        self.grow(node.blockchain, 10)
+        server = self.serve(node)
+        try:
+            address = '127.0.0.1:%d' % server.server_port
+            assert self.chain.sync(address) == (15, node.blockchain.chain[15:])
+            self.chain.chain = node.blockchain.chain[:20]
+            assert self.chain.fetch_blocks(address, 21) == node.blockchain.chain[20:]
+            assert self.chain.sync(address) == (20, node.blockchain.chain[20:])
+        finally:
+            server.shutdown()
+
+    def test_cancel(self):
+        results = []
+        miner = threading.Thread(target=lambda: results.append(
+            self.chain.proof_of_work(self.chain.last_block, difficulty=32)))
+        miner.start()
+        time.sleep(0.5)
+        self.chain.miner.cancel()
+        miner.join(timeout=10)
+        assert not miner.is_alive() and results == [None]
+
 
 
 if __name__ == '__main__':